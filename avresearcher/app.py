@@ -1,18 +1,39 @@
-from flask import Flask
+import logging
+import os
+
+from flask import Flask, current_app
 from elasticsearch import Elasticsearch
 
+from .cache import LocalCache, make_cache
+from .jobs import BoundedPool, MailQueue
+from .metrics import Metrics
+from .singleflight import SingleFlight
+from .slow_queries import make_slow_query_log
+from .usage_log import UsageLogQueue
 from .views import views
 from .models import User
 from .extensions import mail, db, bcrypt, sentry, login_manager
 
 
-__all__ = ['create_app']
+__all__ = ['create_app', 'warm_up']
+
+
+logger = logging.getLogger(__name__)
 
 
 DEFAULT_BLUEPRINTS = (
     views,
 )
 
+# The directory of manage.py and wsgi.py
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings that are paths of files or directories written by the app.
+# Relative paths are relative to PROJECT_ROOT, so the app and manage.py use
+# the same files whatever the working directory (e.g. uWSGI's chdir) is.
+PATH_SETTINGS = ['COLLECTION_STATS_PATH', 'MAIL_QUEUE_PATH',
+                 'SLOW_QUERY_LOG_PATH', 'USAGE_LOG_JOURNAL_PATH']
+
 
 def create_app(package_name='avresearcher', settings_override=None):
     """Returns a :class:`Flask` application instance configured with
@@ -27,6 +48,7 @@ def create_app(package_name='avresearcher', settings_override=None):
     app.config.from_object('avresearcher.settings')
     app.config.from_object(settings_override)
     _validate(app.config)
+    _resolve_paths(app.config)
 
     if app.config['DEBUG'] and app.config['SENTRY_DSN']:
         sentry.init_app(app)
@@ -38,13 +60,64 @@ def create_app(package_name='avresearcher', settings_override=None):
     @login_manager.user_loader
     def load_user(user_id):
         """ Callback for reloading a user from the session. None is returned
-        if the user does not exist."""
-
-        return db.session.query(User).get(int(user_id))
+        if the user does not exist.
+
+        Users are kept in the user cache (if enabled), so that most requests
+        don't query the database."""
+        user_id = int(user_id)
+        user_cache = current_app.user_cache
+        if user_cache is not None:
+            user = user_cache.get(user_id)
+            if user is not None:
+                return user
+
+        user = db.session.query(User).get(user_id)
+        if user is not None and user_cache is not None:
+            # Detach the user from the session: it outlives this request,
+            # and a commit would expire its attributes.
+            db.session.expunge(user)
+            user_cache.set(user_id, user)
+
+        return user
 
     login_manager.setup_app(app)
 
     app.es_search, app.es_log = _check_es_config(app.config)
+    app.metrics = Metrics(buckets=app.config['METRICS_BUCKETS'],
+                          worker_label=app.config['METRICS_WORKER_LABEL'])\
+        if app.config['METRICS_ENABLED'] else None
+    app.search_cache = make_cache(app.config)
+    app.user_cache = LocalCache(app.config['USER_CACHE_SIZE'],
+                                app.config['USER_CACHE_TTL'])\
+        if app.config['USER_CACHE_TTL'] else None
+    app.search_flight = SingleFlight() if app.config['SEARCH_SINGLE_FLIGHT']\
+        else None
+
+    app.usage_log = None
+    if app.es_log is not None and app.config['USAGE_LOG_ASYNC']:
+        app.usage_log = UsageLogQueue(
+            app.es_log,
+            batch_size=app.config['USAGE_LOG_BATCH_SIZE'],
+            flush_interval=app.config['USAGE_LOG_FLUSH_INTERVAL'],
+            max_queued=app.config['USAGE_LOG_MAX_QUEUED'],
+            journal_path=app.config['USAGE_LOG_JOURNAL_PATH'],
+            metrics=app.metrics)
+
+    app.slow_query_log = make_slow_query_log(app.config, app.es_log,
+                                             app.usage_log)
+
+    app.mail_queue = None
+    if app.config['MAIL_QUEUE_PATH'] is not None:
+        app.mail_queue = MailQueue(
+            app, mail, app.config['MAIL_QUEUE_PATH'],
+            max_attempts=app.config['MAIL_QUEUE_MAX_ATTEMPTS'],
+            retry_delay=app.config['MAIL_QUEUE_RETRY_DELAY'])
+        # Send the messages left by a previous run.
+        app.before_first_request(app.mail_queue.start)
+
+    app.bcrypt_pool = BoundedPool(app.config['BCRYPT_POOL_SIZE'],
+                                  app.config['BCRYPT_POOL_MAX_WAITING'],
+                                  app.config['BCRYPT_POOL_TIMEOUT'])
 
     for bp in DEFAULT_BLUEPRINTS:
         app.register_blueprint(bp)
@@ -56,7 +129,8 @@ def _check_es_config(config):
     # Check whether we have ES_SEARCH_CONFIG and ES_LOG_CONFIG;
     # if not, set them from the deprecated ES_{SEARCH,LOG}_{HOST,PORT}
     # settings;
-    # if successful, return Elasticsearch instances.
+    # if successful, return Elasticsearch instances, with the
+    # ES_CONNECTION_DEFAULTS for the settings these configs don't set.
 
     for estype in ["SEARCH", "LOG"]:
         es_config = "ES_%s_CONFIG" % estype
@@ -72,11 +146,57 @@ def _check_es_config(config):
                 "port": config[port],
             }
 
+    defaults = config.get("ES_CONNECTION_DEFAULTS") or {}
+
     es_log = None
     es_log_config = config["ES_LOG_CONFIG"]
     if es_log_config is not None:
-        es_log = Elasticsearch(es_log_config)
-    return Elasticsearch(**config["ES_SEARCH_CONFIG"]), es_log
+        es_log = Elasticsearch(**dict(defaults, **es_log_config))
+    es_search = Elasticsearch(**dict(defaults, **config["ES_SEARCH_CONFIG"]))
+    return es_search, es_log
+
+
+def warm_up(app):
+    """Opens ES_WARM_UP_CONNECTIONS connections to each node of the search
+    and log clusters, so that the first requests of a new worker process
+    don't have to connect. Call this in each worker, before it accepts
+    requests."""
+    n_connections = app.config['ES_WARM_UP_CONNECTIONS']
+    for es in [app.es_search, app.es_log]:
+        if es is not None and n_connections:
+            _warm_up_connections(es, n_connections)
+
+
+def _warm_up_connections(es, n_connections):
+    # Connections are only kept for reuse once they are returned to the
+    # (urllib3) pool, so hold on to each one until all are open.
+    for connection in es.transport.connection_pool.connections:
+        pool = getattr(connection, 'pool', None)
+        if pool is None:
+            continue
+
+        responses = []
+        try:
+            for _ in range(n_connections):
+                responses.append(pool.urlopen(
+                    'HEAD', connection.url_prefix + '/',
+                    headers=connection.headers, preload_content=False,
+                    release_conn=False))
+        except Exception as e:
+            logger.warning('Warming up connections to %s failed: %s'
+                           % (connection.host, e))
+        finally:
+            for response in responses:
+                response.release_conn()
+
+        logger.info('Opened %d connections to %s'
+                    % (len(responses), connection.host))
+
+
+def _resolve_paths(config):
+    for name in PATH_SETTINGS:
+        if config[name] is not None:
+            config[name] = os.path.join(PROJECT_ROOT, config[name])
 
 
 def _validate(config):
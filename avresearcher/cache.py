@@ -0,0 +1,170 @@
+"""Caching of Elasticsearch responses.
+
+Two backends are available: :class:`LocalCache`, an in-process LRU cache,
+and :class:`RedisCache`, which stores responses in a store shared by all
+workers. Both expire entries after a fixed number of seconds and keep
+hit/miss counters. :class:`LocalCache` also caches the logged in users.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+__all__ = ['LocalCache', 'RedisCache', 'cache_key', 'make_cache']
+
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(kind, index, body):
+    """Returns a cache key for an ES request.
+
+    :param kind: the type of request ('search', 'count', ...).
+    :param index: the actual (ES) index name.
+    :param body: the request body, as produced by ``_payload_to_es``.
+
+    The body is serialized with sorted keys, so payloads that differ only
+    in key order share a key.
+    """
+    canonical = json.dumps([kind, index, body], sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha1(canonical).hexdigest()
+
+
+class BaseCache(object):
+    """Common bookkeeping for the cache backends.
+
+    Subclasses implement ``_get``, which returns None for a miss, ``_set``
+    and ``_delete``.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LocalCache(BaseCache):
+    """In-process cache with LRU eviction.
+
+    :param max_size: maximum number of entries.
+    :param ttl: number of seconds an entry stays valid.
+    :param timer: function that returns the current time in seconds.
+    """
+
+    def __init__(self, max_size, ttl, timer=time.time):
+        super(LocalCache, self).__init__(ttl)
+        self.max_size = max_size
+        self._timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires <= self._timer():
+                return None
+
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = self._timer() + self.ttl, value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisCache(BaseCache):
+    """Cache stored in Redis, shared by all worker processes.
+
+    :param client: a ``redis.StrictRedis`` instance, or any object with
+                   compatible ``get(key)``, ``set(key, value, ex=ttl)`` and
+                   ``delete(key)`` methods.
+    :param ttl: number of seconds an entry stays valid.
+    :param prefix: string prepended to all keys.
+
+    Errors talking to Redis are logged and treated as cache misses, so an
+    unavailable cache never takes searching down with it.
+    """
+
+    def __init__(self, client, ttl, prefix='avresearcher:'):
+        super(RedisCache, self).__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+
+    def _get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning('Cache lookup failed: %s' % e)
+            return None
+
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def _set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        except Exception as e:
+            logger.warning('Cache store failed: %s' % e)
+
+    def _delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            logger.warning('Cache delete failed: %s' % e)
+
+
+def make_cache(config):
+    """Returns the cache configured by the SEARCH_CACHE_* settings, or None
+    if caching is disabled."""
+    backend = config.get('SEARCH_CACHE_BACKEND')
+    ttl = config.get('SEARCH_CACHE_TTL', 300)
+
+    if backend is None:
+        return None
+    elif backend == 'local':
+        return LocalCache(config.get('SEARCH_CACHE_SIZE', 1000), ttl)
+    elif backend == 'redis':
+        import redis
+        client = redis.StrictRedis.from_url(config['SEARCH_CACHE_REDIS_URL'])
+        return RedisCache(client, ttl)
+    else:
+        raise ValueError("unknown SEARCH_CACHE_BACKEND %r" % backend)
@@ -0,0 +1,41 @@
+"""gzip/deflate compression of responses, negotiated with Accept-Encoding."""
+import zlib
+
+
+__all__ = ['accepted_encoding', 'compress']
+
+
+# Preferred encoding first
+ENCODINGS = ['gzip', 'deflate']
+
+
+def accepted_encoding(accept_encoding):
+    """Returns the encoding (from ENCODINGS) to use for a request with the
+    given Accept-Encoding header, or None."""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.
+        accepted[coding.strip().lower()] = q
+
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.)) > 0:
+            return encoding
+
+    return None
+
+
+def compress(data, encoding, level=6):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    # 'deflate' is the zlib format (RFC 2616), not raw deflate.
+    return zlib.compress(data, level)
@@ -0,0 +1,118 @@
+"""Streaming export of the documents that match a query.
+
+The hits are fetched with a scroll and written to the response as they
+arrive, so the number of exported rows does not affect the memory use of
+the worker.
+"""
+import csv
+import json
+import zlib
+from cStringIO import StringIO
+
+from elasticsearch.exceptions import TransportError
+from toolz import get_in
+
+
+__all__ = ['scroll_hits', 'hit_rows', 'csv_chunks', 'ndjson_chunks',
+           'gzip_chunks']
+
+
+def scroll_hits(es, index, body, scroll='5m', size=500, max_hits=None):
+    """Returns a generator of pages (lists) of the hits that match the
+    query in ``body``, max. ``max_hits`` hits in total.
+
+    Uses a scan, so hits are not sorted. The scan is started before this
+    returns, so that errors in the query are raised here rather than while
+    the hits are streamed. The scroll is cleared when the generator is
+    closed before all hits are read.
+    """
+    resp = es.search(index=index, body=body, search_type='scan',
+                     scroll=scroll, size=size)
+    return _scroll(es, resp['_scroll_id'], scroll, max_hits)
+
+
+def _scroll(es, scroll_id, scroll, max_hits):
+    n_hits = 0
+    exhausted = False
+    try:
+        while max_hits is None or n_hits < max_hits:
+            resp = es.scroll(scroll_id, scroll=scroll)
+            scroll_id = resp['_scroll_id']
+
+            hits = resp['hits']['hits']
+            if not hits:
+                exhausted = True
+                return
+
+            if max_hits is not None:
+                hits = hits[:max_hits - n_hits]
+            n_hits += len(hits)
+            yield hits
+    finally:
+        # Free the search context on ES, rather than wait for it to expire.
+        if not exhausted:
+            try:
+                es.clear_scroll(scroll_id=scroll_id)
+            except TransportError:
+                pass   # The search context expires anyway.
+
+
+def hit_rows(hits, fields):
+    """Yields a row per hit with the values of the fields, given as
+    (column name, field name) pairs. The field name '_id' is the id of the
+    document; multi-valued fields are joined by '; '."""
+    for hit in hits:
+        row = []
+        for _, field in fields:
+            if field == '_id':
+                value = hit['_id']
+            else:
+                value = get_in(field.split('.'), hit.get('_source', {}))
+
+            if isinstance(value, list):
+                value = u'; '.join(unicode(v) for v in value)
+            elif value is None:
+                value = u''
+            row.append(unicode(value))
+
+        yield row
+
+
+def csv_chunks(pages, fields):
+    """Yields (UTF-8 encoded) CSV data, a header and a chunk per page of
+    hits."""
+    buf = StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+
+    writer.writerow([column for column, _ in fields])
+    for hits in pages:
+        for row in hit_rows(hits, fields):
+            writer.writerow([value.encode('utf-8') for value in row])
+
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    # The header only, if there were no hits.
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def ndjson_chunks(pages, fields):
+    """Yields a JSON object per hit, one per line, in a chunk per page of
+    hits."""
+    columns = [column for column, _ in fields]
+    for hits in pages:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n'
+                      for row in hit_rows(hits, fields))
+
+
+def gzip_chunks(chunks, level=6):
+    """Compresses a stream of chunks into a gzip stream."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
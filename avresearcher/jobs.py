@@ -0,0 +1,317 @@
+"""Background jobs: outgoing email and password hashing.
+
+:class:`MailQueue` sends email from a background thread, so that requests
+don't wait for the SMTP server. Messages are spooled to a local directory
+(one JSON file per message) before they are sent, so they survive restarts,
+and sending is retried with an increasing delay when it fails.
+
+:class:`BoundedPool` runs CPU-heavy calls (bcrypt) on a fixed number of
+threads, so that a burst of registrations or logins can't occupy all
+workers; calls that can't be queued fail with :class:`PoolBusy`.
+
+:class:`LocalSMTPServer` is an SMTP stand-in for testing, which keeps the
+messages it receives.
+"""
+import asyncore
+import atexit
+import json
+import logging
+import os
+import smtpd
+import threading
+import time
+import uuid
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from flask.ext.mail import Message
+
+
+__all__ = ['MailQueue', 'BoundedPool', 'PoolBusy', 'LocalSMTPServer']
+
+
+logger = logging.getLogger(__name__)
+
+
+# The Message attributes that are stored in the spool
+MESSAGE_FIELDS = ['subject', 'sender', 'recipients', 'body', 'html', 'cc',
+                  'bcc', 'reply_to']
+
+
+class MailQueue(object):
+    """Sends email through Flask-Mail from a background thread.
+
+    :param app: the Flask application, whose mail settings are used.
+    :param mail: the :class:`flask.ext.mail.Mail` extension.
+    :param spool_path: directory that holds the messages that were not sent
+                       yet; messages that failed ``max_attempts`` times are
+                       moved to its 'failed' subdirectory.
+    :param max_attempts: max. number of times a message is sent.
+    :param retry_delay: number of seconds before the first retry; the delay
+                        doubles with each further attempt.
+    :param poll_interval: max. number of seconds between checks of the
+                          spool, for messages that are due to be retried
+                          or were spooled by another process.
+    """
+
+    def __init__(self, app, mail, spool_path, max_attempts=5, retry_delay=60,
+                 poll_interval=10):
+        self.app = app
+        self.mail = mail
+        self.spool_path = spool_path
+        self.failed_path = os.path.join(spool_path, 'failed')
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._worker_lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+
+        atexit.register(self.close)
+
+    def send(self, message):
+        """Spools a :class:`flask.ext.mail.Message`, to be sent in the
+        background."""
+        entry = {'message': dict((field, getattr(message, field))
+                                 for field in MESSAGE_FIELDS),
+                 'attempts': 0, 'next_attempt': 0}
+        self._ensure_worker()
+        self._write('%.6f-%s.json' % (time.time(), uuid.uuid4().hex), entry)
+        self._wakeup.set()
+
+    def start(self):
+        """Starts the background thread in this process (if it isn't
+        running), which sends the messages left in the spool."""
+        self._ensure_worker()
+
+    def close(self):
+        """Stops the background thread. Messages that were not sent stay in
+        the spool."""
+        self._closed.set()
+        self._wakeup.set()
+        if self._worker is not None and self._worker_pid == os.getpid():
+            self._worker.join()
+
+    def pending(self):
+        """Returns the file names of the spooled messages, oldest first."""
+        return sorted(name for name in os.listdir(self.spool_path)
+                      if name.endswith('.json'))
+
+    def _ensure_worker(self):
+        # The queue may have been created before the WSGI server forked its
+        # workers, so (re)start the thread in the process that uses it.
+        if self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+
+        with self._worker_lock:
+            if self._worker_pid != os.getpid() or not self._worker.is_alive():
+                for path in [self.spool_path, self.failed_path]:
+                    if not os.path.isdir(path):
+                        try:
+                            os.makedirs(path)
+                        except OSError:
+                            # Another process may have created it first.
+                            if not os.path.isdir(path):
+                                raise
+
+                self._recover()
+                self._worker = threading.Thread(target=self._run,
+                                                name='mail-queue')
+                self._worker.daemon = True
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._send_due()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _send_due(self):
+        """Sends the spooled messages that are due."""
+        for name in self.pending():
+            if self._closed.is_set():
+                return
+
+            # Claim the message, so that no other process sends it.
+            claimed = '%s.%d.sending' % (name, os.getpid())
+            try:
+                os.rename(os.path.join(self.spool_path, name),
+                          os.path.join(self.spool_path, claimed))
+            except OSError:
+                continue
+
+            with open(os.path.join(self.spool_path, claimed)) as f:
+                entry = json.load(f)
+
+            if entry['next_attempt'] > time.time():
+                self._release(claimed, name)
+            elif self._deliver(entry['message']):
+                os.remove(os.path.join(self.spool_path, claimed))
+            else:
+                entry['attempts'] += 1
+                if entry['attempts'] >= self.max_attempts:
+                    logger.error('Giving up on sending email to %s after %d'
+                                 ' attempts' % (entry['message']['recipients'],
+                                                entry['attempts']))
+                    os.rename(os.path.join(self.spool_path, claimed),
+                              os.path.join(self.failed_path, name))
+                else:
+                    entry['next_attempt'] = time.time() + self.retry_delay\
+                        * 2 ** (entry['attempts'] - 1)
+                    self._write(name, entry)
+                    os.remove(os.path.join(self.spool_path, claimed))
+
+    def _deliver(self, fields):
+        """Sends a message. Returns False if that failed."""
+        fields = dict(fields)
+        if isinstance(fields['sender'], list):
+            fields['sender'] = tuple(fields['sender'])
+
+        try:
+            with self.app.app_context():
+                self.mail.send(Message(**fields))
+        except Exception as e:
+            logger.warning('Sending email to %s failed: %s'
+                           % (fields['recipients'], e))
+            return False
+
+        return True
+
+    def _write(self, name, entry):
+        tmp_path = os.path.join(self.spool_path, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, os.path.join(self.spool_path, name))
+
+    def _release(self, claimed, name):
+        os.rename(os.path.join(self.spool_path, claimed),
+                  os.path.join(self.spool_path, name))
+
+    def _recover(self):
+        # Returns the messages claimed by processes that no longer exist
+        # (e.g. that were killed while sending) to the spool.
+        for claimed in os.listdir(self.spool_path):
+            if not claimed.endswith('.sending'):
+                continue
+
+            name, pid, _ = claimed.rsplit('.', 2)
+            try:
+                os.kill(int(pid), 0)
+            except OSError:
+                try:
+                    self._release(claimed, name)
+                except OSError:
+                    pass
+
+
+class PoolBusy(Exception):
+    """Raised when a :class:`BoundedPool` can't take more calls."""
+
+
+class BoundedPool(object):
+    """Runs calls on ``size`` threads, with at most ``max_waiting`` calls
+    waiting for a thread.
+
+    When gevent has patched the threading module (``manage.py serve
+    --gevent``), the calls run on a gevent thread pool: these are real
+    threads, so the calls don't block the greenlets of the other requests.
+
+    :param timeout: max. number of seconds a caller waits for the result.
+    """
+
+    def __init__(self, size, max_waiting, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size + max_waiting)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._timeouts = (TimeoutError,)
+
+    def apply(self, func, *args):
+        """Returns ``func(*args)``, computed on one of the pool's threads.
+        Raises :class:`PoolBusy` when the pool is full, or when the result
+        takes longer than ``timeout``."""
+        if not self._slots.acquire(False):
+            raise PoolBusy()
+
+        try:
+            pool = self._get_pool()
+            return pool.apply_async(func, args).get(timeout=self.timeout)
+        except self._timeouts:
+            raise PoolBusy()
+        finally:
+            self._slots.release()
+
+    def _get_pool(self):
+        # Threads don't survive a fork, so each process gets its own pool.
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                if _gevent_patched():
+                    from gevent import Timeout
+                    from gevent.threadpool import ThreadPool as OSThreadPool
+                    self._pool = OSThreadPool(self.size)
+                    self._timeouts = (TimeoutError, Timeout)
+                else:
+                    self._pool = ThreadPool(self.size)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+
+def _gevent_patched():
+    # Whether gevent replaced the threading module by greenlets.
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """An SMTP server that keeps the messages it receives in ``messages``,
+    as (sender, recipients, data) triples, instead of delivering them.
+
+    :param port: port to listen on; 0 picks a free port.
+    :param echo: whether to print each message.
+    """
+
+    def __init__(self, host='localhost', port=0, echo=False):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.echo = echo
+        self.messages = []
+        self._thread = None
+        self._running = False
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+        if self.echo:
+            print '---------- Message from %s to %s' % (mailfrom,
+                                                        ', '.join(rcpttos))
+            print data
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            asyncore.loop(timeout=.1, count=1)
+
+    def start(self):
+        """Serves in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='local-smtp')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.close()
@@ -0,0 +1,128 @@
+"""Latency histograms, exposed in the Prometheus text format.
+
+Metrics are kept per process; with several WSGI workers, each worker
+reports its own numbers, labeled with its pid (see ``worker_label``), so
+they can be summed across workers.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+__all__ = ['Metrics']
+
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """A registry of histograms and gauges, identified by a name and a set
+    of labels.
+
+    :param prefix: prefix of all metric names.
+    :param buckets: upper bounds of the histogram buckets.
+    :param worker_label: if not None, the name of a label with the pid of
+        the process that is added to all metrics.
+    """
+
+    def __init__(self, prefix='avresearcher_', buckets=DEFAULT_BUCKETS,
+                 worker_label=None):
+        self.prefix = prefix
+        self.buckets = sorted(buckets)
+        self.worker_label = worker_label
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """Adds a value (e.g. a duration in seconds) to a histogram."""
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Records the duration of the with block in a histogram."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        # The pid is read when rendering, as the registry may be created
+        # before the WSGI server forks its workers.
+        worker = ((self.worker_label, os.getpid()),)\
+            if self.worker_label is not None else ()
+
+        lines = []
+        with self._lock:
+            for name, metrics in _by_name(self._histograms):
+                name = self.prefix + name
+                lines.append('# TYPE %s histogram' % name)
+                for labels, histogram in metrics:
+                    labels = tuple(sorted(labels + worker))
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels + (('le', repr(bound)),)),
+                            count))
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels + (('le', '+Inf'),)),
+                        histogram.count))
+                    lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                                                  histogram.sum))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), histogram.count))
+
+            for name, metrics in _by_name(self._gauges):
+                name = self.prefix + name
+                lines.append('# TYPE %s gauge' % name)
+                for labels, value in metrics:
+                    labels = tuple(sorted(labels + worker))
+                    lines.append('%s%s %r' % (name, _format_labels(labels),
+                                              value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _by_name(metrics):
+    # Groups {(name, labels): metric} by name, sorted.
+    grouped = {}
+    for (name, labels), metric in metrics.iteritems():
+        grouped.setdefault(name, []).append((labels, metric))
+    return sorted((name, sorted(group)) for name, group in grouped.iteritems())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', r'\\')
+                                                  .replace('"', r'\"'))
+                             for k, v in labels)
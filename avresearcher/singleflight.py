@@ -0,0 +1,57 @@
+"""Coalescing of concurrent identical requests ("single-flight").
+
+When several threads ask for the same key at the same time, only the first
+one performs the actual call; the others wait for it and share its result.
+"""
+import sys
+import threading
+
+
+__all__ = ['SingleFlight']
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Tracks the calls that are in flight within a process.
+
+    Results are only shared between calls that overlap in time; nothing is
+    kept once a call has finished (that is what the cache is for).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Returns ``fn()``, or the result of the call to the function
+        that is already in flight for ``key``. Exceptions are raised in all
+        waiting threads."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
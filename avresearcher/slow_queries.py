@@ -0,0 +1,94 @@
+"""Log of slow Elasticsearch requests.
+
+Requests that take longer than a threshold are recorded, with their
+payload, so that they can be reproduced. Entries are written as JSON lines
+to a file, or to the log index.
+"""
+import json
+import logging
+from logging.handlers import WatchedFileHandler
+
+
+__all__ = ['FileSlowQueryLog', 'ESSlowQueryLog', 'make_slow_query_log']
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryLog(object):
+    """Records requests slower than ``threshold`` seconds.
+
+    Subclasses implement ``record``, which writes an entry (a dict).
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def is_slow(self, seconds, took=None):
+        """Whether a request is slow, given its round-trip time and the
+        'took' (in ms) that ES reported."""
+        return seconds >= self.threshold \
+            or (took is not None and took / 1000. >= self.threshold)
+
+
+class FileSlowQueryLog(SlowQueryLog):
+    """Appends entries to a file.
+
+    All worker processes append to the same file, so it is not rotated
+    here (the processes would rotate it at the same time); rotate it with
+    e.g. logrotate instead. The file is reopened when it was moved.
+    """
+
+    def __init__(self, threshold, path):
+        super(FileSlowQueryLog, self).__init__(threshold)
+        self._handler = WatchedFileHandler(path)
+
+    def record(self, entry):
+        self._handler.handle(logging.makeLogRecord(
+            {'msg': json.dumps(entry, sort_keys=True)}))
+
+
+class ESSlowQueryLog(SlowQueryLog):
+    """Indexes entries (as type 'slow_query') in the log index, through the
+    :class:`usage_log.UsageLogQueue`, so that slow requests don't wait for
+    another ES request."""
+
+    def __init__(self, threshold, index, usage_log):
+        super(ESSlowQueryLog, self).__init__(threshold)
+        self.index = index
+        self.usage_log = usage_log
+
+    def record(self, entry):
+        action = dict(entry, _op_type='create', _index=self.index,
+                      _type='slow_query')
+        self.usage_log.put([action])
+
+
+def make_slow_query_log(config, es_log=None, usage_log=None):
+    """Returns the slow query log configured by the SLOW_QUERY_* settings,
+    or None if it is disabled.
+
+    Entries are only sent to ES through the usage log queue; without it
+    (USAGE_LOG_ASYNC is False), they are written to SLOW_QUERY_LOG_PATH.
+    """
+    destination = config.get('SLOW_QUERY_LOG')
+    threshold = config.get('SLOW_QUERY_THRESHOLD', 1.)
+
+    if destination is None:
+        return None
+    elif destination == 'es':
+        if es_log is None:
+            raise ValueError("SLOW_QUERY_LOG 'es' requires ES_LOG_CONFIG")
+        if usage_log is not None:
+            return ESSlowQueryLog(threshold, config['ES_LOG_INDEX'],
+                                  usage_log)
+
+        logger.warning("SLOW_QUERY_LOG 'es' requires USAGE_LOG_ASYNC; slow"
+                       " queries are written to %s"
+                       % config['SLOW_QUERY_LOG_PATH'])
+        destination = 'file'
+
+    if destination == 'file':
+        return FileSlowQueryLog(threshold, config['SLOW_QUERY_LOG_PATH'])
+
+    raise ValueError("unknown SLOW_QUERY_LOG %r" % destination)
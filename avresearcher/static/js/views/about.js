@@ -21,18 +21,7 @@ function($, _, Backbone, d3, aboutTemplate){
 
             this.model.on('change:stats', this.renderIndexStats, this);
 
-            for (var i = 0; i < ENABLED_COLLECTIONS.length; i++) {
-                var coll = ENABLED_COLLECTIONS[i];
-                this.model.getTotalDocCount(coll);
-                this.model.getFirstLastDocDates(coll);
-            }
-
-            if (_.has(ENABLED_COLLECTIONS, 'immix')) {
-                this.model.getImmixDocsWithSubtitleCount();
-            }
-            if (_.has(ENABLED_COLLECTIONS, 'kb')) {
-                this.model.getKbDocsByTypeCount();
-            }
+            this.model.getCollectionStats();
         },
 
         render: function(){
@@ -107,6 +107,7 @@ function($, _, Backbone, d3, app, ResultsModal, exportTemplate) {
             });
 
             this.current_interval = (selected_interval_size === null) ? 'year' : selected_interval_size;
+            this.updateExport();
         },
 
         render: function() {
@@ -127,11 +128,17 @@ function($, _, Backbone, d3, app, ResultsModal, exportTemplate) {
         updateExport: function() {
             var exportForm = this.$el.find('.export');
             var payload = [];
+            var hitsPayloads = [];
             _.each(this.options.models, function(model, name) {
                 payload.push(model.constructExportPayload());
+                if (model.get('ftQuery')) {
+                    hitsPayloads.push(model.constructBasicQuery());
+                }
             });
             exportForm.html(_.template(exportTemplate)({
-                payload: JSON.stringify(payload)
+                payload: JSON.stringify(payload),
+                interval: this.current_interval || 'year',
+                hitsPayloads: hitsPayloads
             }));
         },
 
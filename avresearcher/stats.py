@@ -0,0 +1,128 @@
+"""Collection statistics, as shown on the 'about' page.
+
+Computing the statistics takes an aggregation query per collection, so
+they are stored in a JSON snapshot (COLLECTION_STATS_PATH) that is only
+recomputed when it is missing or has expired. An expired snapshot is
+recomputed by one request (per process), while the others are served the
+expired snapshot.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+
+__all__ = ['compute_collection_stats', 'invalidate_collection_stats',
+           'load_collection_stats', 'save_collection_stats']
+
+
+def compute_collection_stats(es, config):
+    """Returns a snapshot of the statistics of all enabled collections.
+
+    For each collection, the snapshot contains the total number of documents
+    (``total_docs``), the DATE_STATS_AGGREGATION results
+    (``publication_date_stats``) and the results of the collection's
+    ``stats_aggregations``. Filter aggregations are reduced to their
+    document count, bucket aggregations to their buckets.
+    """
+    collections_config = config['COLLECTIONS_CONFIG']
+    date_stats_aggr = config['DATE_STATS_AGGREGATION']
+
+    collections = {}
+    for coll in config['ENABLED_COLLECTIONS']:
+        coll_config = collections_config[coll]
+
+        aggs = dict(coll_config.get('stats_aggregations', {}))
+        aggs['publication_date_stats'] =\
+            coll_config['available_aggregations'][date_stats_aggr]
+
+        results = es.search(index=coll_config['index_name'],
+                            body={'query': {'match_all': {}}, 'aggs': aggs,
+                                  'size': 0})
+
+        stats = {'total_docs': results['hits']['total']}
+        for name, result in results['aggregations'].iteritems():
+            if 'buckets' in result:
+                result = result['buckets']
+            elif 'doc_count' in result:
+                result = result['doc_count']
+            stats[name] = result
+
+        collections[coll] = stats
+
+    return {
+        'computed_on': datetime.utcnow().isoformat(),
+        'collections': collections
+    }
+
+
+def save_collection_stats(snapshot, path):
+    """Writes the snapshot to ``path``, replacing it atomically so that
+    readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f)
+    # mkstemp makes the file readable by its owner only.
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+
+    return snapshot
+
+
+# Held by the thread that recomputes the snapshot
+_refresh_lock = threading.Lock()
+
+
+def load_collection_stats(es, config):
+    """Returns the stored snapshot, recomputing it first if it is missing or
+    older than COLLECTION_STATS_MAX_AGE.
+
+    Only one thread at a time recomputes the snapshot; meanwhile, the other
+    threads get the expired snapshot, or wait if there is none.
+    """
+    path = config['COLLECTION_STATS_PATH']
+    max_age = config['COLLECTION_STATS_MAX_AGE']
+
+    snapshot, expired = _read_collection_stats(path, max_age)
+    if not expired:
+        return snapshot
+
+    if not _refresh_lock.acquire(snapshot is None):
+        return snapshot
+
+    try:
+        # Another thread may have saved it while this one was waiting.
+        snapshot, expired = _read_collection_stats(path, max_age)
+        if not expired:
+            return snapshot
+
+        return save_collection_stats(compute_collection_stats(es, config),
+                                     path)
+    finally:
+        _refresh_lock.release()
+
+
+def _read_collection_stats(path, max_age):
+    # Returns (snapshot, whether it has expired); the snapshot is None if
+    # there is none.
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, OSError):
+        return None, True
+
+    return snapshot, max_age is not None and age > max_age
+
+
+def invalidate_collection_stats(path):
+    """Removes the stored snapshot, e.g. after (re)indexing a collection,
+    so that it is recomputed on the next request."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,8 +1,17 @@
-from avresearcher.app import _check_es_config, _validate
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from avresearcher.app import (PROJECT_ROOT, _check_es_config, _validate,
+                              _warm_up_connections, create_app)
+from avresearcher.extensions import db, login_manager
+from avresearcher.models import User
 from copy import deepcopy
 from elasticsearch import Elasticsearch
 
-from nose.tools import assert_equal, assert_in, assert_raises, assert_true
+from nose.tools import (assert_equal, assert_in, assert_is, assert_raises,
+                        assert_true)
 
 
 config = {
@@ -45,6 +54,13 @@ def test_check_es_config():
     assert_true(isinstance(es_search, Elasticsearch))
     assert_equal(es_log, None)
 
+    # ES_CONNECTION_DEFAULTS apply unless the config sets them.
+    c["ES_CONNECTION_DEFAULTS"] = {"timeout": 3, "max_retries": 1}
+    c["ES_SEARCH_CONFIG"]["timeout"] = 5
+    es_search, es_log = _check_es_config(c)
+    assert_equal(es_search.transport.max_retries, 1)
+    assert_equal(es_search.transport.connection_pool.connections[0].timeout, 5)
+
 
 def test_validate():
     _validate(config)
@@ -64,3 +80,93 @@ def test_validate():
     c = deepcopy(config)
     c["COLLECTIONS_CONFIG"]["index1"]["enabled_search_fields"] += "field3"
     assert_raises(ValueError, _validate, c)
+
+
+class UserCacheSettings(object):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'test'
+    TESTING = True
+    ES_SEARCH_CONFIG = {'hosts': ['localhost']}
+    ES_LOG_CONFIG = None
+    SLOW_QUERY_LOG = None
+    MAIL_QUEUE_PATH = None
+    MAIL_ACCOUNT_APPROVAL_ADDRESS = 'admin@example.org'
+
+
+def test_paths():
+    app = create_app(settings_override=UserCacheSettings)
+    # Relative to the project root, not to the working directory.
+    assert_equal(app.config['COLLECTION_STATS_PATH'],
+                 os.path.join(PROJECT_ROOT, 'collection_stats.json'))
+    assert_equal(app.config['MAIL_QUEUE_PATH'], None)
+
+
+def test_user_cache():
+    app = create_app(settings_override=UserCacheSettings)
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(email='user@example.org', password='x',
+                            name='User', email_verification_token='verify',
+                            approval_token='approve', email_verified=True))
+        db.session.commit()
+
+        user = login_manager.user_callback(u'1')
+        assert_equal(user.name, 'User')
+
+        # Changes are not seen while the user is cached...
+        db.session.query(User).filter_by(id=1).update({'name': 'Changed'})
+        db.session.commit()
+        assert_is(login_manager.user_callback(u'1'), user)
+        assert_equal(user.name, 'User')
+        assert_equal(login_manager.user_callback(u'2'), None)
+
+    # ... unless the user was changed by approve_user (or verify_email).
+    response = app.test_client().get('/approve_user/1/approve')
+    assert_equal(response.status_code, 200)
+    with app.app_context():
+        user = login_manager.user_callback(u'1')
+        assert_equal(user.name, 'Changed')
+        assert_true(user.approved)
+
+        db.drop_all()
+
+
+class CountingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.clients = set()
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.server.clients.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_warm_up_connections():
+    server = CountingServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        es = Elasticsearch(['%s:%d' % server.server_address], maxsize=5)
+        _warm_up_connections(es, 3)
+        assert_equal(len(server.clients), 3)
+
+        # The warmed up connections are reused.
+        es.ping()
+        es.ping()
+        assert_equal(len(server.clients), 3)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,139 @@
+from avresearcher.cache import LocalCache, RedisCache, cache_key
+from avresearcher.views import _cached_msearch, _split_msearch
+from flask import Flask
+
+from nose.tools import assert_equal, assert_not_equal
+
+
+class FakeRedis(object):
+    # Stand-in for redis.StrictRedis; ignores expiry.
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeES(object):
+    def __init__(self):
+        self.bodies = []
+
+    def msearch(self, body):
+        self.bodies.append(body)
+        return {'responses': [{'took': 1, 'query': q} for q in body[1::2]]}
+
+
+def test_cache_key():
+    q1 = {'query': {'match_all': {}}, 'size': 0, 'from': 10}
+    q2 = {'from': 10, 'size': 0, 'query': {'match_all': {}}}
+
+    assert_equal(cache_key('search', 'idx', q1), cache_key('search', 'idx', q2))
+    assert_not_equal(cache_key('search', 'idx', q1),
+                     cache_key('search', 'other_idx', q1))
+    assert_not_equal(cache_key('search', 'idx', q1),
+                     cache_key('count', 'idx', q1))
+
+
+def test_local_cache():
+    now = [0]
+    cache = LocalCache(max_size=2, ttl=10, timer=lambda: now[0])
+
+    assert_equal(cache.get('a'), None)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert_equal(cache.get('a'), 1)
+
+    # 'b' is least recently used, so it is evicted first.
+    cache.set('c', 3)
+    assert_equal(len(cache), 2)
+    assert_equal(cache.get('b'), None)
+    assert_equal(cache.get('a'), 1)
+
+    cache.delete('c')
+    assert_equal(len(cache), 1)
+
+    now[0] = 10
+    assert_equal(cache.get('a'), None)
+    assert_equal(cache.stats(), {'hits': 2, 'misses': 3})
+
+
+def test_redis_cache():
+    client = FakeRedis()
+    cache = RedisCache(client, ttl=10)
+    other_worker = RedisCache(client, ttl=10)
+
+    cache.set('a', {'hits': {'total': 3}})
+    assert_equal(other_worker.get('a'), {'hits': {'total': 3}})
+    assert_equal(other_worker.get('b'), None)
+    assert_equal(other_worker.stats(), {'hits': 1, 'misses': 1})
+
+    cache.delete('a')
+    assert_equal(other_worker.get('a'), None)
+
+
+def test_cached_msearch():
+    app = Flask(__name__)
+    app.es_search = FakeES()
+    app.search_cache = LocalCache(max_size=10, ttl=10)
+    app.search_flight = None
+    app.metrics = None
+    app.slow_query_log = None
+
+    q1 = ('idx', {'size': 0})
+    q2 = ('idx', {'size': 10})
+
+    with app.app_context():
+        r1 = _cached_msearch([q1])
+        r2 = _cached_msearch([q1, q2])
+
+    assert_equal(r2['responses'][0], r1['responses'][0])
+    assert_equal(r2['responses'][1]['query'], {'size': 10})
+    # Only the query that missed the cache is sent the second time.
+    assert_equal(app.es_search.bodies[1], [{'index': 'idx'}, {'size': 10}])
+
+    # Identical queries within one msearch are sent once.
+    app.search_cache = None
+    with app.app_context():
+        r3 = _cached_msearch([q2, q1, q2])
+
+    assert_equal(len(r3['responses']), 3)
+    assert_equal(r3['responses'][0], r3['responses'][2])
+    assert_equal(r3['responses'][1]['query'], {'size': 0})
+    assert_equal(app.es_search.bodies[2], [{'index': 'idx'}, {'size': 10},
+                                           {'index': 'idx'}, {'size': 0}])
+
+
+def test_split_msearch():
+    app = Flask(__name__)
+    app.es_search = FakeES()
+    app.search_cache = LocalCache(max_size=10, ttl=10)
+    app.search_flight = None
+    app.metrics = None
+    app.slow_query_log = None
+
+    aggs = {'dates': {'date_histogram': {'field': 'date'}}}
+    page1 = ('idx', {'query': {'match_all': {}}, 'aggs': aggs, 'size': 10})
+    page2 = ('idx', {'query': {'match_all': {}}, 'aggs': aggs, 'size': 10,
+                     'from': 10})
+
+    with app.app_context():
+        r1 = _split_msearch([page1])['responses'][0]
+        r2 = _split_msearch([page2])['responses'][0]
+
+    # The hits and the aggregations are fetched in one msearch...
+    assert_equal(app.es_search.bodies[0], [
+        {'index': 'idx'}, {'query': {'match_all': {}}, 'size': 10},
+        {'index': 'idx'}, {'query': {'match_all': {}}, 'aggs': aggs,
+                           'size': 0}])
+    assert_equal(r1['query'], {'query': {'match_all': {}}, 'size': 10})
+    # ... and turning the page only fetches the hits again.
+    assert_equal(app.es_search.bodies[1], [
+        {'index': 'idx'}, {'query': {'match_all': {}}, 'size': 10,
+                           'from': 10}])
+    assert_equal(r2['query']['from'], 10)
@@ -0,0 +1,21 @@
+import zlib
+
+from avresearcher.compression import accepted_encoding, compress
+
+from nose.tools import assert_equal
+
+
+def test_accepted_encoding():
+    assert_equal(accepted_encoding('gzip, deflate'), 'gzip')
+    assert_equal(accepted_encoding('deflate'), 'deflate')
+    assert_equal(accepted_encoding('gzip;q=0, deflate;q=0.5'), 'deflate')
+    assert_equal(accepted_encoding('*'), 'gzip')
+    assert_equal(accepted_encoding('identity'), None)
+    assert_equal(accepted_encoding(''), None)
+
+
+def test_compress():
+    data = '{"hits": []}' * 100
+    assert_equal(zlib.decompress(compress(data, 'gzip'), 16 + zlib.MAX_WBITS),
+                 data)
+    assert_equal(zlib.decompress(compress(data, 'deflate')), data)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+
+from avresearcher.export import (csv_chunks, gzip_chunks, ndjson_chunks,
+                                 scroll_hits)
+
+from nose.tools import assert_equal
+
+
+fields = [('id', '_id'), ('title', 'title'), ('publication', 'meta.pub')]
+
+
+def make_hit(i):
+    return {'_id': str(i),
+            '_source': {'title': u'Krant %d é' % i,
+                        'meta': {'pub': ['a', 'b'] if i % 2 else None}}}
+
+
+class FakeES(object):
+    # Returns pages of two hits; scroll ids are page numbers.
+    def __init__(self, n_hits):
+        self.hits = [make_hit(i) for i in range(n_hits)]
+        self.cleared = []
+
+    def search(self, index, body, search_type, scroll, size):
+        assert_equal(search_type, 'scan')
+        return {'_scroll_id': '0'}
+
+    def scroll(self, scroll_id, scroll):
+        page = int(scroll_id)
+        return {'_scroll_id': str(page + 1),
+                'hits': {'hits': self.hits[page * 2:page * 2 + 2]}}
+
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+
+def test_scroll_hits():
+    es = FakeES(5)
+    pages = list(scroll_hits(es, 'idx', {}))
+    assert_equal([len(page) for page in pages], [2, 2, 1])
+    assert_equal(es.cleared, [])
+
+    # Stopping early clears the scroll.
+    pages = list(scroll_hits(es, 'idx', {}, max_hits=3))
+    assert_equal([len(page) for page in pages], [2, 1])
+    assert_equal(es.cleared, ['2'])
+
+
+def test_csv_chunks():
+    pages = [[make_hit(0), make_hit(1)], [make_hit(2)]]
+    chunks = list(csv_chunks(iter(pages), fields))
+
+    assert_equal(len(chunks), 2)
+    assert_equal(''.join(chunks).decode('utf-8').splitlines(),
+                 [u'id,title,publication',
+                  u'0,Krant 0 é,',
+                  u'1,Krant 1 é,a; b',
+                  u'2,Krant 2 é,'])
+
+    # Header only
+    assert_equal(list(csv_chunks(iter([]), fields)),
+                 ['id,title,publication\n'])
+
+
+def test_ndjson_chunks():
+    chunks = list(ndjson_chunks(iter([[make_hit(1)]]), fields))
+    assert_equal([json.loads(line) for line in ''.join(chunks).splitlines()],
+                 [{'id': '1', 'title': u'Krant 1 é', 'publication': 'a; b'}])
+
+
+def test_gzip_chunks():
+    data = ''.join(gzip_chunks(iter(['abc\n'] * 1000)))
+    assert_equal(zlib.decompress(data, 16 + zlib.MAX_WBITS), 'abc\n' * 1000)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from avresearcher.jobs import BoundedPool, LocalSMTPServer, MailQueue, PoolBusy
+from flask import Flask
+from flask.ext.mail import Mail, Message
+
+from nose.tools import assert_equal, assert_in, assert_raises, assert_true
+
+
+def make_app(port):
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER='localhost', MAIL_PORT=port)
+    mail = Mail()
+    mail.init_app(app)
+    return app, mail
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(.01)
+    return condition()
+
+
+def test_mail_queue():
+    tmp_dir = tempfile.mkdtemp()
+    server = LocalSMTPServer().start()
+    try:
+        spool_path = os.path.join(tmp_dir, 'spool')
+        msg = Message('Subject', sender=('Sender', 'sender@example.org'),
+                      recipients=['user@example.org'], body='Hello')
+
+        # The SMTP server is down: the message stays in the spool.
+        app, mail = make_app(free_port())
+        queue = MailQueue(app, mail, spool_path, retry_delay=.2,
+                          poll_interval=.01)
+        queue.send(msg)
+        time.sleep(.1)
+        queue.close()
+        assert_equal(len(queue.pending()), 1)
+        assert_equal(server.messages, [])
+
+        # It is retried by the next queue that uses the spool.
+        app, mail = make_app(server.port)
+        queue = MailQueue(app, mail, spool_path, poll_interval=.01)
+        queue.start()
+        assert_true(wait_for(lambda: server.messages))
+        queue.close()
+
+        assert_equal(queue.pending(), [])
+        sender, recipients, data = server.messages[0]
+        assert_equal(sender, 'sender@example.org')
+        assert_equal(recipients, ['user@example.org'])
+        assert_in('Hello', data)
+
+        # Messages that can't be sent end up in the 'failed' directory.
+        app, mail = make_app(free_port())
+        queue = MailQueue(app, mail, spool_path, max_attempts=2,
+                          retry_delay=0, poll_interval=.01)
+        queue.send(msg)
+        assert_true(wait_for(lambda: os.listdir(queue.failed_path)))
+        queue.close()
+        assert_equal(queue.pending(), [])
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def test_bounded_pool():
+    pool = BoundedPool(size=1, max_waiting=0)
+    assert_equal(pool.apply(pow, 2, 3), 8)
+
+    release = threading.Event()
+    busy = threading.Thread(target=pool.apply, args=(release.wait,))
+    busy.start()
+    time.sleep(.05)
+    try:
+        assert_raises(PoolBusy, pool.apply, pow, 2, 3)
+    finally:
+        release.set()
+        busy.join()
+
+    assert_equal(pool.apply(pow, 2, 3), 8)
@@ -0,0 +1,216 @@
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+from avresearcher import settings
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.serializer import JSONSerializer
+
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
+
+# manage.py needs the ES hosts, which are set in local_settings.py.
+if not hasattr(settings, 'ES_SEARCH_CONFIG'):
+    settings.ES_SEARCH_CONFIG = {'hosts': ['localhost']}
+
+import manage
+from manage import chunk_bulk_actions
+
+
+def test_chunk_bulk_actions():
+    def action(n, text='x'):
+        return {'_index': 'idx', '_type': 'item', '_id': n, 'text': text}
+
+    def chunks(actions, chunk_size=2, max_chunk_bytes=1000):
+        return [(offset, len(chunk)) for offset, chunk in
+                chunk_bulk_actions(enumerate(actions), JSONSerializer(),
+                                   chunk_size, max_chunk_bytes)]
+
+    # Chunks of at most chunk_size actions, with the offset of the member
+    # after it; skipped members (None) are counted in the offsets.
+    assert_equal(chunks([action(0), None, action(2), action(3)]),
+                 [(3, 2), (4, 1)])
+    assert_equal(chunks([action(0), None]), [(2, 1)])
+    assert_equal(chunks([None]), [(1, 0)])
+    assert_equal(chunks([]), [])
+
+    # ... and of at most max_chunk_bytes, unless an action is larger.
+    assert_equal(chunks([action(0), action(1, 'x' * 100), action(2)],
+                        chunk_size=10, max_chunk_bytes=120),
+                 [(1, 1), (2, 1), (3, 1)])
+
+    offset, chunk = next(chunk_bulk_actions(enumerate([action(0)]),
+                                            JSONSerializer(), 2, 1000))
+    assert_equal([map(json.loads, lines) for lines in chunk],
+                 [[{'index': {'_index': 'idx', '_type': 'item', '_id': 0}},
+                   {'text': 'x'}]])
+
+
+class BulkES(object):
+    # Stand-in for the ES client of manage.py. Rejects the documents with
+    # an id in ``rejected``. Bulk requests fail as a whole the first
+    # ``down`` times, and always if they have a document with an id of at
+    # least ``down_from``.
+    transport = type('Transport', (), {'serializer': JSONSerializer()})
+
+    def __init__(self, rejected=(), down=0, down_from=None):
+        self.rejected = rejected
+        self.down = down
+        self.down_from = down_from
+        self.indexed = []
+
+    def bulk(self, body):
+        doc_ids = [json.loads(line)['index']['_id']
+                   for line in body.splitlines()[::2]]
+        if self.down or (self.down_from is not None and
+                         max(map(int, doc_ids)) >= self.down_from):
+            self.down = max(self.down - 1, 0)
+            raise ConnectionError('N/A', 'Connection refused', None)
+
+        items = []
+        for doc_id in doc_ids:
+            if doc_id in self.rejected:
+                items.append({'index': {'_id': doc_id, 'status': 400,
+                                        'error': 'MapperParsingException'}})
+            else:
+                self.indexed.append(doc_id)
+                items.append({'index': {'_id': doc_id, 'status': 201}})
+        return {'items': items}
+
+
+def make_immix_archive(path, n_items):
+    with tarfile.open(path, 'w:gz') as tar:
+        for n in range(n_items):
+            # Items without a date are skipped.
+            data = json.dumps({'date': '2000-01-01' if n != 2 else None})
+            info = tarfile.TarInfo('immix/_%d.json' % n)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+
+
+class TestIndexArchive(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, 'immix.tar.gz')
+        make_immix_archive(self.archive, 7)
+        self.checkpoint = os.path.join(self.tmp_dir, 'checkpoint.json')
+        self.dead_letter = os.path.join(self.tmp_dir, 'dead_letter.jsonl')
+
+        self.saved = manage.es, manage.BULK_MAX_RETRIES, \
+            manage.BULK_RETRY_DELAY
+        manage.BULK_MAX_RETRIES = 2
+        manage.BULK_RETRY_DELAY = 0
+
+    def teardown(self):
+        manage.es, manage.BULK_MAX_RETRIES, manage.BULK_RETRY_DELAY = \
+            self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def index(self, start=0, n_threads=1):
+        return manage.index_archive(
+            (self.archive, start), 'avresearcher_immix', chunk_size=2,
+            max_chunk_bytes=2 ** 20, n_threads=n_threads,
+            checkpoint_path=self.checkpoint,
+            dead_letter_path=self.dead_letter)
+
+    def test_dead_letter(self):
+        for n_threads in [1, 3]:
+            manage.es = BulkES(rejected=['4'])
+            # Requests that fail as a whole are retried.
+            manage.es.down = 2
+            assert_equal(self.index(n_threads=n_threads)[1:3], (5, 1))
+            assert_equal(sorted(manage.es.indexed),
+                         ['0', '1', '3', '5', '6'])
+            assert_equal(manage.load_checkpoint(self.checkpoint),
+                         {self.archive: {'done': True}})
+
+        # Only the rejected document is dead-lettered (once per run).
+        with open(self.dead_letter) as f:
+            entries = [json.loads(line) for line in f]
+        assert_equal([(e['archive'], e['error']) for e in entries],
+                     [(self.archive, 'MapperParsingException')] * 2)
+        assert_equal(json.loads(entries[0]['action'][0])['index']['_id'], '4')
+
+    def test_resume(self):
+        for n_threads in [1, 3]:
+            if os.path.exists(self.checkpoint):
+                os.remove(self.checkpoint)
+
+            # The cluster is down after the first chunk.
+            manage.es = BulkES(down_from=2)
+            assert_raises(ConnectionError, self.index, n_threads=n_threads)
+            assert_false(os.path.exists(self.dead_letter))
+
+            # The checkpoint is not after the chunks that were not sent...
+            state = manage.load_checkpoint(self.checkpoint).get(self.archive,
+                                                                {})
+            if n_threads == 1:
+                assert_equal(state, {'members': 3, 'done': False})
+            assert_true(state.get('members', 0) <= 3)
+            indexed = manage.es.indexed
+
+            # ... so that resuming indexes the rest.
+            manage.es = BulkES()
+            self.index(state.get('members', 0), n_threads)
+            assert_equal(sorted(set(indexed + manage.es.indexed)),
+                         ['0', '1', '3', '4', '5', '6'])
+            assert_equal(manage.load_checkpoint(self.checkpoint),
+                         {self.archive: {'done': True}})
+
+
+class SettingsES(object):
+    # Records the calls to the indices API; 'kb_v1' has a refresh interval
+    # of its own, 'kb_v2' the ES defaults.
+    def __init__(self):
+        self.indices = self
+        self.settings = {'kb_v1': {'index.refresh_interval': '30s'},
+                         'kb_v2': {}}
+        self.calls = []
+
+    def get_settings(self, index, flat_settings):
+        return dict((name, {'settings': dict(settings)})
+                    for name, settings in self.settings.iteritems())
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body)
+
+    def optimize(self, index, **params):
+        self.calls.append(('optimize', index, params))
+
+    def refresh(self, index):
+        self.calls.append(('refresh', index))
+
+
+class TestIndexSettings(object):
+    def setup(self):
+        self.saved = manage.es
+        manage.es = SettingsES()
+
+    def teardown(self):
+        manage.es = self.saved
+
+    def assert_restored(self):
+        assert_equal(manage.es.settings, {
+            'kb_v1': {'index.refresh_interval': '30s',
+                      'index.number_of_replicas': 1},
+            'kb_v2': manage.DEFAULT_INDEX_SETTINGS})
+
+    def test_success(self):
+        with manage.index_settings('kb'):
+            assert_equal(manage.es.settings['kb_v1'],
+                         manage.BULK_LOAD_SETTINGS)
+        self.assert_restored()
+        # The merge is not waited for.
+        assert_equal(sorted(manage.es.calls), [
+            ('optimize', 'kb_v1', {'wait_for_merge': False}),
+            ('optimize', 'kb_v2', {'wait_for_merge': False}),
+            ('refresh', 'kb_v1'), ('refresh', 'kb_v2')])
+
+    def test_exception(self):
+        with assert_raises(ValueError):
+            with manage.index_settings('kb'):
+                raise ValueError
+        self.assert_restored()
+        assert_equal(manage.es.calls, [])
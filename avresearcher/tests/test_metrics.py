@@ -0,0 +1,85 @@
+import os
+
+from avresearcher.metrics import Metrics
+from avresearcher.views import _observe_query
+from flask import Flask
+
+from nose.tools import assert_equal, assert_in
+
+
+def test_histogram():
+    metrics = Metrics(buckets=[.1, 1.])
+    metrics.observe('es_seconds', .05, index='kb')
+    metrics.observe('es_seconds', .5, index='kb')
+    metrics.observe('es_seconds', 5., index='kb')
+    metrics.observe('es_seconds', .5, index='immix')
+    metrics.set_gauge('search_cache_hits', 3)
+
+    lines = metrics.render().splitlines()
+    assert_in('# TYPE avresearcher_es_seconds histogram', lines)
+    assert_in('avresearcher_es_seconds_bucket{index="kb",le="0.1"} 1', lines)
+    assert_in('avresearcher_es_seconds_bucket{index="kb",le="1.0"} 2', lines)
+    assert_in('avresearcher_es_seconds_bucket{index="kb",le="+Inf"} 3', lines)
+    assert_in('avresearcher_es_seconds_count{index="kb"} 3', lines)
+    assert_in('avresearcher_es_seconds_sum{index="kb"} 5.55', lines)
+    assert_in('avresearcher_es_seconds_count{index="immix"} 1', lines)
+    assert_in('avresearcher_search_cache_hits 3', lines)
+
+
+def test_time():
+    metrics = Metrics()
+    try:
+        with metrics.time('phase_seconds', phase='decode'):
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert_in('avresearcher_phase_seconds_count{phase="decode"} 1',
+              metrics.render().splitlines())
+
+
+def test_label_escaping():
+    metrics = Metrics(buckets=[])
+    metrics.observe('x', 1, label='a"b\\')
+    assert_equal(metrics.render().splitlines()[1],
+                 'avresearcher_x_bucket{label="a\\"b\\\\",le="+Inf"} 1')
+
+
+def test_observe_query():
+    app = Flask(__name__)
+    app.config['COLLECTIONS_CONFIG'] = {'kb': {
+        'index_name': 'kb', 'available_aggregations': {'dates': {},
+                                                       'types': {}}}}
+    app.metrics = Metrics(buckets=[])
+    app.slow_query_log = None
+
+    with app.app_context():
+        _observe_query('search', 'kb', {'aggs': {'dates': {}, 'types': {}}},
+                       {'took': 20}, .03)
+        _observe_query('search', 'kb', {'size': 10}, {'took': 10}, .02)
+        _observe_query('search', 'kb', {'aggs': {'x1': {}, 'x2': {},
+                                                 'dates': {}}},
+                       {'took': 10}, .02)
+
+    lines = app.metrics.render().splitlines()
+    # ES only reports the time of the whole request, so it is labeled with
+    # the set of aggregations.
+    assert_in('avresearcher_es_took_seconds_count{aggregations="dates,types",'
+              'index="kb"} 1', lines)
+    assert_in('avresearcher_es_took_seconds_count{aggregations="",'
+              'index="kb"} 1', lines)
+    # Names of aggregations that the collection doesn't have are not used
+    # as labels.
+    assert_in('avresearcher_es_took_seconds_count{aggregations="dates,other",'
+              'index="kb"} 1', lines)
+
+
+def test_worker_label():
+    metrics = Metrics(buckets=[], worker_label='worker')
+    metrics.observe('x', 1, phase='decode')
+    metrics.set_gauge('y', 2)
+
+    lines = metrics.render().splitlines()
+    assert_in('avresearcher_x_count{phase="decode",worker="%d"} 1'
+              % os.getpid(), lines)
+    assert_in('avresearcher_y{worker="%d"} 2' % os.getpid(), lines)
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from avresearcher.singleflight import SingleFlight
+
+from nose.tools import assert_equal, assert_raises
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait()
+        return {'took': 1}
+
+    results = []
+    started = []
+
+    def worker():
+        started.append(1)
+        results.append(flight.do('key', fetch))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for t in threads:
+        t.start()
+    # Give all threads the chance to join the call in flight.
+    while len(started) < 5:
+        time.sleep(.01)
+    time.sleep(.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert_equal(results, [{'took': 1}] * 5)
+    assert_equal(len(calls), 1)
+
+    # Nothing is kept after the call finished.
+    assert_equal(flight.do('key', lambda: 2), 2)
+
+
+def test_single_flight_error():
+    def fail():
+        raise ValueError('ES is down')
+
+    assert_raises(ValueError, SingleFlight().do, 'key', fail)
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+
+from avresearcher import settings
+from avresearcher.slow_queries import (ESSlowQueryLog, FileSlowQueryLog,
+                                       make_slow_query_log)
+from avresearcher.views import views
+from flask import Flask
+from flask.ext.login import LoginManager
+
+from nose.tools import assert_equal, assert_false, assert_true
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.events = []
+
+    def put(self, events):
+        self.events.extend(events)
+
+
+class FakeES(object):
+    def search(self, index, body):
+        return {'took': 1500, 'hits': {'total': 0, 'hits': []}}
+
+    def msearch(self, body):
+        return {'responses': [{'took': took} for took in [10, 2000]]}
+
+
+def test_is_slow():
+    log = ESSlowQueryLog(1., 'logs', FakeQueue())
+    assert_false(log.is_slow(.5, took=20))
+    assert_true(log.is_slow(1.5, took=20))
+    assert_true(log.is_slow(.5, took=1000))
+
+
+def test_es_slow_query_log():
+    queue = FakeQueue()
+    log = make_slow_query_log({'SLOW_QUERY_LOG': 'es',
+                               'ES_LOG_INDEX': 'logs'}, object(), queue)
+    log.record({'took': 1500})
+    assert_equal(queue.events, [{'took': 1500, '_op_type': 'create',
+                                 '_index': 'logs', '_type': 'slow_query'}])
+
+    # Without the queue, slow requests would wait for ES to index the
+    # entry; the entries are written to the file instead.
+    log = make_slow_query_log({'SLOW_QUERY_LOG': 'es', 'ES_LOG_INDEX': 'logs',
+                               'SLOW_QUERY_LOG_PATH': os.devnull}, object())
+    assert_true(isinstance(log, FileSlowQueryLog))
+
+
+def test_file_slow_query_log():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'slow.log')
+
+        app = Flask(__name__)
+        app.config.from_object(settings)
+        app.config.update(LOGIN_DISABLED=True, SECRET_KEY='secret',
+                          SEARCH_SPLIT_AGGREGATIONS=False)
+        LoginManager(app).user_loader(lambda user_id: None)
+        app.register_blueprint(views)
+
+        app.es_search = FakeES()
+        app.search_cache = app.search_flight = app.metrics = None
+        app.slow_query_log = FileSlowQueryLog(1., path)
+
+        client = app.test_client()
+        client.post('/api/search', data={'payload': json.dumps(
+            {'index': 'kb', 'size': 0, 'aggs': {'publication': {}}})})
+        client.post('/api/search', data={'payload': json.dumps(
+            [{'index': 'kb', 'size': 0}, {'index': 'immix', 'size': 0}])})
+
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+
+        assert_equal([(e['kind'], e['collection'], e['took'])
+                      for e in entries],
+                     [('search', 'kb', 1500), ('msearch', 'immix', 2000)])
+        assert_equal(json.loads(entries[0]['payload']),
+                     {'size': 0, 'aggs': {'publication': {}}})
+        assert_equal(entries[0]['user_id'], 'anonymous')
+        assert_true(entries[0]['server_seconds'] >= entries[0]['es_seconds'])
+
+        # The file is reopened after it was rotated (moved) by another
+        # process.
+        os.rename(path, path + '.1')
+        app.slow_query_log.record({'took': 3000})
+        with open(path) as f:
+            assert_equal([json.loads(line) for line in f], [{'took': 3000}])
+    finally:
+        shutil.rmtree(tmp_dir)
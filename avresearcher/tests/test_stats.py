@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from avresearcher import stats
+from avresearcher.stats import (compute_collection_stats,
+                                invalidate_collection_stats,
+                                load_collection_stats, save_collection_stats)
+
+from nose.tools import assert_equal, assert_true
+
+
+config = {
+    "COLLECTIONS_CONFIG": {
+        "kb": {
+            "index_name": "quamerdes_kb",
+            "available_aggregations": {
+                "dates_stats": {"stats": {"field": "date"}},
+            },
+            "stats_aggregations": {
+                "docs_by_type_count": {"terms": {"field": "meta.article_type"}},
+                "docs_with_text": {"filter": {"exists": {"field": "text"}}},
+            },
+        },
+    },
+    "ENABLED_COLLECTIONS": ["kb"],
+    "DATE_STATS_AGGREGATION": "dates_stats",
+    "COLLECTION_STATS_MAX_AGE": None,
+}
+
+
+class FakeES(object):
+    def __init__(self):
+        self.n_searches = 0
+
+    def search(self, index, body):
+        self.n_searches += 1
+        assert_equal(index, "quamerdes_kb")
+        assert_equal(set(body["aggs"]), set(["docs_by_type_count",
+                                             "docs_with_text",
+                                             "publication_date_stats"]))
+        return {
+            "hits": {"total": 42, "hits": []},
+            "aggregations": {
+                "docs_by_type_count": {"buckets": [{"key": "artikel",
+                                                    "doc_count": 40}]},
+                "docs_with_text": {"doc_count": 41},
+                "publication_date_stats": {"min": 0, "max": 1},
+            }
+        }
+
+
+def test_compute_collection_stats():
+    stats = compute_collection_stats(FakeES(), config)["collections"]
+
+    assert_equal(stats, {"kb": {
+        "total_docs": 42,
+        "docs_by_type_count": [{"key": "artikel", "doc_count": 40}],
+        "docs_with_text": 41,
+        "publication_date_stats": {"min": 0, "max": 1},
+    }})
+
+
+def test_load_collection_stats():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        c = dict(config)
+        c["COLLECTION_STATS_PATH"] = os.path.join(tmp_dir, "stats.json")
+        es = FakeES()
+
+        # The first load computes the snapshot, the second reads it back.
+        snapshot = load_collection_stats(es, c)
+        assert_true(os.path.exists(c["COLLECTION_STATS_PATH"]))
+        assert_equal(load_collection_stats(es, c), snapshot)
+        assert_equal(es.n_searches, 1)
+
+        invalidate_collection_stats(c["COLLECTION_STATS_PATH"])
+        load_collection_stats(es, c)
+        assert_equal(es.n_searches, 2)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_expired_collection_stats():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        c = dict(config)
+        c["COLLECTION_STATS_PATH"] = os.path.join(tmp_dir, "stats.json")
+        c["COLLECTION_STATS_MAX_AGE"] = -1
+        es = FakeES()
+
+        # Concurrent saves don't share a temporary file.
+        threads = [threading.Thread(target=save_collection_stats,
+                                    args=({"n": n},
+                                          c["COLLECTION_STATS_PATH"]))
+                   for n in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(os.listdir(tmp_dir), ["stats.json"])
+
+        # While another thread recomputes the expired snapshot, it is
+        # served as is.
+        with stats._refresh_lock:
+            snapshot = load_collection_stats(es, c)
+        assert_true("n" in snapshot)
+        assert_equal(es.n_searches, 0)
+
+        assert_true("collections" in load_collection_stats(es, c))
+        assert_equal(es.n_searches, 1)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import tempfile
+
+from avresearcher.usage_log import UsageLogQueue
+from elasticsearch.exceptions import ConnectionError
+
+from nose.tools import assert_equal, assert_false, assert_true
+
+
+class FakeES(object):
+    def __init__(self, up=True):
+        self.up = up
+        self.bulks = []
+
+    def bulk(self, body, **kwargs):
+        if not self.up:
+            raise ConnectionError('N/A', 'connection refused', None)
+
+        self.bulks.append(body)
+        return {'items': [{'create': {'status': 201}}
+                          for _ in range(len(body) // 2)]}
+
+
+def make_events(n):
+    return [{'_op_type': 'create', '_index': 'logs', '_type': 'event',
+             'event_id': i} for i in range(n)]
+
+
+def test_batching():
+    es = FakeES()
+    log = UsageLogQueue(es, batch_size=2, flush_interval=.01)
+    log.put(make_events(5))
+    log.close()
+
+    # A header/event pair per event, max. two events per bulk request.
+    assert_equal(sum(len(body) for body in es.bulks), 10)
+    assert_true(all(len(body) <= 4 for body in es.bulks))
+
+
+def test_journal():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        journal_path = os.path.join(tmp_dir, 'journal.jsonl')
+        es = FakeES(up=False)
+        log = UsageLogQueue(es, batch_size=10, flush_interval=.01,
+                            max_queued=2, journal_path=journal_path)
+
+        # Three events don't fit in the queue, the other two can't be sent.
+        log.put(make_events(5))
+        log.close()
+        with open(journal_path) as f:
+            journaled = [json.loads(line)['event_id'] for line in f]
+        assert_equal(sorted(journaled), range(5))
+
+        # Once ES is back, the journal is replayed after the next flush.
+        es.up = True
+        log._flush(make_events(1))
+        log._replay_journal()
+        assert_false(os.path.exists(journal_path))
+        assert_equal(sum(len(body) // 2 for body in es.bulks), 6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_no_journal():
+    log = UsageLogQueue(FakeES(up=False), flush_interval=.01)
+    log.put(make_events(1))
+    log.close()
+    assert_true(log._queue.empty())
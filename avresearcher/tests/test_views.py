@@ -1,6 +1,15 @@
-from avresearcher.views import _date_table, _find_qstring, _gen_csv_filename
+import json
 
-from nose.tools import assert_equal
+from avresearcher import settings
+from avresearcher.metrics import Metrics
+from avresearcher.views import (_date_table, _find_qstring, _gen_csv_filename,
+                                _merge_responses, _payload_to_es,
+                                _split_query, _strip_response, views)
+from elasticsearch import TransportError
+from flask import Flask
+from flask.ext.login import LoginManager
+
+from nose.tools import assert_equal, assert_true
 
 
 def test_csv():
@@ -69,3 +78,198 @@ def test_gen_csv_filename():
     assert_equal("kb_waarom.csv", _gen_csv_filename(p1, p2))
     assert_equal("kb_waarom.csv", _gen_csv_filename(p2, p1))
     assert_equal("kb_waarom_kb_waarom.csv", _gen_csv_filename(p1, p1))
+
+
+def test_csv_n_series():
+    def make_bucket(point):
+        date, count = point
+        return {"key_as_string": date + "T00:00:00.000Z", "key": "ignored",
+                "doc_count": count}
+
+    buckets1 = map(make_bucket, [("2000-01-01", 1), ("2000-02-01", 0),
+                                 ("2000-03-01", 3)])
+    buckets2 = map(make_bucket, [("2000-02-01", 2), ("2000-03-01", 5)])
+    buckets3 = map(make_bucket, [("1999-12-01", 7)])
+
+    assert_equal(list(_date_table(buckets1, buckets2, buckets3,
+                                  interval='month')),
+                 [("1999-12", 0, 0, 7),
+                  ("2000-01", 1, 0, 0),
+                  ("2000-02", 0, 2, 0),
+                  ("2000-03", 3, 5, 0)])
+
+    assert_equal(list(_date_table(buckets1, buckets3, interval='day')),
+                 [("1999-12-01", 0, 7),
+                  ("2000-01-01", 1, 0),
+                  ("2000-03-01", 3, 0)])
+
+
+def test_payload_to_es_source():
+    app = Flask(__name__)
+    app.config['COLLECTIONS_CONFIG'] = {
+        'kb': {'index_name': 'quamerdes_kb',
+               'required_fields': ['title', 'date']}
+    }
+
+    with app.app_context():
+        assert_equal(_payload_to_es({'index': 'kb', 'size': 5}),
+                     ('quamerdes_kb', {'size': 5,
+                                       '_source': ['title', 'date']}))
+        assert_equal(_payload_to_es({'index': 'kb', 'fields': ['title']}),
+                     ('quamerdes_kb', {'fields': ['title'], '_source': False}))
+        assert_equal(_payload_to_es({'index': 'kb', 'size': 0}),
+                     ('quamerdes_kb', {'size': 0}))
+
+
+def test_strip_response():
+    response = {'took': 3, 'timed_out': False, '_shards': {'total': 5},
+                'hits': {'total': 1, 'max_score': 1.,
+                         'hits': [{'_index': 'kb', '_type': 'item',
+                                   '_id': '1', '_score': 1.,
+                                   'fields': {'title': ['t']}}]},
+                'aggregations': {}}
+
+    assert_equal(_strip_response(response),
+                 {'took': 3, 'aggregations': {},
+                  'hits': {'total': 1,
+                           'hits': [{'_id': '1', 'fields': {'title': ['t']}}]}})
+
+
+def test_split_query():
+    query = {'query': {'match': {'text': 'radio'}},
+             'post_filter': {'term': {'broadcasters': 'VARA'}},
+             'aggs': {'broadcasters': {'terms': {'field': 'broadcasters'}}},
+             'highlight': {'fields': {'text': {}}},
+             'sort': [{'date': 'asc'}], 'size': 10, 'from': 20}
+
+    hits, aggregations = _split_query(query)
+    assert_equal(hits, {'query': {'match': {'text': 'radio'}},
+                        'post_filter': {'term': {'broadcasters': 'VARA'}},
+                        'highlight': {'fields': {'text': {}}},
+                        'sort': [{'date': 'asc'}], 'size': 10, 'from': 20})
+    assert_equal(aggregations, {
+        'query': {'match': {'text': 'radio'}},
+        'aggs': {'broadcasters': {'terms': {'field': 'broadcasters'}}},
+        'size': 0})
+
+    # Queries for only hits or only aggregations are not split.
+    assert_equal(_split_query(hits), (hits, None))
+    assert_equal(_split_query(aggregations), (aggregations, None))
+
+    hits_response = {'took': 3, 'hits': {'total': 5, 'hits': []}}
+    aggregations_response = {'took': 7, 'hits': {'total': 9, 'hits': []},
+                             'aggregations': {'broadcasters': {}}}
+    assert_equal(_merge_responses(hits_response, aggregations_response),
+                 {'took': 7, 'hits': {'total': 5, 'hits': []},
+                  'aggregations': {'broadcasters': {}}})
+    assert_equal(_merge_responses(hits_response, {'error': 'failed'}),
+                 {'error': 'failed'})
+    assert_true('aggregations' not in hits_response)
+
+
+class FailingES(object):
+    # Fails the aggregations part of split searches, like ES does for e.g.
+    # a syntax error in a query_string.
+    def msearch(self, body):
+        return {'responses': [{'error': 'SearchPhaseExecutionException'}
+                              if 'aggs' in query else
+                              {'took': 1, 'hits': {'total': 0, 'hits': []}}
+                              for query in body[1::2]]}
+
+
+def make_app(es):
+    app = Flask(__name__)
+    app.config.from_object(settings)
+    app.config.update(LOGIN_DISABLED=True, SECRET_KEY='secret')
+    LoginManager(app).user_loader(lambda user_id: None)
+    app.register_blueprint(views)
+
+    app.es_search = es
+    app.search_cache = app.search_flight = app.metrics = None
+    app.slow_query_log = None
+    return app
+
+
+def test_search_error():
+    response = make_app(FailingES()).test_client().post('/api/search', data={
+        'payload': json.dumps({'index': 'kb', 'aggs': {'dates': {}}})})
+    assert_equal(response.status_code, 500)
+
+
+class HistogramES(object):
+    # Returns a date histogram with a bucket, unless the query string is
+    # empty.
+    def msearch(self, body):
+        return {'responses': [{'aggregations': {settings.DATE_AGGREGATION: {
+            'buckets': [{'key_as_string': '2000-01-01T00:00:00.000Z',
+                         'doc_count': 3}] if _find_qstring(query) else []}}}
+            for query in body[1::2]]}
+
+
+def test_metrics_allowed_ips():
+    app = make_app(None)
+    app.metrics = Metrics(buckets=[])
+    app.user_cache = None
+    app.config['METRICS_ALLOWED_IPS'] = ['10.0.0.1']
+    client = app.test_client()
+
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert_equal(response.status_code, 403)
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert_equal(response.status_code, 200)
+
+
+def test_export_csv():
+    def payload(q):
+        return {'index': 'kb', 'query': {'query_string': {'query': q}},
+                'aggs': {settings.DATE_AGGREGATION: {
+                    'date_histogram': {'field': 'date', 'interval': 'year'}}}}
+
+    client = make_app(HistogramES()).test_client()
+    response = client.post('/api/export', data={'payload': json.dumps(
+        [payload('radio'), payload(''), payload('tv')])})
+    assert_equal(response.status_code, 200)
+
+    # The header names the series, as the ones without buckets are left
+    # out.
+    assert_equal(response.data.splitlines(),
+                 ['date,kb radio,kb tv', '2000,3,3'])
+
+
+class ScanES(object):
+    # Scans a single page of hits, or fails the query like ES does for
+    # a syntax error in a query_string.
+    def search(self, index, body, search_type, scroll, size):
+        if 'query_string' in json.dumps(body):
+            raise TransportError(400, 'SearchPhaseExecutionException')
+        return {'_scroll_id': '0'}
+
+    def scroll(self, scroll_id, scroll):
+        hits = [{'_id': '1', '_source': {}}] if scroll_id == '0' else []
+        return {'_scroll_id': str(int(scroll_id) + 1), 'hits': {'hits': hits}}
+
+    def clear_scroll(self, scroll_id):
+        pass
+
+
+def test_export_hits():
+    client = make_app(ScanES()).test_client()
+
+    def export(payload=None, **form):
+        form['payload'] = json.dumps(payload or {'index': 'kb'})
+        return client.post('/api/export/hits', data=form,
+                           headers={'Accept-Encoding': 'gzip;q=0'})
+
+    response = export()
+    assert_equal(response.status_code, 200)
+    assert_equal(response.headers.get('Content-Encoding'), None)
+    assert_equal(len(response.data.splitlines()), 2)
+
+    assert_equal(export(max_rows='0').data.count('\n'), 1)
+    assert_equal(export(max_rows='many').status_code, 400)
+    assert_equal(export(max_rows='-1').status_code, 400)
+
+    # The query fails before the response is streamed.
+    response = export({'index': 'kb', 'query': {'query_string': {
+        'query': 'AND'}}})
+    assert_equal(response.status_code, 500)
@@ -0,0 +1,179 @@
+"""Asynchronous, batched ingestion of usage log events.
+
+Events are put on a bounded in-memory queue by the request threads and sent
+to the log index in bulk by a background thread. When the queue is full, or
+when Elasticsearch cannot be reached, events are appended to a local
+journal file (one JSON event per line) that is replayed once Elasticsearch
+accepts events again.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from itertools import islice
+from Queue import Queue, Empty, Full
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import bulk
+
+
+__all__ = ['UsageLogQueue']
+
+
+logger = logging.getLogger(__name__)
+
+
+class UsageLogQueue(object):
+    """Buffers bulk actions for the log index.
+
+    :param es: the :class:`Elasticsearch` instance for the log index.
+    :param batch_size: max. number of events sent in one bulk request.
+    :param flush_interval: max. number of seconds an event waits in the
+                           queue before it is sent.
+    :param max_queued: max. number of events kept in memory.
+    :param journal_path: file that events are written to when they cannot
+                         be sent (or queued); None to drop those events.
+    :param metrics: a :class:`metrics.Metrics` that records the duration of
+                    the bulk requests, or None.
+    """
+
+    def __init__(self, es, batch_size=500, flush_interval=5.,
+                 max_queued=10000, journal_path=None, metrics=None):
+        self.es = es
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+
+        self._queue = Queue(max_queued)
+        self._closed = threading.Event()
+        self._journal_lock = threading.Lock()
+        self._worker_lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+
+        atexit.register(self.close)
+
+    def put(self, events):
+        """Queues the events without blocking; events that don't fit in the
+        queue are written to the journal."""
+        self._ensure_worker()
+
+        overflow = []
+        for event in events:
+            try:
+                self._queue.put_nowait(event)
+            except Full:
+                overflow.append(event)
+
+        if overflow:
+            logger.warning('Usage log queue full, journaling %d events'
+                           % len(overflow))
+            self._journal(overflow)
+
+    def close(self):
+        """Stops the background thread and sends all queued events."""
+        self._closed.set()
+        if self._worker is not None and self._worker_pid == os.getpid():
+            self._worker.join()
+
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _ensure_worker(self):
+        # The queue may have been created before the WSGI server forked its
+        # workers, so (re)start the thread in the process that uses it.
+        if self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+
+        with self._worker_lock:
+            if self._worker_pid != os.getpid() or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name='usage-log')
+                self._worker.daemon = True
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            if batch and self._flush(batch):
+                self._replay_journal()
+
+    def _next_batch(self, block=True):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if block:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _flush(self, events):
+        """Sends the events to ES. Returns False, after journaling the
+        events, if ES could not be reached."""
+        start = time.time()
+        try:
+            bulk(self.es, events, stats_only=True)   # Don't care about errors.
+        except TransportError as e:
+            logger.warning('Sending %d usage log events failed: %s'
+                           % (len(events), e))
+            self._journal(events)
+            return False
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('es_seconds', time.time() - start,
+                                     client='log', kind='bulk',
+                                     index=events[0].get('_index'))
+
+        return True
+
+    def _journal(self, events):
+        if self.journal_path is None:
+            logger.warning('Dropping %d usage log events' % len(events))
+            return
+
+        with self._journal_lock:
+            with open(self.journal_path, 'a') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+
+    def _replay_journal(self):
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return
+
+        # Move the journal aside, so that events journaled while replaying
+        # end up in a fresh file.
+        replay_path = '%s.%d.replay' % (self.journal_path, os.getpid())
+        with self._journal_lock:
+            try:
+                os.rename(self.journal_path, replay_path)
+            except OSError:
+                # Another process is replaying it.
+                return
+
+        with open(replay_path) as f:
+            lines = iter(f)
+            while True:
+                events = [json.loads(line) for line in
+                          islice(lines, self.batch_size)]
+                if not events:
+                    break
+                if not self._flush(events):
+                    self._journal(json.loads(line) for line in lines)
+                    break
+
+        os.remove(replay_path)
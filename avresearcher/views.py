@@ -1,17 +1,31 @@
+import csv
+import heapq
 import re
+import time
 import uuid
 import json
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime
+from contextlib import contextmanager
+from itertools import chain, groupby
 
+from elasticsearch import TransportError
 from elasticsearch.helpers import bulk
 from flask import (Blueprint, current_app, render_template, abort, request,
-                   Response, jsonify, url_for)
+                   Response, jsonify, url_for, g)
 from flask.ext.login import login_user, logout_user, login_required, current_user
 from flask.ext.mail import Message
 from slugify import slugify_filename
-from toolz import first, get_in, join
+from toolz import first, get_in
 
+from .cache import cache_key
+from .compression import accepted_encoding, compress
+from .export import scroll_hits, csv_chunks, ndjson_chunks, gzip_chunks
 from .extensions import db, mail, bcrypt
+from .jobs import PoolBusy
 from .models import User
+from .stats import load_collection_stats
 
 
 views = Blueprint('views', __name__)
@@ -19,6 +33,84 @@ views = Blueprint('views', __name__)
 R_EMAIL = re.compile(r'^.+@[^.].*\.[a-z]{2,10}$', re.IGNORECASE)
 
 
+@views.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@views.teardown_request
+def record_request_time(exc=None):
+    metrics = current_app.metrics
+    start = getattr(g, 'request_start', None)
+    if metrics is not None and start is not None:
+        metrics.observe('request_seconds', time.time() - start,
+                        endpoint=request.endpoint)
+
+
+@views.teardown_request
+def record_slow_queries(exc=None):
+    slow_queries = getattr(g, 'slow_queries', None)
+    if not slow_queries:
+        return
+
+    server_seconds = time.time() - g.request_start
+    user_id = getattr(current_user, 'id', 'anonymous')  # For LOGIN_DISABLED.
+    for entry in slow_queries:
+        entry.update({
+            'timestamp': datetime.utcnow().isoformat(),
+            'endpoint': request.endpoint,
+            'user_id': user_id,
+            'server_seconds': server_seconds,
+        })
+        current_app.slow_query_log.record(entry)
+
+
+@views.route('/metrics', methods=['GET'])
+def metrics():
+    """Returns the latency histograms (and cache statistics) of this
+    process in the Prometheus text format."""
+    metrics = current_app.metrics
+    if metrics is None:
+        abort(404)
+
+    allowed_ips = current_app.config['METRICS_ALLOWED_IPS']
+    if allowed_ips is not None and request.remote_addr not in allowed_ips:
+        abort(403)
+
+    for cache_name in ['search_cache', 'user_cache']:
+        cache = getattr(current_app, cache_name)
+        if cache is not None:
+            for name, value in cache.stats().iteritems():
+                metrics.set_gauge('%s_%s' % (cache_name, name), value)
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@views.after_request
+def compress_response(response):
+    """Compresses (non-streamed) responses of at least
+    RESPONSE_COMPRESSION_MIN_SIZE bytes with gzip or deflate, if the client
+    accepts it."""
+    min_size = current_app.config['RESPONSE_COMPRESSION_MIN_SIZE']
+    if min_size is None or response.direct_passthrough\
+            or response.is_streamed or response.status_code != 200\
+            or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+    data = response.get_data()
+    if encoding is None or len(data) < min_size:
+        return response
+
+    response.set_data(compress(data, encoding,
+                               current_app.config['RESPONSE_COMPRESSION_LEVEL']))
+    response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
 @views.route('/', methods=['GET'])
 def index():
     exposed_settings = [
@@ -69,6 +161,7 @@ def verify_email(user_id, token):
     user.email_verified = True
     db.session.add(user)
     db.session.commit()
+    _invalidate_user(user.id)
 
     # Send email to mail address responsible for approving accounts
     approve_url = url_for('.approve_user', user_id=user.id,
@@ -82,7 +175,7 @@ def verify_email(user_id, token):
 
     msg.body = MESSAGES['email_approval_body'] % (user.name, user.organization,
                                                   user.email, approve_url)
-    mail.send(msg)
+    _send_mail(msg)
 
     messages = {
         'email_verified_title': MESSAGES['email_verified_title'] % user.name,
@@ -108,6 +201,7 @@ def approve_user(user_id, token):
     user.approved = True
     db.session.add(user)
     db.session.commit()
+    _invalidate_user(user.id)
 
     MESSAGES = current_app.config['MESSAGES']
 
@@ -119,13 +213,27 @@ def approve_user(user_id, token):
     index_url = url_for('.index', _external=True)
     msg.body = MESSAGES['email_approved_body'] % (user.name, index_url)
 
-    mail.send(msg)
+    _send_mail(msg)
 
     return render_template('approve_user.html', user=user,
                            user_approved_title=MESSAGES['user_approved_title']
                            % user.name)
 
 
+def _send_mail(msg):
+    # Sends the message from the mail queue, if there is one.
+    if current_app.mail_queue is not None:
+        current_app.mail_queue.send(msg)
+    else:
+        mail.send(msg)
+
+
+def _invalidate_user(user_id):
+    # Removes a changed user from the user cache (of this worker process).
+    if current_app.user_cache is not None:
+        current_app.user_cache.delete(user_id)
+
+
 @views.route('/api/register', methods=['POST'])
 def register():
     """Register a new user account."""
@@ -153,7 +261,12 @@ def register():
         return jsonify({'success': False, 'errors': errors})
 
     # Hash the provided password
-    password = bcrypt.generate_password_hash(request.form['password'], 12)
+    try:
+        password = current_app.bcrypt_pool.apply(
+            bcrypt.generate_password_hash, request.form['password'], 12)
+    except PoolBusy:
+        return jsonify({'success': False,
+                        'errors': [MESSAGES['server_busy']]})
 
     # Create the user record
     user = User(
@@ -182,7 +295,7 @@ def register():
                   recipients=[request.form['email']])
     msg.body = MESSAGES['email_verification_body']\
         % (request.form['name'], verification_url)
-    mail.send(msg)
+    _send_mail(msg)
 
     return jsonify({'success': True})
 
@@ -209,7 +322,15 @@ def login():
         return jsonify({'success': False, 'errors': [MESSAGES['login_failed']]})
 
     # Validate password
-    if not bcrypt.check_password_hash(user.password, request.form['password']):
+    try:
+        valid_password = current_app.bcrypt_pool.apply(
+            bcrypt.check_password_hash, user.password,
+            request.form['password'])
+    except PoolBusy:
+        return jsonify({'success': False,
+                        'errors': [MESSAGES['server_busy']]})
+
+    if not valid_password:
         return jsonify({
             'success': False,
             'errors': [MESSAGES['login_failed']]
@@ -254,22 +375,265 @@ def logout():
 @views.route('/api/search', methods=['POST'])
 @login_required
 def search():
-    payload = json.loads(request.form['payload'])
+    with _timed_phase('decode'):
+        payload = json.loads(request.form['payload'])
 
     if isinstance(payload, dict):
         index, payload = _payload_to_es(payload)
-        results = current_app.es_search.search(index=index, body=payload)
+        if current_app.config['SEARCH_SPLIT_AGGREGATIONS']:
+            results = _split_msearch([(index, payload)])['responses'][0]
+            # A failed search raises, like it does when it isn't split.
+            if 'error' in results:
+                raise TransportError(results.get('status', 500),
+                                     results['error'])
+        else:
+            results = _cached('search', index, payload,
+                              lambda: _strip_response(_timed_es(
+                                  'search', index, payload,
+                                  lambda: current_app.es_search.search(
+                                      index=index, body=payload))))
 
     elif isinstance(payload, list):
+        queries = [_payload_to_es(query) for query in payload]
+        if current_app.config['SEARCH_SPLIT_AGGREGATIONS']:
+            results = _split_msearch(queries)
+        else:
+            results = _cached_msearch(queries)
+
+    with _timed_phase('encode'):
+        return jsonify(results)
+
+
+def _cached(kind, index, body, fetch):
+    """Returns the cached response to an ES request, or calls ``fetch`` to
+    get (and cache) it. Concurrent identical requests share a single call
+    to ``fetch``."""
+    key = cache_key(kind, index, body)
+
+    cache = current_app.search_cache
+    if cache is not None:
+        results = cache.get(key)
+        if results is not None:
+            return results
+
+    results = _single_flight(key, fetch)
+    if cache is not None:
+        cache.set(key, results)
+
+    return results
+
+
+def _cached_msearch(queries):
+    """Performs an msearch for a list of (index name, body) pairs. Only the
+    queries that are not in the cache are sent to ES, and identical queries
+    are sent only once."""
+    cache = current_app.search_cache
+    keys = [cache_key('search', index, query) for index, query in queries]
+
+    responses = {}
+    if cache is not None:
+        for key in set(keys):
+            response = cache.get(key)
+            if response is not None:
+                responses[key] = response
+
+    # Unique missing queries, in order of first appearance.
+    missing = OrderedDict()
+    for key, query in zip(keys, queries):
+        if key not in responses:
+            missing.setdefault(key, query)
+
+    if missing:
         body = []
-        for query in payload:
-            index, query = _payload_to_es(query)
+        for index, query in missing.itervalues():
             body.append({'index': index})
             body.append(query)
 
-        results = current_app.es_search.msearch(body=body)
+        indices = ','.join(sorted(set(index for index, _ in
+                                      missing.itervalues())))
+        results = _single_flight('msearch:' + ','.join(missing),
+                                 lambda: _timed_es(
+                                     'msearch', indices, missing.values(),
+                                     lambda: current_app.es_search.msearch(
+                                         body=body)))
+        for key, response in zip(missing, results['responses']):
+            response = _strip_response(response)
+            responses[key] = response
+            # Don't cache failed queries.
+            if cache is not None and 'error' not in response:
+                cache.set(key, response)
+
+    return {'responses': [responses[key] for key in keys]}
+
+
+# The parts of a search request that determine its aggregations
+AGGREGATION_QUERY_KEYS = ['query', 'aggs', 'aggregations', 'min_score']
+
+
+def _split_query(body):
+    """Splits a search request into a request for the hits (which also
+    gets the highlighting) and one for the aggregations only, or returns
+    (body, None) if the request doesn't need both.
+
+    The aggregations don't depend on the page, sorting or highlighting, so
+    they can be cached and reused when only those change.
+    """
+    if body.get('size', 10) == 0 or not (body.get('aggs')
+                                         or body.get('aggregations')):
+        return body, None
+
+    hits_query = dict((key, value) for key, value in body.iteritems()
+                      if key not in ['aggs', 'aggregations'])
+    aggregations_query = dict((key, body[key])
+                              for key in AGGREGATION_QUERY_KEYS if key in body)
+    aggregations_query['size'] = 0
+
+    return hits_query, aggregations_query
+
+
+def _split_msearch(queries):
+    """Like :func:`_cached_msearch`, but the hits and the aggregations of
+    each query are fetched (and cached) as separate queries, see
+    :func:`_split_query`. The responses are merged again."""
+    parts = []
+    n_parts = []
+    for index, body in queries:
+        split = [part for part in _split_query(body) if part is not None]
+        parts.extend((index, part) for part in split)
+        n_parts.append(len(split))
+
+    responses = iter(_cached_msearch(parts)['responses'])
+    merged = []
+    for n in n_parts:
+        response = next(responses)
+        if n == 2:
+            response = _merge_responses(response, next(responses))
+        merged.append(response)
+
+    return {'responses': merged}
+
+
+def _merge_responses(hits_response, aggregations_response):
+    # Returns a new response, as the given ones may be cached.
+    for response in [hits_response, aggregations_response]:
+        if 'error' in response:
+            return response
+
+    response = dict(hits_response)
+    response['aggregations'] = aggregations_response.get('aggregations', {})
+    response['took'] = max(hits_response.get('took', 0),
+                           aggregations_response.get('took', 0))
+    return response
+
+
+# Parts of ES search responses that the front-end doesn't use
+RESPONSE_OMIT = ['_shards', 'timed_out']
+HITS_OMIT = ['max_score']
+HIT_OMIT = ['_index', '_type', '_score']
+
+
+def _strip_response(response):
+    """Removes the metadata the front-end doesn't use from a search
+    response (in-place), and returns it."""
+    for key in RESPONSE_OMIT:
+        response.pop(key, None)
+
+    hits = response.get('hits', {})
+    for key in HITS_OMIT:
+        hits.pop(key, None)
+    for hit in hits.get('hits', []):
+        for key in HIT_OMIT:
+            hit.pop(key, None)
+
+    return response
+
+
+def _timed_es(kind, index, body, fetch, client='search'):
+    """Calls ``fetch``, which performs an ES request, and records its
+    round-trip time and the time ES reports it took. For an msearch,
+    ``body`` is the list of (index, query) pairs."""
+    start = time.time()
+    with _timed('es_seconds', client=client, kind=kind, index=index):
+        response = fetch()
+    seconds = time.time() - start
+
+    if kind == 'msearch':
+        for (query_index, query), query_response in zip(body,
+                                                         response['responses']):
+            _observe_query(kind, query_index, query, query_response, seconds)
+    elif body is not None:
+        _observe_query(kind, index, body, response, seconds)
+
+    return response
+
+
+def _observe_query(kind, index, body, response, seconds):
+    # Records the 'took' of a search response, for the index and for the
+    # set of aggregations in the request (ES doesn't report the time of
+    # each aggregation; with SEARCH_SPLIT_AGGREGATIONS, the aggregations
+    # are timed apart from the hits), and notes the query if it is slow.
+    # The names of the aggregations come from the client, so names that
+    # are not among the available_aggregations of the collection are
+    # labeled 'other'.
+    took = response.get('took') if isinstance(response, dict) else None
+
+    metrics = current_app.metrics
+    if metrics is not None and took is not None:
+        collection = current_app.config['COLLECTIONS_CONFIG']\
+            .get(_collection_name(index), {})
+        available = collection.get('available_aggregations', {})
+        aggregations = body.get('aggs') or body.get('aggregations') or {}
+        aggregations = set(name if name in available else 'other'
+                           for name in aggregations)
+        metrics.observe('es_took_seconds', took / 1000., index=index,
+                        aggregations=','.join(sorted(aggregations)))
+
+    slow_query_log = current_app.slow_query_log
+    if slow_query_log is not None and slow_query_log.is_slow(seconds, took):
+        # Written when the request is done (see record_slow_queries), when
+        # the total time is known.
+        if not hasattr(g, 'slow_queries'):
+            g.slow_queries = []
+        g.slow_queries.append({
+            'kind': kind,
+            'index': index,
+            'collection': _collection_name(index),
+            'payload': json.dumps(body, sort_keys=True),
+            'took': took,
+            'es_seconds': seconds,
+        })
+
+
+def _collection_name(index):
+    for name, config in current_app.config['COLLECTIONS_CONFIG'].iteritems():
+        if config['index_name'] == index:
+            return name
+    return None
 
-    return jsonify(results)
+
+def _timed(name, **labels):
+    metrics = current_app.metrics
+    if metrics is None:
+        return _untimed()
+    return metrics.time(name, **labels)
+
+
+def _timed_phase(phase):
+    """Records the time of a phase (e.g. 'decode', 'encode') of the
+    current request."""
+    return _timed('phase_seconds', endpoint=request.endpoint, phase=phase)
+
+
+@contextmanager
+def _untimed():
+    yield
+
+
+def _single_flight(key, fetch):
+    flight = current_app.search_flight
+    if flight is None:
+        return fetch()
+    return flight.do(key, fetch)
 
 
 def _payload_to_es(payload):
@@ -290,65 +654,172 @@ def _payload_to_es(payload):
         sort_spec = payload['sort'][0]
         sort_spec[config[index]['date_sort_field']] = sort_spec.pop('date')
 
+    # Only return the fields that are shown. Highlighted snippets are not
+    # taken from the returned _source, so the (large) text fields are left
+    # out.
+    if payload.get('size') != 0:
+        if 'fields' in payload:
+            payload['_source'] = False
+        else:
+            payload['_source'] = config[index]['required_fields']
+
     return index_name, payload
 
 
 @views.route('/api/count', methods=['POST'])
 @login_required
 def count():
-    payload = json.loads(request.form['payload'])
+    with _timed_phase('decode'):
+        payload = json.loads(request.form['payload'])
 
     index = current_app.config['COLLECTIONS_CONFIG'].get(payload.pop('index'))['index_name']
     query = payload.get('query')
 
-    results = current_app.es_search.count(index=index, body=query)
+    results = _cached('count', index, query,
+                      lambda: _timed_es('count', index, query,
+                                        lambda: current_app.es_search.count(
+                                            index=index, body=query)))
 
-    return jsonify(results)
+    with _timed_phase('encode'):
+        return jsonify(results)
+
+
+@views.route('/api/collection_stats', methods=['GET'])
+@login_required
+def collection_stats():
+    """Returns the (precomputed) statistics of the enabled collections."""
+    return jsonify(load_collection_stats(current_app.es_search,
+                                         current_app.config))
 
 
 @views.route('/api/export', methods=['POST'])
 @login_required
 def export_cvs():
-    payload1, payload2 = json.loads(request.form['payload'])
+    """Exports the date histograms of any number of queries as a CSV table,
+    with a row per date and a column per query. The header names the query
+    of each column."""
+    with _timed_phase('decode'):
+        payloads = json.loads(request.form['payload'])
 
-    filename = _gen_csv_filename(payload1, payload2)
+    interval = request.form.get('interval', 'year')
+    if interval not in current_app.config['ALLOWED_INTERVALS']:
+        abort(400)
 
-    payload1['size'] = 0
-    payload2['size'] = 0
-
-    config = current_app.config['COLLECTIONS_CONFIG']
-    index1 = config.get(payload1.pop('index'))['index_name']
-    index2 = config.get(payload2.pop('index'))['index_name']
-
-    results1 = current_app.es_search.search(index=index1, body=payload1)
-    results2 = current_app.es_search.search(index=index2, body=payload2)
+    filename = _gen_csv_filename(*payloads)
+    labels = [_series_label(payload) for payload in payloads]
 
     date_aggr = current_app.config['DATE_AGGREGATION']
-    results1 = results1["aggregations"][date_aggr]['buckets']
-    results2 = results2["aggregations"][date_aggr]['buckets']
-
-    return Response((",".join(map(str, row)) + "\n"
-                     for row in _date_table(results1, results2)),
+    queries = []
+    for payload in payloads:
+        payload['size'] = 0
+        payload['aggs'][date_aggr]['date_histogram']['interval'] = interval
+        queries.append(_payload_to_es(payload))
+
+    # All series in a single request
+    responses = _cached_msearch(queries)['responses']
+    results = [response['aggregations'][date_aggr]['buckets']
+               for response in responses]
+
+    # _date_table leaves out the series without buckets.
+    header = ['date'] + [label for label, buckets in zip(labels, results)
+                         if buckets]
+
+    rows = chain([_csv_line(header)],
+                 (",".join(map(str, row)) + "\n"
+                  for row in _date_table(*results, interval=interval)))
+    return Response(rows,
                     headers={"Content-Disposition":
                              "attachment; filename=%s" % filename},
                     mimetype='text/csv')
 
 
-def _gen_csv_filename(payload1, payload2):
+@views.route('/api/export/hits', methods=['POST'])
+@login_required
+def export_hits():
+    """Streams the documents that match the query in the payload as CSV
+    (default) or, with format=ndjson, as one JSON object per line."""
+    payload = json.loads(request.form['payload'])
+    export_format = request.form.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        abort(400)
+
+    collection = payload['index']
+    fields = current_app.config['COLLECTIONS_CONFIG'][collection]['export_fields']
+
+    # Stay under the user's limit, which may be lowered by the request.
+    user_caps = current_app.config['EXPORT_HITS_USER_MAX_ROWS']
+    max_rows = user_caps.get(getattr(current_user, 'email', None),
+                             current_app.config['EXPORT_HITS_MAX_ROWS'])
+    if request.form.get('max_rows'):
+        try:
+            requested_rows = int(request.form['max_rows'])
+        except ValueError:
+            abort(400)
+        if requested_rows < 0:
+            abort(400)
+        max_rows = min(max_rows, requested_rows)
+
+    try:
+        filename = slugify_filename(' '.join([collection,
+                                              _find_qstring(payload)]))
+    except StopIteration:
+        filename = slugify_filename(collection)
+
+    index, payload = _payload_to_es(payload)
+    body = {
+        'query': payload.get('query', {'match_all': {}}),
+        '_source': [field for _, field in fields if field != '_id']
+    }
+
+    # Starts the scan, so ES errors fail the request before it's streamed.
+    pages = scroll_hits(current_app.es_search, index, body,
+                        size=current_app.config['EXPORT_HITS_SCROLL_SIZE'],
+                        max_hits=max_rows)
+    if export_format == 'csv':
+        chunks = csv_chunks(pages, fields)
+        mimetype = 'text/csv'
+        filename += '.csv'
+    else:
+        chunks = ndjson_chunks(pages, fields)
+        mimetype = 'application/x-ndjson'
+        filename += '.ndjson'
+
+    headers = {'Content-Disposition': 'attachment; filename=%s' % filename,
+               'Vary': 'Accept-Encoding'}
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding == 'gzip':
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(chunks, headers=headers, mimetype=mimetype)
+
+
+def _gen_csv_filename(*payloads):
     # Generate a pretty filename for our CSV dump.
-    index1 = payload1['index']
-    index2 = payload2['index']
+    parts = []
+    for payload in payloads:
+        q = _find_qstring(payload)
+        if q:
+            parts.extend([payload['index'], q])
+
+    return slugify_filename(" ".join(parts)) + '.csv'
+
 
-    q1 = _find_qstring(payload1)
-    q2 = _find_qstring(payload2)
+def _series_label(payload):
+    # The collection and query string of a series, as its column name.
+    try:
+        q = _find_qstring(payload)
+    except StopIteration:
+        q = None
 
-    if not q1:
-        index1 = ""
-    if not q2:
-        index2 = ""
+    return u' '.join([payload['index'], q]) if q else payload['index']
 
-    return slugify_filename(" ".join(part for part in [index1, q1, index2, q2]
-                                          if part)) + '.csv'
+
+def _csv_line(values):
+    buf = StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(
+        [value.encode('utf-8') for value in values])
+    return buf.getvalue()
 
 
 def _find_qstring(payload):
@@ -372,33 +843,42 @@ def _find_qstring(payload):
     return next(dfs('query', payload))
 
 
-def _date_table(results1, results2):
-    def year(bucket):
-        return int(bucket['key_as_string'].split('-', 1)[0])
+# Functions that turn a date histogram bucket into the date in the first
+# column of the CSV export, per interval. Within an interval, the dates sort
+# in chronological order.
+_DATE_LABELS = {
+    'year': lambda bucket: int(bucket['key_as_string'].split('-', 1)[0]),
+    'month': lambda bucket: bucket['key_as_string'][:len('yyyy-mm')],
+    'week': lambda bucket: bucket['key_as_string'][:len('yyyy-mm-dd')],
+    'day': lambda bucket: bucket['key_as_string'][:len('yyyy-mm-dd')],
+}
+
+
+def _date_table(*results, **kwargs):
+    """Merges date histograms (lists of buckets, sorted by date) into rows
+    of (date, count in results[0], count in results[1], ...).
+
+    Dates for which all counts are zero are skipped, as are series without
+    buckets. Takes an ``interval`` keyword argument (default 'year').
+    """
+    date = _DATE_LABELS[kwargs.get('interval', 'year')]
+    results = [buckets for buckets in results if buckets]
 
-    def generate1(buckets):
+    def generate(i, buckets):
         for x in buckets:
             count = x['doc_count']
             if int(count) != 0:
-                yield year(x), x['doc_count']
-
-    def generate2(buckets1, buckets2):
-        for x, y in join(first, generate1(buckets1), first, generate1(buckets2),
-                         left_default=None, right_default=None):
-            if x is None:
-                yield y[0], 0, y[1]
-            elif y is None:
-                yield x[0], x[1], 0
-            else:
-                yield x[0], x[1], y[1]
-
-    if results1 and results2:
-        # XXX looks like toolz.join undoes our nice sort order. Too bad.
-        return sorted(generate2(results1, results2), key=first)
-    elif results1:
-        return generate1(results1)
-    else:
-        return generate1(results2)
+                yield date(x), i, count
+
+    # ES returns the buckets in order, so the series can be merged without
+    # sorting them again.
+    merged = heapq.merge(*[generate(i, buckets)
+                           for i, buckets in enumerate(results)])
+    for date_label, group in groupby(merged, key=first):
+        row = [0] * len(results)
+        for _, i, count in group:
+            row[i] = count
+        yield (date_label,) + tuple(row)
 
 
 @views.route('/api/log_usage', methods=['POST'])
@@ -410,11 +890,18 @@ def log_usage():
         return success
 
     user_id = getattr(current_user, 'id', 'anonymous')  # For LOGIN_DISABLED.
-    bulk(current_app.es_log,
-         _gen_bulk_events(json.loads(request.form['events']),
-                          user_id=user_id,
-                          log_index=current_app.config['ES_LOG_INDEX']),
-         stats_only=True)   # Don't care about errors.
+    with _timed_phase('decode'):
+        events = json.loads(request.form['events'])
+    events = _gen_bulk_events(events, user_id=user_id,
+                              log_index=current_app.config['ES_LOG_INDEX'])
+
+    if current_app.usage_log is not None:
+        current_app.usage_log.put(events)
+    else:
+        _timed_es('bulk', current_app.config['ES_LOG_INDEX'], None,
+                  lambda: bulk(current_app.es_log, events,
+                               stats_only=True),  # Don't care about errors.
+                  client='log')
 
     return success
 
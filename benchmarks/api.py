@@ -0,0 +1,183 @@
+"""Load test of the /api/* endpoints, against a fake Elasticsearch.
+
+Requests are replayed from a file of request patterns (see
+``api_payloads.json``), each with an endpoint, the form data that the
+front-end (``avrapi.js``) sends and a weight. The patterns are drawn at
+random, in proportion to their weights, and sent by a number of concurrent
+clients to the application, which talks to a :class:`FakeESServer` over
+HTTP. The results (throughput and latency percentiles per pattern) can be
+compared to a stored baseline.
+"""
+import json
+import os
+import random
+import threading
+import time
+from Queue import Queue, Empty
+
+from avresearcher import create_app
+
+from .fake_es import FakeESServer
+
+
+__all__ = ['load_patterns', 'run_api_benchmark', 'compare_to_baseline',
+           'format_results']
+
+
+PATTERNS_PATH = os.path.join(os.path.dirname(__file__), 'api_payloads.json')
+
+
+def load_patterns(path=PATTERNS_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def benchmark_settings(es_address, cache=False):
+    """Returns the settings override for the application under test."""
+    es_config = {'hosts': [es_address]}
+    return type('BenchmarkSettings', (object,), {
+        'ES_SEARCH_CONFIG': es_config,
+        'ES_LOG_CONFIG': es_config,
+        'ES_LOG_INDEX': 'avresearcher_benchmark_logs',
+        'LOGIN_DISABLED': True,
+        'SECRET_KEY': 'benchmark',
+        'SEARCH_CACHE_BACKEND': 'local' if cache else None,
+        'SLOW_QUERY_LOG': None,
+        'MAIL_QUEUE_PATH': None,
+        'USAGE_LOG_JOURNAL_PATH': None,
+    })
+
+
+def run_api_benchmark(patterns, n_requests=1000, concurrency=8,
+                      es_latency=.02, es_jitter=.01, cache=False, warmup=1,
+                      seed=0):
+    """Sends ``n_requests`` requests, drawn from ``patterns``, from
+    ``concurrency`` threads. Returns {pattern name: statistics}, plus the
+    statistics of all requests under 'all'."""
+    es_server = FakeESServer(latency=es_latency, jitter=es_jitter,
+                             seed=seed).start()
+    try:
+        app = create_app(settings_override=benchmark_settings(
+            es_server.address, cache))
+
+        # Warm up connections and code paths; not measured.
+        client = app.test_client()
+        for pattern in patterns:
+            for _ in range(warmup):
+                _send(client, pattern)
+
+        rng = random.Random(seed)
+        weighted = [pattern for pattern in patterns
+                    for _ in range(pattern.get('weight', 1))]
+        queue = Queue()
+        for _ in range(n_requests):
+            queue.put(rng.choice(weighted))
+
+        timings = []   # (pattern name, seconds, status code)
+        timings_lock = threading.Lock()
+
+        def worker():
+            client = app.test_client()
+            while True:
+                try:
+                    pattern = queue.get_nowait()
+                except Empty:
+                    return
+
+                start = time.time()
+                status = _send(client, pattern)
+                seconds = time.time() - start
+                with timings_lock:
+                    timings.append((pattern['name'], seconds, status))
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        if app.usage_log is not None:
+            app.usage_log.close()
+    finally:
+        es_server.stop()
+
+    results = {}
+    for name in set(name for name, _, _ in timings):
+        results[name] = _statistics([t for t in timings if t[0] == name],
+                                    elapsed)
+    results['all'] = _statistics(timings, elapsed)
+
+    return results
+
+
+def _send(client, pattern):
+    form = dict((key, value if isinstance(value, basestring)
+                 else json.dumps(value))
+                for key, value in pattern['form'].iteritems())
+    response = client.post(pattern['endpoint'], data=form,
+                           headers={'Accept-Encoding': 'gzip'})
+    # Read streamed responses (exports) completely.
+    response.get_data()
+    return response.status_code
+
+
+def _statistics(timings, elapsed):
+    seconds = sorted(t[1] for t in timings)
+    return {
+        'requests': len(timings),
+        'errors': sum(1 for t in timings if t[2] != 200),
+        'throughput': len(timings) / elapsed,
+        'p50': percentile(seconds, 50),
+        'p95': percentile(seconds, 95),
+        'p99': percentile(seconds, 99),
+    }
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    rank = int(round(p / 100. * len(sorted_values) + .5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def compare_to_baseline(results, baseline, tolerance=.2):
+    """Returns a description of each regression: a latency percentile that
+    is more than ``tolerance`` (a fraction) higher than in the baseline,
+    a throughput that is more than ``tolerance`` lower, or new errors."""
+    regressions = []
+    for name, base in sorted(baseline.iteritems()):
+        current = results.get(name)
+        if current is None:
+            continue
+
+        for stat in ['p50', 'p95', 'p99']:
+            if current[stat] > base[stat] * (1 + tolerance):
+                regressions.append('%s: %s %.1f ms > %.1f ms (baseline)' % (
+                    name, stat, current[stat] * 1000, base[stat] * 1000))
+
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f/s < %.1f/s (baseline)'
+                               % (name, current['throughput'],
+                                  base['throughput']))
+
+        if current['errors'] > base['errors']:
+            regressions.append('%s: %d errors (baseline: %d)'
+                               % (name, current['errors'], base['errors']))
+
+    return regressions
+
+
+def format_results(results):
+    lines = ['%-20s %8s %6s %9s %9s %9s %9s' % ('pattern', 'requests',
+                                                 'errors', 'req/s', 'p50 ms',
+                                                 'p95 ms', 'p99 ms')]
+    for name in sorted(results, key=lambda name: (name == 'all', name)):
+        r = results[name]
+        lines.append('%-20s %8d %6d %9.1f %9.1f %9.1f %9.1f' % (
+            name, r['requests'], r['errors'], r['throughput'],
+            r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+    return '\n'.join(lines)
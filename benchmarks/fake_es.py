@@ -0,0 +1,196 @@
+"""A stand-in for Elasticsearch, for benchmarking the application.
+
+The server answers search, msearch, count, scroll and bulk requests with
+responses of the right shape (hits and the aggregations that were asked
+for), after a configurable delay. It does not store or search anything.
+"""
+import json
+import random
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+
+
+__all__ = ['FakeESServer']
+
+
+class FakeESServer(ThreadingMixIn, HTTPServer):
+    """Serves fake ES responses on ``host:port`` (port 0 picks a free port).
+
+    :param latency: mean delay, in seconds, of each response.
+    :param jitter: max. random deviation from ``latency``, in seconds.
+    :param n_hits: the total number of hits reported for each query.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=.02, jitter=.01,
+                 n_hits=1000, seed=0):
+        HTTPServer.__init__(self, (host, port), FakeESHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.n_hits = n_hits
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._thread = None
+        self._connections = {}   # socket -> thread
+        self._connections_lock = threading.Lock()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def delay(self):
+        with self._random_lock:
+            deviation = self._random.uniform(-self.jitter, self.jitter)
+        return max(0., self.latency + deviation)
+
+    def start(self):
+        """Serves requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='fake-es')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        # Close the kept-alive connections, and wait for their threads.
+        with self._connections_lock:
+            connections = self._connections.items()
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self._connections_lock:
+            self._connections[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # Keep-alive, as the ES client expects
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._respond(200, '')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        path = urlparse(self.path).path.rstrip('/')
+        endpoint = path.rsplit('/', 1)[-1]
+
+        time.sleep(self.server.delay())
+
+        if endpoint == '_msearch':
+            lines = [json.loads(line) for line in body.splitlines() if line]
+            response = {'responses': [self._search(query)
+                                      for query in lines[1::2]]}
+        elif endpoint == '_search':
+            response = self._search(json.loads(body) if body else {})
+            if 'scroll' in self.path:
+                response['_scroll_id'] = 'fake'
+        elif endpoint == 'scroll':
+            # Scrolls are always exhausted after the initial scan request.
+            response = {'_scroll_id': 'fake', 'took': 1,
+                        'hits': {'total': self.server.n_hits, 'hits': []}}
+        elif endpoint == '_count':
+            response = {'count': self.server.n_hits,
+                        '_shards': {'total': 5, 'successful': 5, 'failed': 0}}
+        elif endpoint == '_bulk':
+            n_actions = len([line for line in body.splitlines() if line]) // 2
+            response = {'took': 1, 'errors': False,
+                        'items': [{'create': {'status': 201}}
+                                  for _ in range(n_actions)]}
+        else:
+            response = {'acknowledged': True}
+
+        self._respond(200, json.dumps(response))
+
+    def _search(self, query):
+        size = query.get('size', 10)
+        hits = [{'_index': 'fake', '_type': 'item', '_id': str(i),
+                 '_score': 1.,
+                 'fields': {'title': ['Title %d' % i],
+                            'date': ['2000-01-01T00:00:00']}}
+                for i in range(min(size, self.server.n_hits))]
+
+        return {
+            'took': int(self.server.latency * 1000),
+            'timed_out': False,
+            '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+            'hits': {'total': self.server.n_hits, 'max_score': 1.,
+                     'hits': hits},
+            'aggregations': fake_aggregations(query.get('aggs') or
+                                              query.get('aggregations') or {})
+        }
+
+    def _respond(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def fake_aggregations(aggs):
+    """Returns a response of the right shape for the aggregations in a
+    request."""
+    response = {}
+    for name, spec in aggs.iteritems():
+        result = {}
+        if 'date_histogram' in spec:
+            result['buckets'] = [
+                {'key_as_string': '%d-01-01T00:00:00.000Z' % year,
+                 'key': (year - 1970) * 31556952000, 'doc_count': year % 7}
+                for year in range(1950, 2015)]
+        elif 'terms' in spec or 'significant_terms' in spec:
+            size = (spec.get('terms') or spec.get('significant_terms'))\
+                .get('size', 10)
+            result['buckets'] = [{'key': 'term%d' % i, 'doc_count': 100 - i}
+                                 for i in range(size)]
+        elif 'stats' in spec:
+            result.update({'count': 1000, 'min': -631152000000.,
+                           'max': 1388534400000., 'avg': 378691200000.,
+                           'sum': 3.786912e14})
+        else:
+            # filter, nested, global, ...
+            result['doc_count'] = 1000
+
+        sub_aggs = spec.get('aggs') or spec.get('aggregations')
+        if sub_aggs:
+            result.update(fake_aggregations(sub_aggs))
+        response[name] = result
+
+    return response
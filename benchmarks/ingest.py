@@ -0,0 +1,377 @@
+"""Benchmarks of the ingestion pipeline, on synthetic data.
+
+Each stage is run on its own fixture, so that the cost of reading the
+archives (gzip, tar, JSON), of tokenizing (pattern.nl) and of the gensim
+steps can be told apart:
+
+- ``get_immix_items``, ``get_kb_items``: read a tar.gz archive of items.
+- ``es_format_index_actions``: format the (already read) items as bulk
+  index actions.
+- ``tokenize``: tokenize and lemmatize the subtitles of the iMMix items.
+- ``iter_docs``: read the documents of a token store.
+- ``get_analyzed_items``: read a token store as bags-of-words.
+- ``get_descriptive_terms``: rank the TF-IDF weighted terms of a corpus.
+
+The fixtures are generated from a fixed seed, so runs with the same
+parameters process the same data. Each stage runs in a fresh process, and
+reports its documents/sec, MB/sec (of its input: uncompressed JSON, text,
+or the token store or corpus files) and peak RSS. The peak RSS includes the
+interpreter and the imported modules.
+"""
+import bisect
+import json
+import os
+import random
+import resource
+import tarfile
+import time
+from StringIO import StringIO
+from functools import partial
+from multiprocessing import Pool
+
+
+__all__ = ['STAGES', 'make_fixtures', 'run_ingest_benchmark',
+           'format_results']
+
+
+STAGES = ['get_immix_items', 'get_kb_items', 'es_format_index_actions',
+          'tokenize', 'iter_docs', 'get_analyzed_items',
+          'get_descriptive_terms']
+
+# Stages that need the text analysis requirements, and the fixtures they use
+TEXT_STAGES = ['tokenize', 'iter_docs', 'get_analyzed_items',
+               'get_descriptive_terms']
+CORPUS_STAGES = ['get_analyzed_items', 'get_descriptive_terms']
+
+# progress_cnt that (effectively) disables the progress reports of the
+# text analysis tasks
+NO_PROGRESS = 2 ** 62
+
+# The publication of the synthetic KB archive; get_kb_items derives it from
+# the file name.
+KB_PUBLICATION = 'de-telegraaf'
+
+VOCABULARY_SIZE = 20000
+
+SYLLABLES = ['de', 'ver', 'ge', 'be', 'on', 'aan', 'kom', 'sta', 'huis',
+             'land', 'tijd', 'werk', 'stad', 'regering', 'nie', 'uw', 'wat',
+             'gen', 'heid', 'ing', 'lijk', 'schap', 'er', 'en', 'te', 'ne',
+             'ma', 'ri', 'vo', 'lu', 'po', 'kra', 'vla', 'ster']
+
+
+class Words(object):
+    """Draws words from a synthetic vocabulary with a Zipfian frequency
+    distribution, like the words in natural language."""
+
+    def __init__(self, rng, size=VOCABULARY_SIZE):
+        self.rng = rng
+        vocabulary = set()
+        while len(vocabulary) < size:
+            vocabulary.add(''.join(rng.choice(SYLLABLES)
+                                   for _ in range(rng.randint(1, 4))))
+        self.vocabulary = sorted(vocabulary)
+        rng.shuffle(self.vocabulary)
+
+        self.cumulative = []
+        total = 0.
+        for rank in range(1, size + 1):
+            total += 1. / rank
+            self.cumulative.append(total)
+
+    def sample(self, n):
+        total = self.cumulative[-1]
+        return [self.vocabulary[bisect.bisect(self.cumulative,
+                                              self.rng.random() * total)]
+                for _ in range(n)]
+
+    def text(self, n):
+        """Returns a text of ``n`` words, in sentences."""
+        words = self.sample(n)
+        sentences = []
+        while words:
+            length = self.rng.randint(5, 20)
+            sentence, words = words[:length], words[length:]
+            sentences.append(' '.join(sentence).capitalize() + '.')
+        return u' '.join(sentences)
+
+
+def _date(rng, start_year):
+    return '%d-%02d-%02d' % (rng.randint(start_year, 2014),
+                             rng.randint(1, 12), rng.randint(1, 28))
+
+
+def immix_item(n, words, words_per_doc):
+    rng = words.rng
+    date = _date(rng, 1950) + 'T20:00:00'
+    title = words.text(rng.randint(2, 6))
+    return {
+        'title': title,
+        'date': date,
+        'meta': {
+            'expressieID': str(n),
+            'mainTitle': title,
+            'titles': [title],
+            'broadcasters': [rng.choice(['NOS', 'VARA', 'KRO', 'AVRO'])],
+            'broadcastdates': [{'start': date, 'end': date}],
+            'categories': [{'key': 'genre', 'value': 'nieuws'}],
+            'summaries': [words.text(30)],
+            'descriptions': [words.text(30)],
+            'subtitles': words.text(words_per_doc),
+        }
+    }
+
+
+def kb_item(n, words, words_per_doc):
+    rng = words.rng
+    return {
+        'title': words.text(rng.randint(2, 8)),
+        'date': _date(rng, 1900),
+        'text': words.text(words_per_doc),
+        'source': 'http://resolver.kb.nl/resolve?urn=synthetic:%d' % n,
+        '_meta': {
+            'article_type': rng.choice(['artikel', 'advertentie',
+                                        'familiebericht']),
+            'record_identifier': str(n),
+        }
+    }
+
+
+def make_archive(path, member_dir, make_item, n_docs, words, words_per_doc):
+    """Writes ``n_docs`` items as JSON members of a tar.gz archive. Returns
+    the total (uncompressed) size of the members."""
+    n_bytes = 0
+    with tarfile.open(path, 'w:gz') as tar:
+        for n in xrange(n_docs):
+            data = json.dumps(make_item(n, words, words_per_doc))
+            info = tarfile.TarInfo('%s/_%09d.json' % (member_dir, n))
+            info.size = len(data)
+            info.mtime = 0
+            tar.addfile(info, StringIO(data))
+            n_bytes += len(data)
+    return n_bytes
+
+
+def make_token_store(path, n_docs, words, words_per_doc):
+    from text_analysis.token_store import TokenStore
+
+    store = TokenStore(path)
+    with store.writer('000000000') as shard:
+        for n in xrange(n_docs):
+            shard.add('_%09d.json' % n, words.sample(words_per_doc))
+
+
+def make_fixtures(workdir, n_docs=10000, words_per_doc=300, seed=0,
+                  stages=STAGES):
+    """Generates the fixtures of ``stages`` in ``workdir``. Fixtures that
+    were generated with the same parameters before are reused.
+
+    Returns {fixture name: {'path': ..., 'bytes': ...}}, where 'bytes' is
+    the uncompressed size of an archive; 'corpus' holds the paths of the
+    dictionary, corpus and model.
+    """
+    manifest_path = os.path.join(workdir, 'fixtures.json')
+    params = {'n_docs': n_docs, 'words_per_doc': words_per_doc,
+              'seed': seed}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except IOError:
+        manifest = None
+    if manifest is None or manifest['params'] != params:
+        manifest = {'params': params, 'fixtures': {}}
+    fixtures = manifest['fixtures']
+
+    def generate(name, path, make, *args):
+        if name in fixtures and os.path.exists(path):
+            return False
+        print 'Generating %s' % path
+        # Each fixture has its own random state, so it doesn't depend on
+        # the other fixtures that are generated.
+        words = Words(random.Random('%s-%d' % (name, seed)))
+        fixtures[name] = {'path': path,
+                          'bytes': make(*(args + (words, words_per_doc)))}
+        return True
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    if set(stages) & set(['get_immix_items', 'es_format_index_actions',
+                          'tokenize']):
+        generate('immix', os.path.join(workdir, 'immix.tar.gz'),
+                 make_archive, os.path.join(workdir, 'immix.tar.gz'),
+                 'immix', immix_item, n_docs)
+    if 'get_kb_items' in stages:
+        path = os.path.join(workdir, KB_PUBLICATION + '.tar.gz')
+        generate('kb', path, make_archive, path, 'kb', kb_item, n_docs)
+
+    if set(stages) & set(TEXT_STAGES[1:]):
+        path = os.path.join(workdir, 'tokens')
+        if generate('tokens', path, make_token_store, path, n_docs):
+            fixtures.pop('corpus', None)
+
+    if set(stages) & set(CORPUS_STAGES) and 'corpus' not in fixtures:
+        print 'Generating the dictionary, corpus and TF-IDF model'
+        fixtures['corpus'] = make_corpus(fixtures['tokens']['path'],
+                                         workdir)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return fixtures
+
+
+def make_corpus(token_store_path, workdir):
+    from gensim.corpora import Dictionary, MmCorpus
+    from gensim.models.tfidfmodel import TfidfModel
+    from text_analysis import tasks
+
+    paths = {'dictionary': os.path.join(workdir, 'dictionary'),
+             'corpus': os.path.join(workdir, 'corpus.mm'),
+             'model': os.path.join(workdir, 'tfidf_model')}
+
+    Dictionary(tasks.iter_docs(token_store_path, progress_cnt=NO_PROGRESS))\
+        .save(paths['dictionary'])
+    corpus = tasks.Corpus(token_store_path, paths['dictionary'])
+    MmCorpus.serialize(paths['corpus'], corpus.get_analyzed_items(
+        doc2bow=True, progress_cnt=NO_PROGRESS))
+    TfidfModel(MmCorpus(paths['corpus'])).save(paths['model'])
+
+    return paths
+
+
+# Stages. Each returns the iterable that is timed (it is consumed by the
+# benchmark) and the size of its input in bytes; their setup is not timed.
+
+def read_archive(fixtures, readers, collection):
+    return readers[collection](fixtures[collection]['path']), \
+        fixtures[collection]['bytes']
+
+
+def format_actions(fixtures, readers):
+    items = list(readers['immix'](fixtures['immix']['path']))
+    return readers['format'](readers['index_name'], 'item', items), \
+        fixtures['immix']['bytes']
+
+
+def tokenize_texts(fixtures, readers):
+    from text_analysis.tasks import extract_immix_subtitles, tokenize
+
+    texts = [extract_immix_subtitles(item)
+             for _, item in filter(None, readers['immix'](
+                 fixtures['immix']['path']))]
+    n_bytes = sum(len(text.encode('utf-8')) for text in texts)
+    return (list(tokenize(text)) for text in texts), n_bytes
+
+
+def iter_docs(fixtures, readers):
+    from text_analysis import tasks
+
+    path = fixtures['tokens']['path']
+    return tasks.iter_docs(path, progress_cnt=NO_PROGRESS), _du(path)
+
+
+def get_analyzed_items(fixtures, readers):
+    from text_analysis import tasks
+
+    corpus = tasks.Corpus(fixtures['tokens']['path'],
+                          fixtures['corpus']['dictionary'])
+    return corpus.get_analyzed_items(doc2bow=True,
+                                     progress_cnt=NO_PROGRESS), \
+        _du(fixtures['tokens']['path'])
+
+
+def get_descriptive_terms(fixtures, readers):
+    from text_analysis import tasks
+
+    paths = fixtures['corpus']
+    corpus = tasks.Corpus(fixtures['tokens']['path'], paths['dictionary'],
+                          paths['corpus'], paths['model'])
+    return corpus.get_descriptive_terms(10, progress_cnt=NO_PROGRESS), \
+        _du(paths['corpus'])
+
+
+STAGE_FUNCTIONS = {
+    'get_immix_items': partial(read_archive, collection='immix'),
+    'get_kb_items': partial(read_archive, collection='kb'),
+    'es_format_index_actions': format_actions,
+    'tokenize': tokenize_texts,
+    'iter_docs': iter_docs,
+    'get_analyzed_items': get_analyzed_items,
+    'get_descriptive_terms': get_descriptive_terms,
+}
+
+
+def _du(path):
+    # Size in bytes of a file, or of the files in a directory.
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def run_stage(stage, fixtures, readers):
+    """Runs a stage; meant to be called in a fresh process. Returns its
+    statistics."""
+    iterable, n_bytes = STAGE_FUNCTIONS[stage](fixtures, readers)
+
+    start = time.time()
+    n_docs = sum(1 for doc in iterable if doc is not None)
+    seconds = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {
+        'docs': n_docs,
+        'seconds': seconds,
+        'docs_per_sec': n_docs / seconds if seconds else None,
+        'mb_per_sec': n_bytes / seconds / 2 ** 20 if seconds else None,
+        'peak_rss_mb': peak_rss / 2. ** 20,
+    }
+
+
+def _in_subprocess(func, *args):
+    pool = Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_ingest_benchmark(workdir, readers, n_docs=10000, words_per_doc=300,
+                         stages=STAGES, seed=0):
+    """Runs ``stages`` on fixtures of ``n_docs`` documents of
+    ``words_per_doc`` words, stored in ``workdir``.
+
+    ``readers`` holds the functions under test that are defined by
+    ``manage.py``: 'immix' and 'kb' (get_immix_items and get_kb_items),
+    'format' (es_format_index_actions) and the 'index_name' passed to it.
+
+    Returns a list of (stage, statistics) pairs.
+    """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError('unknown stages: %s' % ', '.join(sorted(unknown)))
+
+    # Generate the fixtures in a subprocess as well, to keep this process
+    # (which the stage processes are forked from) small.
+    fixtures = _in_subprocess(make_fixtures, workdir, n_docs, words_per_doc,
+                              seed, stages)
+
+    results = []
+    for stage in [stage for stage in STAGES if stage in stages]:
+        results.append((stage, _in_subprocess(run_stage, stage, fixtures,
+                                               readers)))
+    return results
+
+
+def format_results(results):
+    lines = ['%-24s %8s %9s %10s %9s %12s' % ('stage', 'docs', 'seconds',
+                                              'docs/sec', 'MB/sec',
+                                              'peak RSS MB')]
+    for stage, r in results:
+        lines.append('%-24s %8d %9.2f %10.1f %9.2f %12.1f' % (
+            stage, r['docs'], r['seconds'], r['docs_per_sec'] or 0,
+            r['mb_per_sec'] or 0, r['peak_rss_mb']))
+    return '\n'.join(lines)
@@ -3,19 +3,30 @@ import logging
 import json
 import os
 import re
+import sys
 import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from glob import glob
+from functools import partial
+from multiprocessing import Lock, Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Event, Semaphore
 
 import click
 from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import TransportError
-from elasticsearch.helpers import bulk
+from elasticsearch.exceptions import ConnectionError, TransportError
+from elasticsearch.helpers import bulk, expand_action
 
 from avresearcher import create_app
 from avresearcher.extensions import bcrypt, db
 from avresearcher.models import User
 from avresearcher.settings import ES_SEARCH_CONFIG
+from avresearcher.stats import (compute_collection_stats,
+                                invalidate_collection_stats,
+                                save_collection_stats)
 
 
 logging.getLogger('elasticsearch').setLevel(logging.INFO)
@@ -56,6 +67,107 @@ def runserver(host, port, debug):
     app.run(host=host, port=port, debug=debug, use_reloader=True)
 
 
+@cli.command()
+@click.option('--host', default='0.0.0.0',
+              help='Host to bind to, defaults to 0.0.0.0')
+@click.option('--port', default=5000,
+              help='Port to listen on, defaults to 5000')
+@click.option('--socket', default=None,
+              help='Listen on this uwsgi protocol socket (e.g. for nginx\'s'
+                   ' uwsgi_pass) instead of HTTP')
+@click.option('--workers', default=cpu_count(),
+              help='Number of worker processes, defaults to the number of'
+                   ' cores')
+@click.option('--threads', default=4, help='Number of threads per worker')
+@click.option('--gevent', 'gevent_cores', default=0,
+              help='Serve this many concurrent requests per worker with'
+                   ' gevent, instead of threads (requires gevent)')
+@click.option('--timeout', default=60,
+              help='Number of seconds after which a request is aborted (and'
+                   ' its worker restarted)')
+@click.option('--max-requests', default=10000,
+              help='Number of requests after which a worker is restarted')
+@click.argument('uwsgi_args', nargs=-1)
+def serve(host, port, socket, workers, threads, gevent_cores, timeout,
+          max_requests, uwsgi_args):
+    """Run the application with uWSGI
+
+    Starts --workers processes with --threads threads each. Each worker
+    loads wsgi.py, which opens ES_WARM_UP_CONNECTIONS connections to the
+    Elasticsearch nodes before the worker accepts requests. HTTP clients
+    may keep their connections open between requests.
+
+    With --gevent N, each worker serves up to N requests concurrently as
+    greenlets. Network I/O of pure Python code (Elasticsearch, SMTP)
+    doesn't block the worker then, so many slow searches can be in flight
+    at once. Database calls through a C driver, like MySQLdb, do block all
+    greenlets of the worker; use a pure Python driver (e.g. PyMySQL, with
+    a mysql+pymysql:// SQLALCHEMY_DATABASE_URI) if that matters.
+
+    UWSGI_ARGS are passed to uWSGI; separate them with --, e.g.
+    './manage.py serve -- --stats 127.0.0.1:9191'.
+    """
+    if gevent_cores:
+        try:
+            import gevent
+        except ImportError:
+            raise click.ClickException('--gevent requires gevent; install it'
+                                       ' with pip install gevent')
+
+    app = create_app()
+    maxsize = dict(app.config['ES_CONNECTION_DEFAULTS'],
+                   **app.config['ES_SEARCH_CONFIG']).get('maxsize', 10)
+    if maxsize < (gevent_cores or threads):
+        click.echo('Warning: the ES connection pool (maxsize=%d) is smaller'
+                   ' than the number of concurrent requests per worker; see'
+                   ' ES_CONNECTION_DEFAULTS' % maxsize, file=sys.stderr)
+
+    args = ['uwsgi', '--master', '--need-app', '--die-on-term',
+            # Load the application in each worker, after forking, so that
+            # each has its own (warmed up) ES connections.
+            '--lazy-apps',
+            '--module', 'wsgi:app',
+            '--chdir', os.path.dirname(os.path.abspath(__file__)),
+            '--processes', str(workers),
+            '--harakiri', str(timeout), '--max-requests', str(max_requests)]
+    if gevent_cores:
+        args += ['--gevent', str(gevent_cores), '--gevent-monkey-patch']
+    else:
+        args += ['--threads', str(threads)]
+    if socket:
+        args += ['--socket', socket]
+    else:
+        args += ['--http', '%s:%d' % (host, port), '--http-keepalive',
+                 '--add-header', 'Connection: Keep-Alive']
+    args += list(uwsgi_args)
+
+    try:
+        os.execvp(args[0], args)
+    except OSError as e:
+        raise click.ClickException('Cannot start uWSGI (%s); install it with'
+                                   ' pip install -r requirements.txt' % e)
+
+
+@cli.command()
+@click.option('--host', default='localhost',
+              help='Host to bind to, defaults to localhost')
+@click.option('--port', default=1025,
+              help='Port of the SMTP server, defaults to 1025')
+def smtp_server(host, port):
+    """Start a local SMTP server for testing
+
+    Prints the messages it receives instead of delivering them. Set
+    MAIL_SERVER and MAIL_PORT to use it.
+    """
+    from avresearcher.jobs import LocalSMTPServer
+
+    click.echo('Listening for SMTP on %s:%d' % (host, port))
+    try:
+        LocalSMTPServer(host, port, echo=True).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
 @cli.command()
 def init_db():
     """Creates all required database tables"""
@@ -146,7 +258,28 @@ def es_create_indexes(mapping_dir, mapping_prefix):
 @elasticsearch.command('index_collection')
 @click.argument('name')
 @click.argument('files', nargs=-1, type=click.Path(exists=True, resolve_path=True))
-def es_index_collection(name, files):
+@click.option('--workers', default=1,
+              help='Number of processes that read archives in parallel')
+@click.option('--threads-per-worker', default=1,
+              help='Number of concurrent bulk requests per process')
+@click.option('--chunk-size', default=500,
+              help='Max. number of documents per bulk request')
+@click.option('--max-chunk-bytes', default=100 * 1024 * 1024,
+              help='Max. size of a bulk request in bytes')
+@click.option('--checkpoint', default=None,
+              help='File that records the indexing progress, defaults to'
+                   ' NAME.checkpoint.json')
+@click.option('--dead-letter', default=None,
+              help='File that failed documents are written to, defaults to'
+                   ' NAME.dead_letter.jsonl')
+@click.option('--resume', is_flag=True,
+              help='Skip the documents that were indexed according to the'
+                   ' checkpoint file')
+@click.option('--bulk-load-settings', is_flag=True,
+              help='Disable refreshes and replicas while indexing')
+def es_index_collection(name, files, workers, threads_per_worker, chunk_size,
+                        max_chunk_bytes, checkpoint, dead_letter, resume,
+                        bulk_load_settings):
     """Index a given collection
 
     NAME corresponds to the name of the Elasticsearch index, FILES should
@@ -156,22 +289,97 @@ def es_index_collection(name, files):
     Currently NAME can take the following values:
     - avresearcher_immix
     - avresearcher_kb
+
+    Each archive is read by one of --workers processes, which sends the
+    documents to Elasticsearch over --threads-per-worker connections.
+
+    The number of archive members that have been indexed is recorded in the
+    checkpoint file; after a crash, rerun the same command with --resume to
+    continue where it stopped. Documents that Elasticsearch rejects are
+    written to the dead letter file instead of aborting the run. Bulk
+    requests that fail as a whole (e.g. when the cluster is unreachable)
+    are retried a few times, after which the run is aborted.
+
+    With --bulk-load-settings, the index is not refreshed and has no
+    replicas while indexing; the original settings are restored afterwards,
+    also when indexing fails.
     """
-    if name == 'avresearcher_immix':
-        item_getter = get_immix_items
-    elif name == 'avresearcher_kb':
-        item_getter = get_kb_items
-    else:
-        pass
+    if name not in ITEM_GETTERS:
+        raise click.BadParameter('unknown collection %s' % name)
+
+    checkpoint = checkpoint or '%s.checkpoint.json' % name
+    dead_letter = dead_letter or '%s.dead_letter.jsonl' % name
+
+    progress = load_checkpoint(checkpoint) if resume else {}
+    save_checkpoint(checkpoint, progress)
 
+    tasks = []
     for f in files:
-        actions = es_format_index_actions(name, 'item', item_getter(f))
-        bulk(es, actions=actions)
+        state = progress.get(f, {})
+        if state.get('done'):
+            click.echo('Skipping %s, already indexed' % f)
+        else:
+            tasks.append((f, state.get('members', 0)))
+
+    index = partial(index_archive, name=name, chunk_size=chunk_size,
+                    max_chunk_bytes=max_chunk_bytes,
+                    n_threads=threads_per_worker,
+                    checkpoint_path=checkpoint, dead_letter_path=dead_letter)
+
+    with index_settings(name, bulk_load_settings):
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_index_worker)
+            results = pool.imap_unordered(index, tasks)
+        else:
+            pool = None
+            results = (index(task) for task in tasks)
+
+        start = time.time()
+        total_docs = total_bytes = 0
+        for archive_path, n_docs, n_failed, n_bytes in results:
+            total_docs += n_docs
+            total_bytes += n_bytes
+            elapsed = time.time() - start
+
+            click.echo('Indexed %d documents from %s (%d failed); %.1f'
+                       ' docs/sec, %.1f MB/sec overall'
+                       % (n_docs, archive_path, n_failed, total_docs / elapsed,
+                          total_bytes / elapsed / 2 ** 20))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # The collection statistics are out of date now
+    invalidate_collection_stats(create_app().config['COLLECTION_STATS_PATH'])
 
 
-def get_immix_items(archive_path):
+@elasticsearch.command('compute_stats')
+def es_compute_stats():
+    """Precompute the collection statistics
+
+    The statistics are stored in the file set by COLLECTION_STATS_PATH.
+    Run this periodically (e.g. from cron) to keep the statistics on the
+    'about' page up-to-date.
+    """
+    app = create_app()
+    path = app.config['COLLECTION_STATS_PATH']
+    save_collection_stats(compute_collection_stats(app.es_search, app.config),
+                          path)
+
+    click.echo('Stored collection statistics in %s' % path)
+
+
+def get_immix_items(archive_path, skip=0):
+    """Yields (doc_id, item) for each member of the archive, or None for
+    members that should not be indexed. The first ``skip`` members are not
+    read."""
     with tarfile.open(archive_path, 'r:gz') as tar:
-        for immix_file in tar:
+        for n, immix_file in enumerate(tar):
+            if n < skip:
+                tar.members = []
+                continue
+
             f = tar.extractfile(immix_file)
             expression = json.load(f)
             doc_id = immix_file.name.split('/')[-1].split('.')[0].lstrip('_')
@@ -179,7 +387,7 @@ def get_immix_items(archive_path):
             # Skip items that don't include a date
             if not expression['date']:
                 logger.warn('Skipping iMMix item %s, unknown date' % doc_id)
-                continue
+                yield None
             else:
                 yield doc_id, expression
 
@@ -189,7 +397,10 @@ def get_immix_items(archive_path):
             tar.members = []
 
 
-def get_kb_items(archive_path):
+def get_kb_items(archive_path, skip=0):
+    """Yields (doc_id, item) for each member of the archive, or None for
+    members that should not be indexed. The first ``skip`` members are not
+    read."""
     min_date = datetime.strptime('1900-01-01', '%Y-%m-%d')
     publication_name = re.findall(r'.*\/(.*)\.tar.gz$', archive_path)[0]
 
@@ -208,7 +419,11 @@ def get_kb_items(archive_path):
     publication_name = publications[publication_name]
 
     with tarfile.open(archive_path, 'r:gz') as tar:
-        for kb_file in tar:
+        for n, kb_file in enumerate(tar):
+            if n < skip:
+                tar.members = []
+                continue
+
             f = tar.extractfile(kb_file)
             doc_id = kb_file.name.split('/')[-1].split('.')[0]
 
@@ -233,32 +448,340 @@ def get_kb_items(archive_path):
             tar.members = []
 
 
+# Settings applied to an index while bulk loading, see index_settings
+BULK_LOAD_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': 0,
+}
+
+# ES defaults, restored when an index didn't set these explicitly
+DEFAULT_INDEX_SETTINGS = {
+    'index.refresh_interval': '1s',
+    'index.number_of_replicas': 1,
+}
+
+
+@contextmanager
+def index_settings(index_name, bulk_load=True):
+    """Applies BULK_LOAD_SETTINGS to the index (or to all indexes an alias
+    points to) for the duration of the block.
+
+    The original settings are restored when the block exits, also when it
+    raises. After a successful load the index is refreshed and optimized
+    (merged); the merge of a large index takes long, so it is not waited
+    for.
+    """
+    if not bulk_load:
+        yield
+        return
+
+    saved = {}
+    current = es.indices.get_settings(index=index_name, flat_settings=True)
+    for index, index_config in current.iteritems():
+        saved[index] = dict((key, index_config['settings'].get(key, default))
+                            for key, default in
+                            DEFAULT_INDEX_SETTINGS.iteritems())
+
+        click.echo('Applying bulk load settings to %s' % index)
+        es.indices.put_settings(index=index, body=BULK_LOAD_SETTINGS)
+
+    try:
+        yield
+    finally:
+        for index, settings in saved.iteritems():
+            click.echo('Restoring settings of %s' % index)
+            es.indices.put_settings(index=index, body=settings)
+
+    for index in saved:
+        es.indices.refresh(index=index)
+        es.indices.optimize(index=index, wait_for_merge=False)
+        click.echo('Optimizing %s; the merge continues in the background'
+                   % index)
+
+
+ITEM_GETTERS = {
+    'avresearcher_immix': get_immix_items,
+    'avresearcher_kb': get_kb_items,
+}
+
+
+def _init_index_worker():
+    # Worker processes should not share the parent's connections.
+    global es
+    es = Elasticsearch(**ES_SEARCH_CONFIG)
+
+
+# Serializes writes to the checkpoint and dead letter files by the indexing
+# processes and threads.
+index_lock = Lock()
+
+
+def index_archive(task, name, chunk_size, max_chunk_bytes, n_threads,
+                  checkpoint_path, dead_letter_path):
+    """Indexes the items in a single archive, starting at a member offset.
+
+    ``task`` is an (archive path, offset) pair. Progress is recorded in the
+    checkpoint file each time a chunk and all chunks before it are done.
+
+    Returns the archive's path, the number of indexed and failed documents
+    and the number of bytes sent.
+    """
+    archive_path, start = task
+
+    items = enumerate(ITEM_GETTERS[name](archive_path, skip=start), start)
+    actions = ((n, es_format_index_action(name, 'item', item) if item else None)
+               for n, item in items)
+    chunks = enumerate(chunk_bulk_actions(actions, es.transport.serializer,
+                                          chunk_size, max_chunk_bytes))
+
+    def send(seq_chunk):
+        seq, (offset, chunk) = seq_chunk
+        return (seq, offset) + send_bulk_chunk(chunk, archive_path,
+                                               dead_letter_path)
+
+    if n_threads == 1:
+        results = (send(chunk) for chunk in chunks)
+    else:
+        # Limit the number of chunks that are read ahead of the bulk
+        # requests; ThreadPool consumes its input as fast as it can.
+        pending = Semaphore(2 * n_threads)
+        stopped = Event()
+
+        def bounded(chunks):
+            for chunk in chunks:
+                pending.acquire()
+                if stopped.is_set():
+                    return
+                yield chunk
+
+        def send_bounded(seq_chunk):
+            try:
+                return send(seq_chunk)
+            finally:
+                pending.release()
+
+        thread_pool = ThreadPool(n_threads)
+        results = thread_pool.imap_unordered(send_bounded, bounded(chunks))
+
+    n_docs = n_failed = n_bytes = 0
+    # Offsets of the chunks that are done, but that can't be checkpointed
+    # because a preceding chunk is still in flight.
+    done = {}
+    next_seq = 0
+    try:
+        for seq, offset, n_ok, n_errors, size in results:
+            n_docs += n_ok
+            n_failed += n_errors
+            n_bytes += size
+
+            done[seq] = offset
+            if next_seq in done:
+                while next_seq in done:
+                    offset = done.pop(next_seq)
+                    next_seq += 1
+                update_checkpoint(checkpoint_path, archive_path,
+                                  {'members': offset, 'done': False})
+    except:
+        # A chunk could not be sent; the checkpoint stays before it, so
+        # that --resume sends it again.
+        if n_threads != 1:
+            stopped.set()
+            pending.release()  # In case bounded() is waiting
+            thread_pool.terminate()
+        raise
+
+    if n_threads != 1:
+        thread_pool.close()
+        thread_pool.join()
+
+    update_checkpoint(checkpoint_path, archive_path, {'done': True})
+
+    return archive_path, n_docs, n_failed, n_bytes
+
+
+def chunk_bulk_actions(actions, serializer, chunk_size, max_chunk_bytes):
+    """Serializes the actions and groups them into chunks of at most
+    ``chunk_size`` actions and (unless a single action is larger)
+    ``max_chunk_bytes`` bytes.
+
+    ``actions`` is an iterable of (member offset, action or None) pairs.
+    Yields (offset of the next member, chunk) pairs, where a chunk is a
+    list with the serialized lines of each action.
+    """
+    chunk = []
+    chunk_bytes = 0
+    offset = None
+    for n, action in actions:
+        if action is not None:
+            lines = [serializer.dumps(line) for line in expand_action(action)
+                     if line is not None]
+            size = sum(len(line) + 1 for line in lines)
+
+            if chunk and (len(chunk) == chunk_size
+                          or chunk_bytes + size > max_chunk_bytes):
+                yield offset, chunk
+                chunk = []
+                chunk_bytes = 0
+
+            chunk.append(lines)
+            chunk_bytes += size
+
+        offset = n + 1
+
+    # This chunk may be empty, if the last members were skipped.
+    if offset is not None:
+        yield offset, chunk
+
+
+# Bulk requests that fail as a whole (e.g. because the cluster is down or
+# overloaded) are retried this many times, after BULK_RETRY_DELAY seconds,
+# doubling the delay after each attempt
+BULK_MAX_RETRIES = 5
+BULK_RETRY_DELAY = 2
+
+# Status codes of bulk requests that are worth retrying
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+def send_bulk_chunk(chunk, archive_path, dead_letter_path):
+    """Sends a chunk of serialized actions. Actions that ES rejects are
+    written to the dead letter file, with the error.
+
+    Requests that fail as a whole are retried (see BULK_MAX_RETRIES); if
+    they keep failing, or fail for another reason than a connection error
+    or an overloaded cluster, the TransportError is raised, so that the
+    chunk isn't checkpointed.
+
+    Returns the number of successful and failed actions and the size of the
+    request in bytes.
+    """
+    if not chunk:
+        return 0, 0, 0
+
+    body = '\n'.join(line for lines in chunk for line in lines) + '\n'
+    for attempt in xrange(BULK_MAX_RETRIES + 1):
+        try:
+            response = es.bulk(body=body)
+            break
+        except TransportError as e:
+            retry = isinstance(e, ConnectionError)\
+                or e.status_code in RETRY_STATUS_CODES
+            if not retry or attempt == BULK_MAX_RETRIES:
+                raise
+
+            delay = BULK_RETRY_DELAY * 2 ** attempt
+            logger.warning('Bulk request for %s failed (%s), retrying in %d'
+                           ' seconds' % (archive_path, e, delay))
+            time.sleep(delay)
+
+    results = [item.values()[0] for item in response['items']]
+    failed = [{'archive': archive_path, 'error': result.get('error'),
+               'action': lines}
+              for lines, result in zip(chunk, results)
+              if not 200 <= result.get('status', 500) < 300]
+
+    if failed:
+        with index_lock:
+            with open(dead_letter_path, 'a') as f:
+                for entry in failed:
+                    f.write(json.dumps(entry) + '\n')
+
+    return len(chunk) - len(failed), len(failed), len(body)
+
+
+def load_checkpoint(checkpoint_path):
+    """Returns the indexing progress per archive path."""
+    try:
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def save_checkpoint(checkpoint_path, progress):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.rename(tmp_path, checkpoint_path)
+
+
+def update_checkpoint(checkpoint_path, archive_path, state):
+    with index_lock:
+        progress = load_checkpoint(checkpoint_path)
+        progress[archive_path] = state
+        save_checkpoint(checkpoint_path, progress)
+
+
 @cli.group()
 def analyze_text():
     pass
 
 
 @analyze_text.command()
-@click.argument('role', type=click.Choice(['producer', 'consumer']))
-@click.argument('file_path')
-@click.argument('text_extractor')
-@click.option('--socket_addr', default='tcp://127.0.0.1:5557')
-def tokenize(role, file_path, socket_addr, text_extractor):
+@click.argument('items_path')
+@click.argument('tokenized_items_path')
+@click.argument('text_extractor', type=click.Choice(['kb_text',
+                                                     'immix_subtitles',
+                                                     'immix_summaries']))
+@click.option('--workers', default=None, type=click.INT,
+              help='Number of tokenizer processes, defaults to the number'
+                   ' of cores')
+@click.option('--chunk_size', default=10000,
+              help='Number of items per unit of work (and per shard)')
+@click.option('--lemma_cache', default=None,
+              help='SQLite file that caches the parsed sentences, so that'
+                   ' repeated sentences (and re-runs) are not parsed again')
+@click.option('--lemma_cache_size', default=5000000,
+              help='Max. number of sentences kept in the lemma cache')
+def tokenize(items_path, tokenized_items_path, text_extractor, workers,
+             chunk_size, lemma_cache, lemma_cache_size):
+    """Tokenize and lemmatize the text of a collection
+
+    ITEMS_PATH is a glob pattern matching the JSON files of the items.
+    The tokens are stored in the token store (directory)
+    TOKENIZED_ITEMS_PATH.
+    """
     from text_analysis import tasks
 
-    if role == 'producer':
-        tasks.tokenize_producer(socket_addr, file_path, text_extractor)
-    else:
-        tasks.tokenize_consumer(socket_addr, file_path)
+    tasks.tokenize_items(items_path, tokenized_items_path, text_extractor,
+                         workers, chunk_size,
+                         lemma_cache_path=lemma_cache,
+                         lemma_cache_size=lemma_cache_size)
+
+
+@analyze_text.command()
+@click.argument('token_files_path')
+@click.argument('tokenized_items_path')
+def pack_tokens(token_files_path, tokenized_items_path):
+    """Convert files with one token per line into a token store
+
+    TOKEN_FILES_PATH is a glob pattern matching the files, or tar.gz
+    archives of these files.
+    """
+    from text_analysis import tasks
+
+    print tasks.pack_token_files(token_files_path, tokenized_items_path)
 
 
 @analyze_text.command()
 @click.argument('analyzed_items_path')
 @click.argument('dictionary_path')
-def create_dictionary(analyzed_items_path, dictionary_path):
+@click.option('--workers', default=1,
+              help='Number of processes that build dictionaries of the'
+                   ' token store shards')
+@click.option('--no_below', default=None, type=click.INT)
+@click.option('--no_above', default=None, type=click.FLOAT)
+@click.option('--keep_n', default=None, type=click.INT)
+@click.option('--prune_at', default=2000000,
+              help='Max. number of tokens kept in a dictionary while'
+                   ' building it')
+def create_dictionary(analyzed_items_path, dictionary_path, workers, no_below,
+                      no_above, keep_n, prune_at):
     from text_analysis import tasks
 
-    print tasks.create_dictionary(analyzed_items_path, dictionary_path)
+    print tasks.create_dictionary(analyzed_items_path, dictionary_path,
+                                  workers, no_below, no_above, keep_n,
+                                  prune_at)
 
 
 @analyze_text.command()
@@ -306,6 +829,30 @@ def construct_tfidf_model(corpus_path, model_path):
     corpus.construct_tfidf_model(model_path)
 
 
+@analyze_text.command()
+@click.argument('analyzed_items_path')
+@click.argument('dictionary_path')
+@click.argument('corpus_path')
+@click.argument('model_path')
+@click.option('--updated_model_path', default=None,
+              help='Where to save the updated model, defaults to MODEL_PATH')
+def update_tfidf_model(analyzed_items_path, dictionary_path, corpus_path,
+                       model_path, updated_model_path):
+    """Add newly analyzed items to an existing TF-IDF model
+
+    The items in ANALYZED_ITEMS_PATH are serialized to a new corpus at
+    CORPUS_PATH with the existing dictionary, and their document
+    frequencies are added to the model at MODEL_PATH.
+    """
+    from text_analysis import tasks
+
+    corpus = tasks.Corpus(analyzed_items_path=analyzed_items_path,
+                          dictionary_path=dictionary_path,
+                          tfidf_model_path=model_path)
+    print corpus.update_tfidf_model(corpus_path,
+                                    updated_model_path or model_path)
+
+
 @analyze_text.command()
 @click.argument('analyzed_items_path')
 @click.argument('dictionary_path')
@@ -314,16 +861,39 @@ def construct_tfidf_model(corpus_path, model_path):
 @click.argument('index')
 @click.argument('field')
 @click.argument('top_n_terms', type=click.INT)
+@click.option('--bulk-load-settings', is_flag=True,
+              help='Disable refreshes and replicas while indexing')
+@click.option('--stopwords', default=None, type=click.File('rb'),
+              help='File with terms (one per line) that should not be used'
+                   ' as descriptive terms')
 def index_descriptive_terms(analyzed_items_path, dictionary_path, corpus_path,
-                            model_path, index, field, top_n_terms):
+                            model_path, index, field, top_n_terms,
+                            bulk_load_settings, stopwords):
     from text_analysis import tasks
 
+    if stopwords is None:
+        stopwords = tasks.STOPWORDS
+    else:
+        stopwords = [line.strip().decode('utf-8') for line in stopwords
+                     if line.strip()]
+
     corpus = tasks.Corpus(analyzed_items_path, dictionary_path, corpus_path,
                           model_path)
 
     es_update_actions = corpus.descriptive_terms_es_actions(index, field,
-                                                            top_n_terms)
-    bulk(es, actions=es_update_actions, chunk_size=1000)
+                                                            top_n_terms,
+                                                            stopwords)
+    with index_settings(index, bulk_load_settings):
+        bulk(es, actions=es_update_actions, chunk_size=1000)
+
+
+def es_format_index_action(index_name, doc_type, item):
+    return {
+        '_index': index_name,
+        '_type': doc_type,
+        '_id': item[0],
+        '_source': item[1]
+    }
 
 
 def es_format_index_actions(index_name, doc_type, item_iterable):
@@ -331,12 +901,122 @@ def es_format_index_actions(index_name, doc_type, item_iterable):
         if not item:
             pass
         else:
-            yield {
-                '_index': index_name,
-                '_type': doc_type,
-                '_id': item[0],
-                '_source': item[1]
-            }
+            yield es_format_index_action(index_name, doc_type, item)
+
+
+@cli.group()
+def benchmark():
+    """Performance benchmarks"""
+
+
+@benchmark.command('api')
+@click.option('--requests', default=1000, help='Number of requests')
+@click.option('--concurrency', default=8, help='Number of concurrent clients')
+@click.option('--es-latency', default=.02,
+              help='Response time (in seconds) of the fake Elasticsearch')
+@click.option('--es-jitter', default=.01,
+              help='Max. random deviation (in seconds) of the ES response time')
+@click.option('--cache', is_flag=True, help='Enable the search cache')
+@click.option('--payloads', default=None,
+              help='JSON file with the request patterns, defaults to'
+                   ' benchmarks/api_payloads.json')
+@click.option('--baseline', default='benchmarks/baselines/api.json',
+              help='Results to compare with')
+@click.option('--save-baseline', is_flag=True,
+              help='Store the results as the new baseline')
+@click.option('--tolerance', default=.2,
+              help='Allowed relative deviation from the baseline')
+def benchmark_api(requests, concurrency, es_latency, es_jitter, cache,
+                  payloads, baseline, save_baseline, tolerance):
+    """Load test the API against a fake Elasticsearch
+
+    Replays the request patterns of the front-end and reports the
+    throughput and latency percentiles per pattern. Fails when the results
+    are worse than the baseline.
+    """
+    from benchmarks import api
+
+    logging.getLogger('elasticsearch').setLevel(logging.WARNING)
+
+    patterns = api.load_patterns(payloads) if payloads\
+        else api.load_patterns()
+    results = api.run_api_benchmark(patterns, requests, concurrency,
+                                    es_latency, es_jitter, cache)
+    click.echo(api.format_results(results))
+
+    if save_baseline:
+        if os.path.dirname(baseline) and\
+                not os.path.isdir(os.path.dirname(baseline)):
+            os.makedirs(os.path.dirname(baseline))
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo('Stored baseline in %s' % baseline)
+    elif os.path.exists(baseline):
+        with open(baseline) as f:
+            regressions = api.compare_to_baseline(results, json.load(f),
+                                                  tolerance)
+        if regressions:
+            raise click.ClickException('Regressions compared to %s:\n%s'
+                                       % (baseline, '\n'.join(regressions)))
+        click.echo('No regressions compared to %s' % baseline)
+
+
+@benchmark.command('ingest')
+@click.option('--docs', default=10000, help='Number of documents per fixture')
+@click.option('--words-per-doc', default=300,
+              help='Number of words in the text of each document')
+@click.option('--stage', 'stages', multiple=True,
+              help='Stage to run (repeatable), defaults to all stages')
+@click.option('--workdir', default=None,
+              help='Directory of the generated archives, token store and'
+                   ' corpus, which are reused by later runs; defaults to'
+                   ' avresearcher_ingest_benchmark in the temp. directory')
+@click.option('--seed', default=0, help='Seed of the synthetic data')
+@click.option('--output', default=None, type=click.File('wb'),
+              help='File to write the results to, as JSON')
+def benchmark_ingest(docs, words_per_doc, stages, workdir, seed, output):
+    """Benchmark the ingestion pipeline on synthetic data
+
+    Reads synthetic tar.gz archives, formats the bulk actions, tokenizes
+    the text and builds bags-of-words and descriptive terms, each as a
+    separate stage. Reports the docs/sec, MB/sec and peak RSS per stage.
+
+    \b
+    Stages:
+    - get_immix_items, get_kb_items
+    - es_format_index_actions
+    - tokenize
+    - iter_docs
+    - get_analyzed_items
+    - get_descriptive_terms
+
+    The last four require the text analysis requirements.
+    """
+    from benchmarks import ingest
+
+    # Don't measure (and print) the debug messages of each document, and
+    # the progress of gensim.
+    logger.setLevel(logging.WARNING)
+
+    workdir = workdir or os.path.join(tempfile.gettempdir(),
+                                      'avresearcher_ingest_benchmark')
+
+    readers = {
+        'immix': get_immix_items,
+        'kb': get_kb_items,
+        'format': es_format_index_actions,
+        'index_name': 'avresearcher_immix',
+    }
+    try:
+        results = ingest.run_ingest_benchmark(workdir, readers, docs,
+                                              words_per_doc,
+                                              stages or ingest.STAGES, seed)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    click.echo(ingest.format_results(results))
+    if output is not None:
+        json.dump(results, output, indent=2)
 
 
 if __name__ == '__main__':
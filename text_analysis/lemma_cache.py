@@ -0,0 +1,117 @@
+"""Persistent cache of parsed (POS tagged and lemmatized) sentences.
+
+Parsing with pattern.nl dominates the time spent tokenizing, while OCR'd
+newspaper text and subtitles repeat many sentences. The cache stores, for
+each sentence, the (tag, lemma) pairs produced by the parser, so that only
+the filters in :func:`tokenizer.tokenize` have to be applied again; changing
+those filters does not invalidate the cache.
+
+The cache is an SQLite database, so it can be shared by the processes of a
+tokenizer pool.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+
+from pattern.nl import parse, tokenize as split_sentences
+
+
+__all__ = ['LemmaCache']
+
+
+class LemmaCache(object):
+    """Maps sentences to their parsed (tag, lemma) pairs.
+
+    :param path: path of the SQLite database.
+    :param max_entries: max. number of cached sentences; the least recently
+                        used sentences are removed when the cache grows
+                        larger.
+    :param flush_every: number of new entries that are buffered before they
+                        are written to the database.
+    """
+
+    def __init__(self, path, max_entries=5000000, flush_every=1000):
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path, timeout=300)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sentences ('
+                           ' key BLOB PRIMARY KEY,'
+                           ' parsed TEXT NOT NULL,'
+                           ' used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS sentences_used'
+                           ' ON sentences (used)')
+        self._conn.commit()
+
+        self._new = {}
+        self._used = set()
+
+    def parse(self, text):
+        """Yields a (tag, lemma) pair for each token in the text."""
+        for sentence in split_sentences(text):
+            for tag, lemma in self._parse_sentence(sentence):
+                yield tag, lemma
+
+    def _parse_sentence(self, sentence):
+        key = sqlite3.Binary(hashlib.sha1(sentence.encode('utf-8')).digest())
+
+        parsed = self._new.get(key)
+        if parsed is None:
+            row = self._conn.execute('SELECT parsed FROM sentences'
+                                     ' WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                parsed = json.loads(row[0])
+                self._used.add(key)
+
+        if parsed is not None:
+            self.hits += 1
+            return parsed
+
+        self.misses += 1
+        parsed = [(tag, lemma) for s in parse(sentence, tokenize=False,
+                                              lemmata=True, collapse=False)
+                  for _, tag, _, _, lemma in s]
+
+        self._new[key] = parsed
+        if len(self._new) >= self.flush_every:
+            self.flush()
+
+        return parsed
+
+    def flush(self):
+        """Writes new entries (and the use of existing ones) to the
+        database, and removes the least recently used entries if the cache
+        is too large."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO sentences (key, parsed, used)'
+                ' VALUES (?, ?, ?)',
+                ((key, json.dumps(parsed), now)
+                 for key, parsed in self._new.iteritems()))
+            self._conn.executemany(
+                'UPDATE sentences SET used = ? WHERE key = ?',
+                ((now, key) for key in self._used))
+
+            n_entries = self._conn.execute('SELECT COUNT(*) FROM sentences')\
+                .fetchone()[0]
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM sentences WHERE key IN (SELECT key FROM'
+                    ' sentences ORDER BY used LIMIT ?)',
+                    (n_entries - self.max_entries,))
+
+        self._new = {}
+        self._used = set()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
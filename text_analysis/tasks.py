@@ -1,16 +1,29 @@
 import os
 from glob import iglob
 import json
+import shutil
 import tarfile
+import tempfile
+import time
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
-import zmq
+import numpy as np
 from gensim.corpora.dictionary import Dictionary
 from gensim.corpora import MmCorpus
+from gensim.matutils import corpus2csc
 from gensim.models.tfidfmodel import TfidfModel
 
+from lemma_cache import LemmaCache
+from token_store import TokenShard, TokenStore
 from tokenizer import tokenize
 
 
+# Terms that are never used as descriptive terms
+STOPWORDS = ['null', 'nul', 'nou', 'kilometer', 'punt', 'applaus', 'radio']
+
+
 def extract_kb_text(item):
     if 'text' in item and item['text']:
         return item['text']
@@ -44,87 +57,158 @@ def extract_immix_summaries(item):
     return None
 
 
-def tokenize_producer(socket_addr, items_path, text_extractor):
-    """Sends the file's name and text as JSON for each file
-    in ``items_path``"""
-    if text_extractor == 'kb_text':
-        text_extractor = extract_kb_text
-    elif text_extractor == 'immix_subtitles':
-        text_extractor = extract_immix_subtitles
-    elif text_extractor == 'immix_summaries':
-        text_extractor = extract_immix_summaries
-    else:
-        raise ValueError('Unknown text extractor (\'%s\')' % text_extractor)
+TEXT_EXTRACTORS = {
+    'kb_text': extract_kb_text,
+    'immix_subtitles': extract_immix_subtitles,
+    'immix_summaries': extract_immix_summaries,
+}
 
-    context = zmq.Context()
 
-    zmq_socket = context.socket(zmq.PUSH)
-    zmq_socket.setsockopt(zmq.SNDHWM, 1000)
-    zmq_socket.bind(socket_addr)
+def tokenize_items(items_path, tokenized_items_path, text_extractor,
+                   workers=None, chunk_size=10000, progress_cnt=10000,
+                   lemma_cache_path=None, lemma_cache_size=5000000):
+    """Tokenizes the text of each file in ``items_path`` (a glob pattern)
+    with a pool of ``workers`` processes (default: one per core), and
+    stores the tokens in the token store ``tokenized_items_path``.
+
+    The items are processed in sorted order in chunks of ``chunk_size``.
+    Each chunk is written to its own shard, named after the number of its
+    first item, so the output does not depend on the number of workers.
+
+    If ``lemma_cache_path`` is given, the parser output of each sentence is
+    cached in (and reused from) a :class:`LemmaCache` of max.
+    ``lemma_cache_size`` sentences at that path, shared by the workers.
+    """
+    if text_extractor not in TEXT_EXTRACTORS:
+        raise ValueError('Unknown text extractor (\'%s\')' % text_extractor)
 
-    for item in iglob(items_path):
-        print item
-        with open(item, 'r') as item_f:
-            try:
-                text = text_extractor(json.load(item_f))
-            except ValueError:
+    items = sorted(iglob(items_path))
+    chunks = ((start, items[start:start + chunk_size], tokenized_items_path,
+               text_extractor, lemma_cache_path, lemma_cache_size)
+              for start in xrange(0, len(items), chunk_size))
+
+    pool = Pool(workers)
+
+    n_items = n_tokenized = n_tokens = cache_hits = cache_misses = 0
+    start_time = time.time()
+    for chunk_items, chunk_tokenized, chunk_tokens, chunk_hits, chunk_misses\
+            in pool.imap_unordered(_tokenize_chunk, chunks):
+        n_items += chunk_items
+        n_tokenized += chunk_tokenized
+        n_tokens += chunk_tokens
+        cache_hits += chunk_hits
+        cache_misses += chunk_misses
+
+        # Report each time another ``progress_cnt`` items are done
+        if n_items % progress_cnt < chunk_items or n_items == len(items):
+            elapsed = time.time() - start_time
+            print '%d/%d items (%d tokenized); %.1f items/sec, %.1f' \
+                  ' tokens/sec' % (n_items, len(items), n_tokenized,
+                                   n_items / elapsed, n_tokens / elapsed)
+            if lemma_cache_path:
+                print 'Lemma cache: %d hits, %d misses (%.1f%% hit rate)' \
+                      % (cache_hits, cache_misses, 100. * cache_hits /
+                         max(cache_hits + cache_misses, 1))
+
+    pool.close()
+    pool.join()
+
+    return n_tokenized
+
+
+def _tokenize_chunk(chunk):
+    # Runs in a worker process. Returns the number of items, the number of
+    # items that yielded tokens, the total number of tokens, and the number
+    # of lemma cache hits and misses.
+    start, items, tokenized_items_path, text_extractor, lemma_cache_path, \
+        lemma_cache_size = chunk
+    text_extractor = TEXT_EXTRACTORS[text_extractor]
+
+    lemma_cache = None
+    if lemma_cache_path:
+        lemma_cache = LemmaCache(lemma_cache_path, lemma_cache_size)
+
+    n_tokenized = n_tokens = 0
+    store = TokenStore(tokenized_items_path)
+    with store.writer('%09d' % start) as shard:
+        for item in items:
+            with open(item, 'r') as item_f:
+                try:
+                    text = text_extractor(json.load(item_f))
+                except ValueError:
+                    continue
+
+            if not text:
                 continue
 
-        if not text:
-            continue
+            tokens = list(tokenize(text, lemma_cache=lemma_cache))
+            if not tokens:
+                continue
 
-        zmq_socket.send_json({'filename': item, 'text': text})
+            # The item's filename without '.json'
+            shard.add(os.path.split(item)[-1][:-5], tokens)
 
+            n_tokenized += 1
+            n_tokens += len(tokens)
 
-def tokenize_consumer(socket_addr, tokenized_items_path):
-    """For each recieved item, tokenizes the text and stores the tokens
-    in a file on disk (one line per token)"""
-    context = zmq.Context()
+    if lemma_cache is None:
+        return len(items), n_tokenized, n_tokens, 0, 0
 
-    consumer_receiver = context.socket(zmq.PULL)
-    consumer_receiver.connect(socket_addr)
+    lemma_cache.close()
+    return (len(items), n_tokenized, n_tokens, lemma_cache.hits,
+            lemma_cache.misses)
 
-    # File and directory counters used to partition the files in multiple
-    # sub-directories
-    file_c = 0
-    dir_c = 0
 
-    while True:
-        data = consumer_receiver.recv_json()
-        tokens = list(tokenize(data['text']))
+def pack_token_files(token_files_path, tokenized_items_path,
+                     items_per_shard=10000):
+    """Converts the tokens written by earlier versions of the tokenizer into
+    a token store. ``token_files_path`` is a glob pattern matching files
+    with one token per line, or tar.gz archives of such files.
+
+    Returns the number of documents.
+    """
+    store = TokenStore(tokenized_items_path)
+    docs = _iter_token_files(sorted(iglob(token_files_path)))
 
-        if tokens:
-            filename = os.path.split(data['filename'])[-1][:-5]
-            filename = os.path.join(tokenized_items_path, str(dir_c),
-                                    '%s.txt' % filename)
+    n_docs = 0
+    for block in _iter_blocks(docs, items_per_shard):
+        with store.writer('%09d' % n_docs) as shard:
+            for doc_name, tokens in block:
+                shard.add(doc_name, tokens)
+        n_docs += len(block)
 
-            # Open the file, and create the directory if it doesn't exist
-            try:
-                doc = open(filename, 'w')
-            except IOError:
-                os.mkdir(os.path.join(tokenized_items_path, str(dir_c)))
-                doc = open(filename, 'w')
+    return n_docs
 
-            # Each line stores a single token
-            for token in tokens:
-                doc.write('%s\n' % token.encode('utf-8'))
 
-            doc.close()
+def _iter_token_files(paths):
+    # Yields (document name, tokens) for each token file; the document name
+    # is the filename without extension.
+    for path in paths:
+        if path.endswith(('.tar.gz', '.tgz')):
+            with tarfile.open(path, 'r:gz') as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield (_token_doc_name(member.name),
+                               _read_tokens(tar.extractfile(member)))
+
+                    # Don't keep the members that were read in memory
+                    tar.members = []
+        else:
+            with open(path, 'r') as f:
+                yield _token_doc_name(path), _read_tokens(f)
 
-            # Update the file and document counts
-            file_c += 1
-            if file_c % 10000 == 0:
-                dir_c += 1
+
+def _token_doc_name(path):
+    return os.path.splitext(os.path.split(path)[-1])[0]
+
+
+def _read_tokens(f):
+    return [token[:-1].decode('utf-8') for token in f]
 
 
 def iter_docs(analyzed_items_path, progress_cnt=1000):
     docno = 0
-    for doc in iglob(analyzed_items_path):
-        tokens = []
-        with open(doc, 'r') as f:
-            for token in f:
-                tokens.append(token[:-1].decode('utf-8'))
-
+    for _, tokens in TokenStore(analyzed_items_path):
         docno += 1
         if docno % progress_cnt == 0:
             print docno
@@ -132,8 +216,50 @@ def iter_docs(analyzed_items_path, progress_cnt=1000):
         yield tokens
 
 
-def create_dictionary(analyzed_items_path, dictionary_path=None):
-    dictionary = Dictionary(iter_docs(analyzed_items_path))
+def create_dictionary(analyzed_items_path, dictionary_path=None, workers=1,
+                      no_below=None, no_above=None, keep_n=None,
+                      prune_at=2000000):
+    """Creates a dictionary of the items in a token store.
+
+    With ``workers`` > 1, a dictionary is created for each shard of the
+    store by a pool of processes. The workers save these to a temporary
+    directory, and each is merged into the final dictionary as soon as it
+    is done, so only one shard dictionary at a time is loaded here. Whenever
+    a (merged) dictionary grows beyond ``prune_at`` tokens, only the
+    ``prune_at`` most frequent ones are kept, which bounds memory use at the
+    cost of exact counts for the rarest tokens.
+
+    If any of ``no_below``, ``no_above`` or ``keep_n`` is given, the final
+    dictionary is pruned with those thresholds; the ones that are not given
+    don't remove any tokens.
+    """
+    if workers > 1:
+        shard_paths = TokenStore(analyzed_items_path).shard_paths()
+        tmp_dir = tempfile.mkdtemp(prefix='dictionaries-')
+        pool = Pool(workers)
+
+        dictionary = Dictionary()
+        try:
+            for n, path in enumerate(pool.imap_unordered(
+                    partial(_shard_dictionary, tmp_dir=tmp_dir,
+                            prune_at=prune_at), shard_paths), 1):
+                _merge_dictionary(dictionary, Dictionary.load(path), prune_at)
+                os.remove(path)
+                print 'Merged %d/%d shard dictionaries' % (n,
+                                                           len(shard_paths))
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(tmp_dir)
+    else:
+        dictionary = Dictionary(iter_docs(analyzed_items_path),
+                                prune_at=prune_at)
+
+    _filter_extremes(dictionary, no_below, no_above, keep_n)
 
     if dictionary_path:
         dictionary.save(dictionary_path)
@@ -141,6 +267,38 @@ def create_dictionary(analyzed_items_path, dictionary_path=None):
     return dictionary
 
 
+def _shard_dictionary(shard_path, tmp_dir, prune_at):
+    # Runs in a worker process. Returns the path of the saved dictionary.
+    dictionary = Dictionary((tokens for _, tokens in TokenShard(shard_path)),
+                            prune_at=prune_at)
+    path = os.path.join(tmp_dir, os.path.basename(shard_path) + '.dict')
+    dictionary.save(path)
+
+    return path
+
+
+def _merge_dictionary(dictionary, other, prune_at):
+    # Merges other into dictionary (in-place), and prunes the result.
+    dictionary.merge_with(other)
+
+    if prune_at is not None and len(dictionary) > prune_at:
+        dictionary.filter_extremes(no_below=1, no_above=1.0, keep_n=prune_at)
+
+    return dictionary
+
+
+def _filter_extremes(dictionary, no_below=None, no_above=None, keep_n=None):
+    # Dictionary.filter_extremes, but only with the thresholds that are set;
+    # the others get values that keep all tokens (instead of gensim's
+    # defaults).
+    if no_below is None and no_above is None and keep_n is None:
+        return
+
+    dictionary.filter_extremes(no_below=1 if no_below is None else no_below,
+                               no_above=1.0 if no_above is None else no_above,
+                               keep_n=keep_n)
+
+
 def merge_dictionaries(dictionaries_path, merged_dictionary_path=None):
     dict_paths = list(iglob(dictionaries_path))
 
@@ -169,6 +327,40 @@ def prune_dictionary(src_dictionary_path, dest_dictionary_path=None,
     return dictionary
 
 
+def _iter_blocks(corpus, block_size=10000):
+    # Yields lists of (at most) block_size documents.
+    corpus = iter(corpus)
+    while True:
+        block = list(islice(corpus, block_size))
+        if not block:
+            break
+        yield block
+
+
+def _top_n_terms(block, idfs, top_n, n_terms):
+    """Returns, for each bag-of-words in the block, an array with the ids of
+    the (at most) ``top_n`` terms with the highest tf * idf weight, in order
+    of decreasing weight. Terms with zero weight are never selected.
+
+    The TF-IDF model's normalization is left out: it does not change the
+    order of the terms within a document.
+    """
+    # Documents x terms
+    tf = corpus2csc(block, num_terms=n_terms, num_docs=len(block)).T.tocsr()
+
+    weights = tf.data * idfs[tf.indices]
+    rows = np.repeat(np.arange(len(block)), np.diff(tf.indptr))
+
+    # Sort all entries by row, then by decreasing weight, and keep the ones
+    # that rank among the top_n of their row.
+    order = np.lexsort((-weights, rows))
+    ranks = np.arange(len(order)) - tf.indptr[rows[order]]
+    keep = order[(ranks < top_n) & (weights[order] > 0)]
+
+    bounds = np.searchsorted(rows[keep], np.arange(1, len(block)))
+    return np.split(tf.indices[keep], bounds)
+
+
 class Corpus(object):
     def __init__(self, analyzed_items_path=None, dictionary_path=None,
                  corpus_path=None, tfidf_model_path=None):
@@ -195,31 +387,18 @@ class Corpus(object):
     def get_analyzed_items(self, doc2bow=False, return_filename=False,
                            progress_cnt=5000):
         docno = 0
-        for tarred_item_file in iglob(self.analyzed_items_path):
-            with tarfile.open(tarred_item_file, 'r:gz') as tar:
-                for f_item in tar:
-                    if not f_item.isfile():
-                        continue
-
-                    item = tar.extractfile(f_item)
-
-                    tokens = []
-                    for token in item:
-                        tokens.append(token[:-1].decode('utf-8'))
-
-                    if doc2bow:
-                        if return_filename:
-                            yield f_item.name, self.dictionary.doc2bow(tokens)
-                        else:
-                            yield self.dictionary.doc2bow(tokens)
-                    else:
-                        yield tokens
-
-                    docno += 1
-                    if docno % progress_cnt == 0:
-                        print docno
-
-                    tar.members = []
+        for item_name, tokens in TokenStore(self.analyzed_items_path):
+            if doc2bow:
+                if return_filename:
+                    yield item_name, self.dictionary.doc2bow(tokens)
+                else:
+                    yield self.dictionary.doc2bow(tokens)
+            else:
+                yield tokens
+
+            docno += 1
+            if docno % progress_cnt == 0:
+                print docno
 
     def construct_corpus(self, corpus_path):
         return MmCorpus.serialize(corpus_path,
@@ -231,35 +410,80 @@ class Corpus(object):
 
         return model
 
-    def get_descriptive_terms(self, top_n):
-        n_seen_items = 0
-        analyzed_items = self.get_analyzed_items(doc2bow=True,
-                                                 return_filename=True)
-        for item_name, doc_bow in analyzed_items:
-            top_n_tokens = sorted(self.tfidf_model[doc_bow],
-                key=lambda token: token[1], reverse=True)[:top_n]
+    def update_tfidf_model(self, corpus_path, model_path):
+        """Adds the analyzed items to the TF-IDF model without rebuilding it.
+
+        The items are serialized to a new corpus shard at ``corpus_path``,
+        using the existing dictionary (tokens that are not in the dictionary
+        are ignored). The shard's document frequencies are added to those of
+        the model, whose idf weights are then recomputed. Run
+        ``descriptive_terms_es_actions`` on the new items to index their
+        terms.
+        """
+        self.construct_corpus(corpus_path)
+        self.corpus = MmCorpus(corpus_path)
+
+        n_terms = len(self.dictionary)
+        dfs = np.zeros(n_terms, dtype=int)
+        n_docs = n_nnz = 0
+        for block in _iter_blocks(self.corpus):
+            tf = corpus2csc(block, num_terms=n_terms, num_docs=len(block))
+            dfs += np.bincount(tf.indices, minlength=n_terms)
+            n_docs += len(block)
+            n_nnz += tf.nnz
+
+        # Plain ints, like the ids and counts gensim puts in the model.
+        model = self.tfidf_model
+        for term_id in np.flatnonzero(dfs).tolist():
+            model.dfs[term_id] = model.dfs.get(term_id, 0) + int(dfs[term_id])
+        model.num_docs += n_docs
+        model.num_nnz += n_nnz
+        model.idfs = dict((term_id, model.wglobal(df, model.num_docs))
+                          for term_id, df in model.dfs.iteritems())
 
-            tokens = []
-            for token_id, score in top_n_tokens:
-                token = self.dictionary[token_id]
+        model.save(model_path)
+
+        return model
 
-                if token not in ['null', 'nul', 'nou', 'kilometer', 'punt',
-                                 'applaus', 'radio']:
-                    tokens.append(token)
+    def get_descriptive_terms(self, top_n, stopwords=STOPWORDS,
+                              block_size=10000, progress_cnt=5000):
+        """Yields the name and the ``top_n`` terms with the highest TF-IDF
+        weight of each item, in order of decreasing weight.
 
-            if n_seen_items % 100 == 0:
-                print item_name, tokens
+        The serialized corpus is read in blocks of ``block_size`` items,
+        which are weighted and ranked as a whole with NumPy. Terms in
+        ``stopwords`` are never selected.
+        """
+        n_terms = len(self.dictionary)
 
-            yield item_name, tokens
+        idfs = np.zeros(n_terms)
+        for term_id, idf in self.tfidf_model.idfs.iteritems():
+            if term_id < n_terms:
+                idfs[term_id] = idf
 
-            n_seen_items += 1
-            if n_seen_items % 5000 == 0:
-                print '*' * 20
-                print n_seen_items
-                print '*' * 20
+        stopword_ids = [self.dictionary.token2id[token] for token in stopwords
+                        if token in self.dictionary.token2id]
+        idfs[stopword_ids] = 0
 
-    def descriptive_terms_es_actions(self, index, field_name, top_n_terms=10):
-        for item_name, tokens in self.get_descriptive_terms(top_n_terms):
+        id2token = np.empty(n_terms, dtype=object)
+        for term_id, token in self.dictionary.iteritems():
+            id2token[term_id] = token
+
+        item_names = TokenStore(self.analyzed_items_path).doc_names()
+
+        n_seen_items = 0
+        for block in _iter_blocks(self.corpus, block_size):
+            for tokens in _top_n_terms(block, idfs, top_n, n_terms):
+                yield next(item_names), list(id2token[tokens])
+
+                n_seen_items += 1
+                if n_seen_items % progress_cnt == 0:
+                    print n_seen_items
+
+    def descriptive_terms_es_actions(self, index, field_name, top_n_terms=10,
+                                     stopwords=STOPWORDS):
+        for item_name, tokens in self.get_descriptive_terms(top_n_terms,
+                                                            stopwords):
             doc_id = item_name.split('/')[-1].split('.')[0]
             if doc_id[0] == '_':
                 doc_id = doc_id[1:]
@@ -0,0 +1,12 @@
+import sys
+import types
+
+
+# The tasks import pattern.nl's parser, which the tests don't use (or
+# replace); make them importable without it.
+try:
+    import pattern.nl
+except ImportError:
+    pattern = sys.modules['pattern'] = types.ModuleType('pattern')
+    pattern.nl = sys.modules['pattern.nl'] = types.ModuleType('pattern.nl')
+    pattern.nl.parse = pattern.nl.tokenize = None
@@ -0,0 +1,40 @@
+import random
+
+import numpy as np
+from gensim.corpora.dictionary import Dictionary
+from gensim.models.tfidfmodel import TfidfModel
+from text_analysis.tasks import _top_n_terms
+
+from nose.tools import assert_almost_equal, assert_equal, assert_not_in
+
+
+def test_top_n_terms():
+    rng = random.Random(0)
+    vocabulary = ['term%d' % n for n in range(50)]
+    docs = [[rng.choice(vocabulary) for _ in range(rng.randint(0, 30))]
+            for _ in range(100)]
+    # A term in all documents has zero weight.
+    docs = [doc + ['overal'] for doc in docs]
+
+    dictionary = Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+    model = TfidfModel(corpus)
+
+    idfs = np.zeros(len(dictionary))
+    for term_id, idf in model.idfs.iteritems():
+        idfs[term_id] = idf
+
+    top_n = 5
+    ranked = _top_n_terms(corpus, idfs, top_n, len(dictionary))
+    assert_equal(len(ranked), len(corpus))
+
+    for bow, term_ids in zip(corpus, ranked):
+        # The terms are ranked like sorting the document's TF-IDF vector
+        # (terms with equal weights may be in a different order).
+        weights = dict(model[bow])
+        expected = sorted(weights.itervalues(), reverse=True)[:top_n]
+        assert_equal(len(term_ids), len(expected))
+        for term_id, weight in zip(term_ids, expected):
+            assert_almost_equal(weights[term_id], weight)
+
+        assert_not_in(dictionary.token2id['overal'], term_ids)
@@ -0,0 +1,62 @@
+import shutil
+import tempfile
+
+from gensim.corpora.dictionary import Dictionary
+from text_analysis.tasks import (_filter_extremes, _merge_dictionary,
+                                 create_dictionary)
+from text_analysis.token_store import TokenStore
+
+from nose.tools import assert_equal
+
+
+DOCS = [['radio', 'nieuws', 'tijd'], ['radio', 'land'], ['radio', 'nieuws'],
+        ['stad', 'land', 'radio']]
+
+
+def token_dfs(dictionary):
+    return dict((dictionary[token_id], df)
+                for token_id, df in dictionary.dfs.iteritems())
+
+
+def test_merge_dictionary():
+    dictionary = Dictionary(DOCS[:2])
+    _merge_dictionary(dictionary, Dictionary(DOCS[2:]), prune_at=None)
+    assert_equal(token_dfs(dictionary), token_dfs(Dictionary(DOCS)))
+    assert_equal(dictionary.num_docs, 4)
+
+    # Only the most frequent tokens are kept.
+    dictionary = Dictionary(DOCS[:2])
+    _merge_dictionary(dictionary, Dictionary(DOCS[2:]), prune_at=3)
+    assert_equal(token_dfs(dictionary), {'radio': 4, 'nieuws': 2, 'land': 2})
+
+
+def test_create_dictionary():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store = TokenStore(tmp_dir)
+        for start in range(0, len(DOCS), 2):
+            with store.writer('%09d' % start) as shard:
+                for n, tokens in enumerate(DOCS[start:start + 2], start):
+                    shard.add('_%d' % n, tokens)
+
+        dictionary = create_dictionary(tmp_dir)
+        assert_equal(token_dfs(create_dictionary(tmp_dir, workers=2)),
+                     token_dfs(dictionary))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_filter_extremes():
+    # Thresholds that are not given don't remove tokens.
+    dictionary = Dictionary(DOCS)
+    _filter_extremes(dictionary, no_below=2)
+    assert_equal(sorted(token_dfs(dictionary)), ['land', 'nieuws', 'radio'])
+
+    dictionary = Dictionary(DOCS)
+    _filter_extremes(dictionary, no_above=.5)
+    assert_equal(sorted(token_dfs(dictionary)),
+                 ['land', 'nieuws', 'stad', 'tijd'])
+
+    dictionary = Dictionary(DOCS)
+    _filter_extremes(dictionary)
+    assert_equal(len(dictionary), 5)
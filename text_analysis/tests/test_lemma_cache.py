@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+
+from text_analysis import lemma_cache, tokenizer
+from text_analysis.lemma_cache import LemmaCache
+
+from nose.tools import assert_equal
+
+
+class FakeParser(object):
+    # Stand-in for pattern.nl's parse and tokenize: tags all words as
+    # nouns, and uses the lowercased word as lemma.
+    def __init__(self):
+        self.parsed = []
+
+    def split_sentences(self, text):
+        return [sentence.strip() for sentence in text.split('.')
+                if sentence.strip()]
+
+    def parse(self, text, lemmata=True, collapse=False, tokenize=True):
+        sentences = self.split_sentences(text) if tokenize else [text]
+        self.parsed.extend(sentences)
+        return [[(word, 'NN', None, None, word.lower())
+                 for word in sentence.split()] for sentence in sentences]
+
+
+def test_lemma_cache():
+    tmp_dir = tempfile.mkdtemp()
+    parser = FakeParser()
+    originals = (lemma_cache.parse, lemma_cache.split_sentences,
+                 tokenizer.parse)
+    lemma_cache.parse = tokenizer.parse = parser.parse
+    lemma_cache.split_sentences = parser.split_sentences
+    try:
+        path = os.path.join(tmp_dir, 'lemmas.db')
+        text = u'Het Nieuws. De radio. Het Nieuws.'
+
+        cache = LemmaCache(path, max_entries=2, flush_every=1)
+        assert_equal(list(cache.parse(text)),
+                     [('NN', 'het'), ('NN', 'nieuws'), ('NN', 'de'),
+                      ('NN', 'radio'), ('NN', 'het'), ('NN', 'nieuws')])
+        # Repeated sentences are parsed once.
+        assert_equal(parser.parsed, ['Het Nieuws', 'De radio'])
+        assert_equal((cache.hits, cache.misses), (1, 2))
+
+        # The tokens are the same as without the cache.
+        assert_equal(list(tokenizer.tokenize(text, lemma_cache=cache)),
+                     list(tokenizer.tokenize(text)))
+        cache.close()
+
+        # The cache is shared through the database; the least recently used
+        # sentence is removed when it grows too large.
+        cache = LemmaCache(path, max_entries=2, flush_every=1)
+        parser.parsed = []
+        list(cache.parse(u'Het Nieuws. Weer.'))
+        list(cache.parse(u'De radio.'))
+        cache.close()
+        assert_equal(parser.parsed, ['Weer', 'De radio'])
+        assert_equal(cache.hit_rate(), 1. / 3)
+    finally:
+        (lemma_cache.parse, lemma_cache.split_sentences,
+         tokenizer.parse) = originals
+        shutil.rmtree(tmp_dir)
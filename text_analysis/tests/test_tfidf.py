@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+from itertools import chain
+
+from gensim.corpora.dictionary import Dictionary
+from gensim.models.tfidfmodel import TfidfModel
+from text_analysis.tasks import Corpus
+from text_analysis.token_store import TokenStore
+
+from nose.tools import assert_almost_equal, assert_equal
+
+
+DOCS = [['radio', 'nieuws', 'tijd'], ['radio', 'land'], ['radio', 'nieuws'],
+        ['stad', 'land', 'radio', 'onbekend'], ['land', 'land', 'tijd']]
+
+
+def test_update_tfidf_model():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        def path(name):
+            return os.path.join(tmp_dir, name)
+
+        for name, docs in [('old', DOCS[:3]), ('new', DOCS[3:])]:
+            with TokenStore(path(name)).writer('000000000') as shard:
+                for n, tokens in enumerate(docs):
+                    shard.add('_%d' % n, tokens)
+
+        # The dictionary doesn't have the tokens that only occur in the new
+        # items.
+        Dictionary(DOCS[:3]).save(path('dictionary'))
+
+        corpus = Corpus(path('old'), path('dictionary'))
+        corpus.construct_corpus(path('old.mm'))
+        corpus = Corpus(path('old'), path('dictionary'), path('old.mm'))
+        corpus.construct_tfidf_model(path('model'))
+
+        corpus = Corpus(path('new'), path('dictionary'),
+                        tfidf_model_path=path('model'))
+        corpus.update_tfidf_model(path('new.mm'), path('model'))
+
+        # The same as a model of all items.
+        dictionary = Dictionary.load(path('dictionary'))
+        expected = TfidfModel([dictionary.doc2bow(doc) for doc in DOCS])
+        model = TfidfModel.load(path('model'))
+        assert_equal(model.num_docs, expected.num_docs)
+        assert_equal(model.num_nnz, expected.num_nnz)
+        assert_equal(model.dfs, expected.dfs)
+        assert_equal(set(type(x) for x in chain(*model.dfs.items())),
+                     set([int]))
+        assert_equal(sorted(model.idfs), sorted(expected.idfs))
+        for term_id, idf in expected.idfs.iteritems():
+            assert_almost_equal(model.idfs[term_id], idf)
+    finally:
+        shutil.rmtree(tmp_dir)
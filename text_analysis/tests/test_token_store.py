@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+from text_analysis.tasks import pack_token_files
+from text_analysis.token_store import TokenShard, TokenStore
+
+from nose.tools import assert_equal, assert_raises
+
+
+DOCS = [('_1', [u'radio', u'nieuws', u'radio']), ('_2', []),
+        ('_3', [u'café', u'nieuws'])]
+
+
+def test_token_store():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store = TokenStore(os.path.join(tmp_dir, 'store'))
+        with store.writer('000000000') as shard:
+            for doc_name, tokens in DOCS[:2]:
+                shard.add(doc_name, tokens)
+        with store.writer('000000002') as shard:
+            shard.add(*DOCS[2])
+
+        # A shard that was not closed properly is not read.
+        with assert_raises(ValueError):
+            with store.writer('000000003') as shard:
+                shard.add('_4', [u'radio'])
+                raise ValueError()
+
+        assert_equal(list(store), DOCS)
+        assert_equal(list(store.doc_names()), ['_1', '_2', '_3'])
+
+        shard = TokenShard(store.shard_paths()[0])
+        assert_equal(len(shard), 2)
+        assert_equal(shard['_1'], DOCS[0][1])
+
+        assert_equal(store['_3'], DOCS[2][1])
+        assert_equal(TokenStore(store.path)['_2'], [])
+        with assert_raises(KeyError):
+            store['_4']
+
+        # A shard that is rewritten is not read until it is closed.
+        shard = store.writer('000000002')
+        assert_equal(list(TokenStore(store.path)), DOCS[:2])
+        shard.add('_5', [u'radio'])
+        shard.close()
+        assert_equal(list(TokenStore(store.path)),
+                     DOCS[:2] + [('_5', [u'radio'])])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_pack_token_files():
+    def token_file(tokens):
+        return ''.join(token.encode('utf-8') + '\n' for token in tokens)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Token files, as written by the ZeroMQ tokenizer...
+        os.makedirs(os.path.join(tmp_dir, 'txt', 'a'))
+        for doc_name, tokens in DOCS:
+            with open(os.path.join(tmp_dir, 'txt', 'a',
+                                   doc_name + '.txt'), 'w') as f:
+                f.write(token_file(tokens))
+
+        # ... or archived in tar.gz files.
+        os.makedirs(os.path.join(tmp_dir, 'tar'))
+        for n, docs in enumerate([DOCS[:2], DOCS[2:]]):
+            with tarfile.open(os.path.join(tmp_dir, 'tar',
+                                           '%d.tar.gz' % n), 'w:gz') as tar:
+                for doc_name, tokens in docs:
+                    data = token_file(tokens)
+                    info = tarfile.TarInfo('a/%s.txt' % doc_name)
+                    info.size = len(data)
+                    tar.addfile(info, StringIO(data))
+
+        for token_files in ['txt/*/*.txt', 'tar/*.tar.gz']:
+            store_path = os.path.join(tmp_dir, 'store-' + token_files[:3])
+            assert_equal(pack_token_files(os.path.join(tmp_dir, token_files),
+                                          store_path, items_per_shard=2), 3)
+
+            store = TokenStore(store_path)
+            assert_equal(list(store), DOCS)
+            assert_equal(len(store.shard_paths()), 2)
+    finally:
+        shutil.rmtree(tmp_dir)
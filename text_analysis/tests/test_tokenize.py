@@ -0,0 +1,46 @@
+import json
+import os
+import shutil
+import tempfile
+
+from text_analysis import tokenizer
+from text_analysis.tasks import tokenize_items
+from text_analysis.token_store import TokenStore
+
+from nose.tools import assert_equal
+
+
+def fake_parse(text, lemmata=True, collapse=False, tokenize=True):
+    # Stand-in for pattern.nl.parse: tags all words as nouns, and uses the
+    # lowercased word as lemma.
+    return [[(word, 'NN', None, None, word.lower()) for word in
+             sentence.split()] for sentence in text.split('.')]
+
+
+def test_tokenize_items():
+    tmp_dir = tempfile.mkdtemp()
+    parse = tokenizer.parse
+    tokenizer.parse = fake_parse
+    try:
+        items = [{'text': 'Het Nieuws. De radio'}, {'text': ''},
+                 {'title': 'no text'}, {'text': 'Radio 1 en 2'},
+                 {'text': 'Weer de radio'}]
+        for n, item in enumerate(items):
+            with open(os.path.join(tmp_dir, '_%d.json' % n), 'w') as f:
+                json.dump(item, f)
+        with open(os.path.join(tmp_dir, '_5.json'), 'w') as f:
+            f.write('invalid')
+
+        items_path = os.path.join(tmp_dir, '*.json')
+        expected = [('_0', ['het', 'nieuws', 'radio']), ('_3', ['radio']),
+                    ('_4', ['weer', 'radio'])]
+
+        # The output doesn't depend on the number of workers.
+        for workers in [1, 3]:
+            store_path = os.path.join(tmp_dir, 'store-%d' % workers)
+            assert_equal(tokenize_items(items_path, store_path, 'kb_text',
+                                        workers=workers, chunk_size=2), 3)
+            assert_equal(list(TokenStore(store_path)), expected)
+    finally:
+        tokenizer.parse = parse
+        shutil.rmtree(tmp_dir)
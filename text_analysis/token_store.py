@@ -0,0 +1,181 @@
+"""Packed storage of tokenized documents.
+
+A token store is a directory of shards. Each shard consists of two files:
+
+- ``<shard>.tok``: the documents, each stored as an array of 32-bit token
+  ids. Documents are appended to this file as they are written.
+- ``<shard>.idx``: a JSON index, written when the shard is closed, with the
+  shard's vocabulary (token id -> token string) and the name, offset and
+  length of each document.
+
+A shard without an index was not closed properly and is ignored by the
+readers. Each shard has a single writer, so shards can be written by
+parallel processes.
+"""
+import json
+import os
+import sys
+from array import array
+from glob import glob
+
+
+__all__ = ['TokenShardWriter', 'TokenShard', 'TokenStore']
+
+
+TOKEN_ID_TYPE = 'I'
+
+
+class TokenShardWriter(object):
+    """Appends documents to a new shard.
+
+    :param path: path of the shard, without extension.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Remove the index of a shard that is rewritten, so the shard is not
+        # read until the new index is written.
+        if os.path.exists(path + '.idx'):
+            os.remove(path + '.idx')
+        self._data = open(path + '.tok', 'wb')
+        self._vocab = {}
+        self._docs = []
+        self._offset = 0
+
+    def add(self, doc_name, tokens):
+        """Appends a document (a sequence of token strings)."""
+        vocab = self._vocab
+        ids = array(TOKEN_ID_TYPE,
+                    [vocab.setdefault(token, len(vocab)) for token in tokens])
+        ids.tofile(self._data)
+
+        self._docs.append((doc_name, self._offset, len(ids)))
+        self._offset += len(ids) * ids.itemsize
+
+    def close(self):
+        """Closes the data file and writes the index."""
+        self._data.close()
+
+        vocab = [None] * len(self._vocab)
+        for token, token_id in self._vocab.iteritems():
+            vocab[token_id] = token
+
+        tmp_path = self.path + '.idx.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'byteorder': sys.byteorder, 'vocab': vocab,
+                       'docs': self._docs}, f)
+        os.rename(tmp_path, self.path + '.idx')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the shard without an index, so it is not read.
+            self._data.close()
+
+
+class TokenShard(object):
+    """Reads the documents in a (closed) shard.
+
+    :param path: path of the shard, without extension.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx') as f:
+            index = json.load(f)
+
+        self.vocab = index['vocab']
+        self.docs = index['docs']
+        self._swap = index['byteorder'] != sys.byteorder
+        self._positions = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _read(self, f, n_tokens):
+        ids = array(TOKEN_ID_TYPE)
+        ids.fromfile(f, n_tokens)
+        if self._swap:
+            ids.byteswap()
+
+        vocab = self.vocab
+        return [vocab[token_id] for token_id in ids]
+
+    def __iter__(self):
+        """Yields (document name, tokens) for each document, in the order
+        they were written."""
+        with open(self.path + '.tok', 'rb') as f:
+            for doc_name, offset, n_tokens in self.docs:
+                yield doc_name, self._read(f, n_tokens)
+
+    def __getitem__(self, doc_name):
+        """Returns the tokens of a single document."""
+        if self._positions is None:
+            self._positions = dict((doc[0], doc[1:]) for doc in self.docs)
+
+        offset, n_tokens = self._positions[doc_name]
+        with open(self.path + '.tok', 'rb') as f:
+            f.seek(offset)
+            return self._read(f, n_tokens)
+
+
+class TokenStore(object):
+    """A directory of token shards.
+
+    Shards are named by the caller; they are read in sorted order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._shard_of_doc = None
+
+    def shard_paths(self):
+        return sorted(p[:-len('.idx')]
+                      for p in glob(os.path.join(self.path, '*.idx')))
+
+    def shards(self):
+        for path in self.shard_paths():
+            yield TokenShard(path)
+
+    def writer(self, shard_name):
+        """Returns a :class:`TokenShardWriter` for a new shard."""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Another process may have created it first.
+                if not os.path.isdir(self.path):
+                    raise
+
+        return TokenShardWriter(os.path.join(self.path, shard_name))
+
+    def doc_names(self):
+        """Yields the name of each document in the store, in the same order
+        as iterating over the store, without reading the tokens."""
+        for shard in self.shards():
+            for doc_name, _, _ in shard.docs:
+                yield doc_name
+
+    def __iter__(self):
+        """Yields (document name, tokens) for each document in the store."""
+        for shard in self.shards():
+            for doc in shard:
+                yield doc
+
+    def __getitem__(self, doc_name):
+        """Returns the tokens of a single document.
+
+        The shard indexes are read on the first lookup; shards written
+        after that are not seen by this store object.
+        """
+        if self._shard_of_doc is None:
+            self._shard_of_doc = {}
+            for shard in self.shards():
+                for name, _, _ in shard.docs:
+                    self._shard_of_doc[name] = shard
+
+        return self._shard_of_doc[doc_name][doc_name]
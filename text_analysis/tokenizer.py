@@ -13,7 +13,7 @@ LEMMA_CHARS = re.compile(r'^[a-z][a-z.\-/]*[a-z.]$')
 
 
 def tokenize(text, min_lemma=3, max_lemma=30, allowed_pos_tags=POS_TAGS,
-             allowed_lemma_chars=LEMMA_CHARS):
+             allowed_lemma_chars=LEMMA_CHARS, lemma_cache=None):
     """
     Tokenize and lemmatize the input text and return a generator that
     yields lemmas.
@@ -25,11 +25,18 @@ def tokenize(text, min_lemma=3, max_lemma=30, allowed_pos_tags=POS_TAGS,
                              we are interested in.
     :param allowed_lemma_chars: a compiled regex that matches lemma's we are
                              interested in.
+    :param lemma_cache: a :class:`lemma_cache.LemmaCache` with the parser
+                        output of previously seen sentences.
     """
-    parsed = parse(text, lemmata=True, collapse=False)
-    for sentence in parsed:
-        for token, tag, _, _, lemma in sentence:
-            if min_lemma <= len(lemma) <= max_lemma \
-                    and allowed_pos_tags.match(tag)\
-                    and allowed_lemma_chars.match(lemma):
-                yield lemma
+    if lemma_cache is None:
+        parsed = ((tag, lemma) for sentence in parse(text, lemmata=True,
+                                                     collapse=False)
+                  for _, tag, _, _, lemma in sentence)
+    else:
+        parsed = lemma_cache.parse(text)
+
+    for tag, lemma in parsed:
+        if min_lemma <= len(lemma) <= max_lemma \
+                and allowed_pos_tags.match(tag)\
+                and allowed_lemma_chars.match(lemma):
+            yield lemma
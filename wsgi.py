@@ -1,3 +1,8 @@
 from avresearcher import create_app
+from avresearcher.app import warm_up
 
 app = create_app()
+
+# Open the ES connections before the first request; 'manage.py serve' loads
+# this module in each worker process, after forking.
+warm_up(app)